@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Measure speed and memory of plot-, check- and compare-nr-running.py on
+synthetic traces and compare them with stored baseline.
+Copyright (C) 2020  Jiri Vozar
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+from prettytable import PrettyTable
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Traces of benchmark cases: CPUs, events, NUMA nodes
+CASES = {
+    "small": (48, 10**5, 2),
+    "medium": (256, 10**6, 4),
+    "large": (1024, 10**7, 8),
+    "huge": (1024, 10**8, 8),
+}
+DEFAULT_CASES = ["small", "medium"]
+
+# Phases of PhaseTimer reports summed to phases of benchmark
+PHASES = {
+    "read": "parse",
+    "aggregate": "analyze",
+    "utilization": "analyze",
+    "heat map": "render",
+    "lines": "render",
+    "axes": "render",
+    "save": "render",
+    "tables": "render",
+}
+TIMES_RE = re.compile(r"([a-z][a-z ]*) (\d+[.]\d+) s")
+
+# Decompression alone, the scripts decompress in parallel with parsing
+DECOMPRESS_CODE = """
+import sys
+sys.path.insert(0, sys.argv[1])
+from nr_running import open_trace
+with open(sys.argv[2], 'r') as input_file:
+    stream = open_trace(input_file, mapped=False)
+    while stream.read(1 << 20):
+        pass
+"""
+
+
+def generate_trace(work_dir, case):
+    """Generate trace and lscpu file of benchmark case, unless they exist. Return their names."""
+    cpus, events, nodes = CASES[case]
+    trace = os.path.join(work_dir, "{}.trace.xz".format(case))
+    lscpu = os.path.join(work_dir, "{}.lscpu.txt".format(case))
+    if not (os.path.exists(trace) and os.path.exists(lscpu)):
+        duration = events / cpus / 1000
+        print("Generating trace '{}'".format(trace), file=sys.stderr)
+        subprocess.run([sys.executable, os.path.join(SCRIPT_DIR, "generate-nr-running.py"),
+                        "--cpus", str(cpus), "--events", str(events), "--nodes", str(nodes),
+                        "--imbalance", "{}:{}:0:2".format(duration / 4, duration / 10),
+                        "--output", trace + ".tmp.xz", "--lscpu-file", lscpu], check=True)
+        os.replace(trace + ".tmp.xz", trace)
+    return trace, lscpu
+
+
+def run(command):
+    """Run command and return (wall seconds, peak RSS in bytes, stderr)."""
+    with tempfile.TemporaryFile('w+') as errors:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=errors)
+        _, status, usage = os.wait4(process.pid, 0)
+        wall = time.perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+        errors.seek(0)
+        output = errors.read()
+    if process.returncode:
+        print(output, file=sys.stderr)
+        raise subprocess.CalledProcessError(process.returncode, command)
+    return wall, usage.ru_maxrss * 1024, output
+
+
+def measure(command, events, repeat):
+    """Return the fastest of repeated runs of command as dictionary of metrics."""
+    best = None
+    for _ in range(repeat):
+        wall, rss, output = run(command)
+        phases = {}
+        for line in output.splitlines():
+            if line.startswith("Times: "):
+                for name, seconds in TIMES_RE.findall(line[len("Times: "):]):
+                    phase = PHASES.get(name, name)
+                    phases[phase] = phases.get(phase, 0.0) + float(seconds)
+        if best is None or wall < best["seconds"]:
+            best = {"seconds": wall, "phases": phases, "max_rss": rss}
+    best["events_per_second"] = events / best["seconds"]
+    return best
+
+
+def run_case(case, work_dir, repeat):
+    """Return dictionary of metrics of all benchmarks of case."""
+    trace, lscpu = generate_trace(work_dir, case)
+    events = CASES[case][1]
+    image = os.path.join(work_dir, case + ".png")
+    python = [sys.executable]
+    benchmarks = {
+        "decompress": python + ["-c", DECOMPRESS_CODE, SCRIPT_DIR, trace],
+        "plot": python + [os.path.join(SCRIPT_DIR, "plot-nr-running.py"), "--no-cache", "--render-times",
+                          "--lscpu-file", lscpu, "--image-file", image, trace],
+        "check": python + [os.path.join(SCRIPT_DIR, "check-nr-running.py"), "--no-cache", "--render-times",
+                           "--lscpu-file", lscpu, trace],
+        "compare": python + [os.path.join(SCRIPT_DIR, "compare-nr-running.py"), "--no-cache", "--render-times",
+                             "--lscpu-file", lscpu, "--image-file", image, trace, trace],
+    }
+    results = {}
+    for name, command in benchmarks.items():
+        print("Running {} of {} case".format(name, case), file=sys.stderr)
+        results[name] = measure(command, events, repeat)
+    return results
+
+
+def print_results(results, out=None):
+    table = PrettyTable(["Case", "Benchmark", "Time (s)", "Parse (s)", "Analyze (s)", "Render (s)",
+                         "Events/s", "Peak RSS (MB)"])
+    for case, benchmarks in results.items():
+        for name, metrics in benchmarks.items():
+            phases = metrics["phases"]
+            table.add_row([case, name, "{:.2f}".format(metrics["seconds"])]
+                          + ["{:.2f}".format(phases[phase]) if phase in phases else "-"
+                             for phase in ("parse", "analyze", "render")]
+                          + ["{:.0f}".format(metrics["events_per_second"]), metrics["max_rss"] >> 20])
+    print(table, file=out)
+
+
+def compare_baseline(results, baseline, tolerance):
+    """Return list of messages about metrics worse than baseline by more than tolerance."""
+    regressions = []
+    for case, benchmarks in results.items():
+        for name, metrics in benchmarks.items():
+            old = baseline.get(case, {}).get(name)
+            if not old:
+                continue
+            for metric, unit in (("seconds", "s"), ("max_rss", "B")):
+                if metrics[metric] > old[metric] * (1 + tolerance):
+                    regressions.append("{} of {} case: {} {:.3g} {} is worse than baseline {:.3g} {}".format(
+                        name, case, metric, metrics[metric], unit, old[metric], unit))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure time of phases, events per second and peak memory "
+                                     "of scripts on synthetic traces, optionally compared to baseline.")
+    parser.add_argument("--cases", nargs="+", default=DEFAULT_CASES, choices=CASES.keys(),
+                        help="Benchmark cases by size of trace, defaults to " + " ".join(DEFAULT_CASES))
+    parser.add_argument("--work-dir", type=str, default=None,
+                        help="Directory for generated traces, which are kept for later runs, "
+                             "defaults to temporary directory")
+    parser.add_argument("--repeat", default=3, type=int,
+                        help="Number of runs of each benchmark, the fastest one is reported")
+    parser.add_argument("--baseline", type=str, default=None,
+                        help="JSON file with results of earlier run, the run fails when it's slower "
+                             "or uses more memory")
+    parser.add_argument("--tolerance", default=0.2, type=float,
+                        help="Allowed relative regression compared to baseline")
+    parser.add_argument("--save-baseline", type=str, default=None,
+                        help="Write results to JSON file usable as --baseline")
+
+    try:
+        args = parser.parse_args()
+    except SystemExit:
+        sys.exit(1)
+
+    if args.work_dir:
+        os.makedirs(args.work_dir, exist_ok=True)
+        work_dir = args.work_dir
+    else:
+        # The directory is removed at exit
+        temporary_dir = tempfile.TemporaryDirectory(prefix="nr_running-benchmark-")
+        work_dir = temporary_dir.name
+
+    results = {case: run_case(case, work_dir, args.repeat) for case in args.cases}
+    print_results(results)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_baseline(results, baseline, args.tolerance)
+        for regression in regressions:
+            print("ERROR: Regression of " + regression)
+        if regressions:
+            sys.exit(1)
+        print("No regression against baseline '{}'".format(args.baseline))
+
+
+if __name__ == "__main__":
+    main()
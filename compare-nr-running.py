@@ -21,259 +21,399 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 import argparse
-from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import io
 import math
+import os
 import sys
-import re
 
 import numpy as np
-import matplotlib
-#matplotlib.use('agg')  # Make it work also on machines without tkinter
-import matplotlib.pyplot as plt
-from matplotlib.colors import ListedColormap, BoundaryNorm
-from matplotlib import collections as mc
-from matplotlib.ticker import MultipleLocator
-
-def draw_report(title, time_axis0, map_values0, differences0, imbalances0, sums0, time_axis1, map_values1, differences1, imbalances1, sums1, image_file=None, numa_cpus={}):
-    # Transpose heat map data to right axes
-    map_values0 = np.array(map_values0)[:-1, :].transpose()
-    map_values1 = np.array(map_values1)[:-1, :].transpose()
-
-    # Group CPU lines by NUMA nodes
-    if numa_cpus:
-        new_order = []
-        for k, v in numa_cpus.items():
-            new_order += v
-        map_values0 = map_values0[new_order]
-        map_values1 = map_values1[new_order]
-
-    # Add blank row to correctly plot all rows with data
-    map_values0 = np.vstack((map_values0, np.zeros(map_values0.shape[1])))
-    map_values1 = np.vstack((map_values1, np.zeros(map_values1.shape[1])))
-
-    cmap = ListedColormap(['#000000', '#305090', '#40b080', '#f0e020', '#f04010'])
-    boundaries = [-0.5, 0.5, 1.5, 2.5, 3.5, 4.5]
-    norm = BoundaryNorm(boundaries, cmap.N, clip=True)
-
-    fig, axs = plt.subplots(nrows=4, ncols=1, gridspec_kw=dict(height_ratios=[4, 4, 1, 2]),
-                            figsize=(20, 15), sharex=True) # , constrained_layout=True)
-    fig.subplots_adjust(hspace=0.1)
-
-    # Draw the main heat map
-    x_grid0, y_grid0 = np.meshgrid(time_axis0, range(len(map_values0)))
-    mesh0 = axs[0].pcolormesh(x_grid0, y_grid0, map_values0, vmin=0, vmax=4, cmap=cmap, norm=norm)
-
-    axs[0].set_xlim(min(time_axis0[0], time_axis1[0]), max(time_axis0[-1], time_axis1[-1]))
-    axs[0].set_ylim([0, map_values0.shape[0] - 1])
-
-    cmap1 = ListedColormap(['#000000', '#305090', '#40b080', '#f0e020', '#f04010'])
-    norm1 = BoundaryNorm(boundaries, cmap1.N, clip=True)
-
-    x_grid1, y_grid1 = np.meshgrid(time_axis1, range(len(map_values1)))
-    mesh1 = axs[1].pcolormesh(x_grid1, y_grid1, map_values1, vmin=0, vmax=4, cmap=cmap1, norm=norm1)
-
-    axs[1].set_xlim(min(time_axis0[0], time_axis1[0]), max(time_axis0[-1], time_axis1[-1]))
-    axs[1].set_ylim([0, map_values1.shape[0] - 1])
-
-    # Create colorbar
-    cbar = fig.colorbar(mesh0, cax=plt.axes([0.95, 0.05, 0.02, 0.9]),
-                        extend='max', ticks=range(5))
-    cbar.ax.set_yticklabels(['0', '1', '2', '3', '4+'])
-    cbar.ax.set_ylabel("Number of tasks on CPU core")
-    plt.subplots_adjust(bottom=0.05, right=0.9, top=0.95, left=0.05)
-
-    # Draw line with differences
-    axs[2].step(time_axis0, differences0, where='post', color='green', alpha=0.8)
-    axs[2].step(time_axis1, differences1, where='post', color='blue', alpha=0.8)
-
-    # Draw imbalances
-    for i in imbalances0:
-        axs[2].plot(i[0][0], i[0][1], 'rx')
-    lc = mc.LineCollection(imbalances0,
-                           colors=np.tile((1, 0, 0, 1), (len(imbalances0), 1)),
-                           linewidths=2)
-    axs[2].add_collection(lc)
-    for i in imbalances1:
-        axs[2].plot(i[0][0], i[0][1], 'rx')
-    lc = mc.LineCollection(imbalances1,
-                           colors=np.tile((1, 0, 0, 1), (len(imbalances1), 1)),
-                           linewidths=2)
-    axs[2].add_collection(lc)
-
-    # Draw line with sums
-    axs[3].step(time_axis0, sums0, where='post', color='green', alpha=0.8,
-                label="Base")
-    axs[3].step(time_axis1, sums1, where='post', color='blue', alpha=0.8,
-                label="Target")
-
-    axs[0].set_ylabel("CPUs")
-    axs[1].set_ylabel("CPUs")
-    axs[2].set_ylabel("Max difference")
-    axs[3].set_ylabel("Sum of tasks")
-    axs[3].set_xlabel("Timestamp (seconds)")
-
-    axs[2].set_ylim(ymin=0)
-    axs[2].set_xlim(min(time_axis0[0], time_axis1[0]), max(time_axis0[-1], time_axis1[-1]))
-    axs[2].grid()
-    axs[3].set_ylim(ymin=0)
-    axs[3].set_xlim(min(time_axis0[0], time_axis1[0]), max(time_axis0[-1], time_axis1[-1]))
-    axs[3].grid()
-
-    axs[3].legend(loc="lower right", ncol=2)
-
-    # Separate CPUs with lines by NUMA nodes
+
+from nr_running import read_topology, read_trace, PhaseTimer, aggregate_steps, AGGREGATES, NS_PER_SEC, TASK_LEVELS
+from nr_running import CPU_GROUPS, cpu_groups, group_cpus, node_starts, ImbalanceDetector
+
+# Width of heat maps in pixels of saved image
+BINS = 1700
+# Colors of lines of traces, the first two are the base and the target
+LINE_COLORS = ['green', 'blue', 'tab:orange', 'tab:purple', 'tab:brown', 'tab:pink', 'tab:olive', 'tab:cyan',
+               'tab:gray', 'black']
+MAX_CPU_TICKS = 64  # more CPUs are labeled by multiples of a step
+
+def cell_centers(time_axis, map_values):
+    """Return x coordinates of heat map cells, columns of time bins are centered between bin edges."""
+    if len(time_axis) > map_values.shape[1]:
+        return (np.array(time_axis[:-1]) + time_axis[1:]) / 2
+    return time_axis
+
+
+def heatmap_height(count):
+    """Return approximate height in pixels of each of count heat maps of saved image of draw_report."""
+    return int((5 + 5 * count) * 100 * 0.9 * 4 / (4 * count + 3))
+
+
+def set_cpu_ticks(ax, cpus, numa_cpus, color):
+    """Label rows of CPUs of heat map by NUMA nodes separated by lines, which can have different sizes."""
+    import matplotlib.pyplot as plt
+    from matplotlib.ticker import MultipleLocator
+
+    plt.sca(ax)
+    step = -(-cpus // MAX_CPU_TICKS)
     if numa_cpus:
-        plt.sca(axs[0])
-        axs[0].grid(True, which='major', axis='y', linestyle='--', color='w')
-        axs[0].yaxis.set_minor_locator(MultipleLocator(1))
-        plt.yticks(range(0, map_values0.shape[0] - 1, len(numa_cpus[0])),
-                   map(lambda x: "Node " + str(x), range(len(numa_cpus.keys()))))
-
-        plt.sca(axs[1])
-        axs[1].grid(True, which='major', axis='y', linestyle='--', color='w')
-        axs[1].yaxis.set_minor_locator(MultipleLocator(1))
-        plt.yticks(range(0, map_values1.shape[0] - 1, len(numa_cpus[0])),
-                   map(lambda x: "Node " + str(x), range(len(numa_cpus.keys()))))
+        ax.grid(True, which='major', axis='y', linestyle='--', color=color)
+        ax.yaxis.set_minor_locator(MultipleLocator(step))
+        plt.yticks(node_starts(numa_cpus), ["Node " + str(node) for node in numa_cpus])
     else:
-        plt.sca(axs[0])
-        axs[0].set_yticks(range(map_values0.shape[0] - 1))
-        plt.sca(axs[1])
-        axs[1].set_yticks(range(map_values1.shape[0] - 1))
+        ax.set_yticks(range(0, cpus, step))
+
 
-    plt.sca(axs[0])
-    plt.title(title)
+def draw_report(title, reports, labels, image_file=None, numa_cpus={}, timer=None):
+    """Draw heat map of each report (time_axis, map_values, differences, imbalances, sums) with common line graphs."""
+    timer = timer or PhaseTimer()
 
+    # Matplotlib is imported only when it's used, workers only parse traces
+    import matplotlib
     if image_file:
-        plt.savefig(image_file)
+        matplotlib.use('agg')  # No window is needed for image files
+    import matplotlib.pyplot as plt
+    from matplotlib.colors import ListedColormap, BoundaryNorm
+    from matplotlib import collections as mc
+
+    x_limits = (min(report[0][0] for report in reports), max(report[0][-1] for report in reports))
+
+    with timer.phase("heat map"):
+        cmap = ListedColormap(['#000000', '#305090', '#40b080', '#f0e020', '#f04010'])
+        boundaries = [-0.5, 0.5, 1.5, 2.5, 3.5, 4.5]
+        norm = BoundaryNorm(boundaries, cmap.N, clip=True)
+
+        fig, axs = plt.subplots(nrows=len(reports) + 2, ncols=1,
+                                gridspec_kw=dict(height_ratios=[4] * len(reports) + [1, 2]),
+                                figsize=(20, 5 + 5 * len(reports)), sharex=True)
+        fig.subplots_adjust(hspace=0.1)
+
+        heatmaps = []
+        for ax, report in zip(axs, reports):
+            time_axis, map_values = report[0], report[1]
+
+            # Transpose heat map data to right axes
+            map_values = np.array(map_values)[:-1, :].transpose()
+
+            # Group CPU lines by NUMA nodes
+            if numa_cpus:
+                new_order = []
+                for k, v in numa_cpus.items():
+                    new_order += v
+                map_values = map_values[new_order]
+
+            # Add blank row to correctly plot all rows with data
+            map_values = np.vstack((map_values, np.zeros(map_values.shape[1])))
+
+            mesh = ax.pcolormesh(cell_centers(time_axis, map_values), range(len(map_values)), map_values,
+                                 cmap=cmap, norm=norm, rasterized=True)
+            ax.set_xlim(*x_limits)
+            ax.set_ylim([0, map_values.shape[0] - 1])
+            heatmaps.append(map_values)
+
+        # Create colorbar
+        cbar = fig.colorbar(mesh, cax=plt.axes([0.95, 0.05, 0.02, 0.9]),
+                            extend='max', ticks=range(5))
+        cbar.ax.set_yticklabels(['0', '1', '2', '3', '4+'])
+        cbar.ax.set_ylabel("Number of tasks on CPU core")
+        plt.subplots_adjust(bottom=0.05, right=0.9, top=0.95, left=0.05)
+
+    difference_ax, sum_ax = axs[-2], axs[-1]
+    with timer.phase("lines"):
+        colors = [LINE_COLORS[index % len(LINE_COLORS)] for index in range(len(reports))]
+
+        # Draw lines with differences
+        for report, color in zip(reports, colors):
+            difference_ax.step(report[0], report[2], where='post', color=color, alpha=0.8, rasterized=True)
+
+        # Draw imbalances over all lines
+        for report in reports:
+            imbalances = report[3]
+            if imbalances:
+                difference_ax.plot([i[0][0] for i in imbalances], [i[0][1] for i in imbalances], 'rx')
+            lc = mc.LineCollection(imbalances,
+                                   colors=np.tile((1, 0, 0, 1), (len(imbalances), 1)),
+                                   linewidths=2, rasterized=True)
+            difference_ax.add_collection(lc)
+
+        # Draw lines with sums
+        for report, color, label in zip(reports, colors, labels):
+            sum_ax.step(report[0], report[4], where='post', color=color, alpha=0.8,
+                        label=label, rasterized=True)
+
+    with timer.phase("axes"):
+        for ax, label in zip(axs, labels):
+            ax.set_ylabel(label + "\nCPUs" if len(reports) > 2 else "CPUs")
+        difference_ax.set_ylabel("Max difference")
+        sum_ax.set_ylabel("Sum of tasks")
+        sum_ax.set_xlabel("Timestamp (seconds)")
+
+        difference_ax.set_ylim(ymin=0)
+        difference_ax.set_xlim(*x_limits)
+        difference_ax.grid()
+        sum_ax.set_ylim(ymin=0)
+        sum_ax.set_xlim(*x_limits)
+        sum_ax.grid()
+
+        sum_ax.legend(loc="lower right", ncol=min(len(reports), 5))
+
+        # Separate CPUs with lines by NUMA nodes
+        for ax, map_values in zip(axs, heatmaps):
+            set_cpu_ticks(ax, map_values.shape[0] - 1, numa_cpus, 'w')
+
+        plt.sca(axs[0])
+        plt.title(title)
+
+    if image_file:
+        with timer.phase("save"):
+            plt.savefig(image_file)
     else:
         plt.show()
 
 
-def read_nodes(lscpu_file):
-    numa_cpus = {}
-    NUMA_re=re.compile(r'NUMA.*CPU\(s\):')
-    for line in lscpu_file:
-        # Find number of CPUs and NUMA nodes:
-        if line[:7] == 'CPU(s):':
-            cpu_nb = int(line[7:])
-        elif line[:13] == 'NUMA node(s):':
-            nodes_nb = int(line[13:])
-
-        # Find NUMA nodes associated with CPUs:
-        elif NUMA_re.search(line):
-            words = line.split()
-            cpus = words[-1].split(',')
-            for cpu in cpus:
-                if '-' in cpu:
-                    w = cpu.split('-')
-                    for i in range(int(w[0]), int(w[1]) + 1):
-                        numa_cpus.setdefault(int(words[1][4:]), []).append(i)
-                else:
-                    numa_cpus.setdefault(int(words[1][4:]), []).append(int(cpu))
-
-    return numa_cpus
-
-
-def process_report(title, input_file, sampling, threshold, duration, image_file=None, numa_cpus={}):
-    time_axis = []
-    map_values = []
-    differences = []
-    imbalances = []
-    sums = []
-    counter = 0
-
-    reg_exp = re.compile(r"^cpus=(\d+)$")
-    line = input_file.readline()
-    line_count = 1
-    match = reg_exp.findall(line)
-    if match:
-        cpus_count = int(match[0])
+def draw_difference(title, time_axis, difference, node_deltas, image_file=None, numa_cpus={}, timer=None):
+    """Draw heat map of signed difference of tasks on CPUs and lines of difference of tasks on nodes."""
+    timer = timer or PhaseTimer()
+
+    import matplotlib
+    if image_file:
+        matplotlib.use('agg')  # No window is needed for image files
+    import matplotlib.pyplot as plt
+    from matplotlib.colors import BoundaryNorm
+
+    with timer.phase("heat map"):
+        difference = difference.transpose()
+        if numa_cpus:
+            new_order = [cpu for cpus in numa_cpus.values() for cpu in cpus if cpu < len(difference)]
+            difference = difference[new_order]
+
+        levels = len(TASK_LEVELS) - 1
+        cmap = plt.get_cmap('RdBu_r', 2 * levels + 1).copy()
+        cmap.set_bad('#a0a0a0')  # from the last partial bin of the shorter trace
+        norm = BoundaryNorm(np.arange(-levels - 0.5, levels + 1), cmap.N, clip=True)
+
+        fig, axs = plt.subplots(nrows=2, ncols=1, gridspec_kw=dict(height_ratios=[4, 2]),
+                                figsize=(20, 10), sharex=True)
+        fig.subplots_adjust(hspace=0.1)
+        mesh = axs[0].pcolormesh(time_axis, range(len(difference) + 1), np.ma.masked_invalid(difference),
+                                 cmap=cmap, norm=norm, rasterized=True)
+        axs[0].set_xlim(time_axis[0], time_axis[-1])
+
+        cbar = fig.colorbar(mesh, cax=plt.axes([0.95, 0.05, 0.02, 0.9]),
+                            extend='both', ticks=range(-levels, levels + 1))
+        cbar.ax.set_yticklabels(["{:+d}".format(level) + ("+" if abs(level) == levels else "")
+                                 for level in range(-levels, levels + 1)])
+        cbar.ax.set_ylabel("Difference of tasks on CPU core (target - base)")
+        plt.subplots_adjust(bottom=0.05, right=0.9, top=0.95, left=0.05)
+
+    with timer.phase("lines"):
+        for index, (label, deltas) in enumerate(node_deltas):
+            axs[1].step(time_axis, np.append(deltas, deltas[-1]), where='post',
+                        color=LINE_COLORS[index % len(LINE_COLORS)], alpha=0.8, label=label, rasterized=True)
+        axs[1].axhline(0, color='black', linewidth=0.5)
+
+    with timer.phase("axes"):
+        axs[0].set_ylabel("CPUs")
+        axs[1].set_ylabel("Difference of tasks")
+        axs[1].set_xlabel("Time from start of trace (seconds)")
+        axs[1].grid()
+        axs[1].legend(loc="lower right", ncol=min(len(node_deltas), 8))
+
+        set_cpu_ticks(axs[0], len(difference), numa_cpus, 'k')
+        plt.title(title)
+
+    if image_file:
+        with timer.phase("save"):
+            plt.savefig(image_file)
     else:
-        print("ERROR: Couldn't get number of CPUs from the trace file.")
-        print("       Unexpected trace file format. First line is expected to have form '{}'".format(reg_exp.pattern))
-        print("       Input line: '{}'".format(line.rstrip('\n')))
-        print("       Exiting")
-        sys.exit(1)
+        plt.show()
 
-    last_row = np.zeros(cpus_count)
-    map_values.append(last_row)
-
-    last_imbalance_start = 0
-    point_time = 0
-    start_time = -1
-
-    reg_exp = re.compile(r"^.*-(\d+).*\s(\d+[.]\d+): sched_update_nr_running: cpu=(\d+) change=([-]?\d+) nr_running=(\d+)")
-    for line in input_file:
-        line_count += 1
-        match = reg_exp.findall(line)
-
-        # Check the correct event
-        if not match:
-            if "sched_update_nr_running:" in line:
-                print("WARNING: Line number {} contains 'sched_update_nr_running:' string, but does not match findall regex '{}'!".format(line_count,reg_exp.pattern))
-                print(line, end='')
-            continue
-
-        pid = int(match[0][0])
-        point_time = float(match[0][1])
-        cpu = int(match[0][2])
-        change = int(match[0][3])
-        nr_running = int(match[0][4])
-
-        if start_time < 0:
-            start_time += point_time
-        point_time -= start_time
-
-        row = np.copy(last_row)
-        row[cpu] = nr_running
-        row_min = min(row)
-        row_max = max(row)
-        diff = row_max - row_min
-
-        # Check the start of imbalance
-        if diff >= threshold and last_imbalance_start == 0:
-            last_imbalance_start = point_time
-        if diff < threshold and last_imbalance_start != 0:
-            # Print and store long imbalances
-            if (point_time - last_imbalance_start) >= duration:
-                imbalances.append([(last_imbalance_start, threshold),
-                                    (point_time, threshold)])
-                print(f"Imbalance from timestamp {last_imbalance_start}"
-                f" lasting {point_time - last_imbalance_start} seconds")
-            last_imbalance_start = 0
-
-        # Store plotting data with optional sampling
-        counter += 1
-        if counter >= sampling:
-            counter = 0
-            map_values.append(row)
-            differences.append(diff)
-            sums.append(sum(row))
-            time_axis.append(point_time)
-        last_row = row
-
-    # Check for unreported imbalance lasting to the very end of input
-    if last_imbalance_start != 0 \
-       and (point_time - last_imbalance_start) >= duration:
-        imbalances.append([(last_imbalance_start, threshold),
-                            (point_time, threshold)])
-        print(f"Imbalance from timestamp {last_imbalance_start}"
-        f" lasting {point_time - last_imbalance_start} seconds")
 
+def process_report(title, events, sampling, threshold, duration, image_file=None, numa_cpus={},
+                   bins=BINS, aggregate="max"):
+    detector = ImbalanceDetector(threshold, duration)
+
+    # Time axis starts at one second
+    times = events.seconds()
+    if len(times):
+        times -= times[0] - 1
+
+    initial = np.zeros(events.cpus_count, dtype=events.nr_running.dtype)
+    all_differences, all_sums = events.balance(initial)
+    all_differences = all_differences[1:]
+    all_sums = all_sums[1:]
+    detector.update(times.tolist(), all_differences.tolist())
+
+    if sampling:
+        # Store plotting data of every sampling-th event
+        sampled = np.arange(sampling - 1, len(events), sampling)
+        map_values = np.vstack((initial, events.state_rows(sampled, initial)))
+        differences = all_differences[sampled].tolist()
+        sums = all_sums[sampled].tolist()
+        time_axis = times[sampled].tolist()
+    else:
+        # Aggregate data to time bins, the last row is only closing the last bin
+        edges = events.time_bins(bins)
+        map_values = events.binned_rows(edges, initial, aggregate)
+        map_values = np.vstack((map_values, np.zeros_like(map_values[-1:])))
+        steps = np.concatenate(([0], all_differences))
+        differences = aggregate_steps(events.time, steps, edges, aggregate)
+        differences = np.append(differences, differences[-1]).tolist()
+        steps = np.concatenate(([0], all_sums))
+        sums = aggregate_steps(events.time, steps, edges, aggregate)
+        sums = np.append(sums, sums[-1]).tolist()
+        time_axis = (edges / NS_PER_SEC - (events.seconds(0) - 1)).tolist()
+
+    detector.finish()
+    imbalances = detector.imbalances
     if not imbalances:
         print("No imbalance found")
 
-    #draw_report(title, time_axis, map_values, differences, imbalances, sums, image_file, numa_cpus)
     return time_axis, map_values, differences, imbalances, sums
 
 
+def read_worker_trace(file_name, use_cache, rebuild_cache, timer, progress):
+    """Return EventLog of trace file name or stdin given by '-'."""
+    with timer.phase("read"):
+        if file_name == "-":
+            return read_trace(sys.stdin, None, use_cache, rebuild_cache, timer=timer, progress=progress)
+        with open(file_name, 'r') as input_file:
+            return read_trace(input_file, None, use_cache, rebuild_cache, timer=timer, progress=progress)
+
+
+def reduce_trace(file_name, sampling, threshold, duration, bins, aggregate, use_cache=True, rebuild_cache=False,
+                 progress=False):
+    """
+    Read trace file in worker process and reduce it to resolution of its heat
+    map, so only small arrays are sent back. Return (report or None if the
+    trace has no events, printed output, profile of the worker).
+    """
+    timer = PhaseTimer()
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        events = read_worker_trace(file_name, use_cache, rebuild_cache, timer, progress)
+        if not len(events):
+            print("No sched_update_nr_running found. Exiting.")
+            return None, output.getvalue(), timer.profile()
+        with timer.phase("aggregate"):
+            time_axis, map_values, differences, imbalances, sums = \
+                process_report(None, events, sampling, threshold, duration, bins=bins, aggregate=aggregate)
+    # Colors of heat map don't distinguish values above the last level
+    map_values = np.minimum(map_values, len(TASK_LEVELS) - 1).astype(np.float32)
+    report = (np.array(time_axis), map_values, np.array(differences), imbalances, np.array(sums))
+    timer.set("matrix", list(map_values.shape))
+    timer.set("imbalances", len(imbalances))
+    return report, output.getvalue(), timer.profile()
+
+
+def align_trace(file_name, bins, aggregate, use_cache=True, rebuild_cache=False, progress=False):
+    """
+    Read trace file in worker process and aggregate it to at most bins time
+    bins starting at its first event. The width of bins is a power of two
+    nanoseconds, so bins of traces of different length can be merged exactly.
+    Return ((width, rows, nanoseconds from the first to the last event),
+    printed output, profile of the worker).
+    """
+    timer = PhaseTimer()
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        events = read_worker_trace(file_name, use_cache, rebuild_cache, timer, progress)
+        if not len(events):
+            print("ERROR: No events in trace '{}'".format(file_name))
+            return None, output.getvalue(), timer.profile()
+        with timer.phase("aggregate"):
+            first, last = int(events.time[0]), int(events.time[-1])
+            span = max(last - first, 1)
+            width = 1 << max(0, math.ceil(math.log2(span / bins)))
+            edges = first + np.arange(-(-span // width) + 1, dtype=np.int64) * width
+            initial = np.zeros(events.cpus_count, dtype=events.nr_running.dtype)
+            rows = events.binned_rows(edges, initial, aggregate).astype(np.float32)
+    timer.set("matrix", list(rows.shape))
+    return (width, rows, last - first), output.getvalue(), timer.profile()
+
+
+def merge_bins(aligned, aggregate):
+    """
+    Merge bins of traces aligned by align_trace to the widest bins. Return
+    width of bins and list of rows. Bins of shorter traces, which end before
+    the end of the bin, and rows after their end are NaN.
+    """
+    width = max(w for w, _, _ in aligned)
+    longest = max(span for _, _, span in aligned)
+    merged = []
+    for w, rows, span in aligned:
+        factor = width // w
+        count = -(-len(rows) // factor)
+        rows = np.vstack((rows, np.full((count * factor - len(rows), rows.shape[1]), np.nan, dtype=rows.dtype)))
+        rows = rows.reshape(count, factor, rows.shape[1])
+        if aggregate == "max":
+            rows = rows.max(axis=1)
+        elif aggregate == "mean":
+            rows = rows.mean(axis=1)
+        else:
+            rows = rows[:, -1]
+        if span < longest:
+            # Partial bin would compare the end of the trace with full bin of longer trace
+            rows[span // width:] = np.nan
+        merged.append(rows)
+
+    length = max(len(rows) for rows in merged)
+    padded = []
+    for rows in merged:
+        padded.append(np.vstack((rows, np.full((length - len(rows), rows.shape[1]), np.nan, dtype=rows.dtype))))
+    return width, padded
+
+
+def difference_report(names, bins, aggregate, numa_cpus={}, use_cache=True, rebuild_cache=False, jobs=None,
+                      progress=False):
+    """
+    Read base and target traces in parallel and return time axis, signed
+    difference of their CPUs on common time bins, list of (label, delta)
+    of sums of tasks on NUMA nodes and profiles of reading of the traces.
+    """
+    parameters = (bins, aggregate, use_cache, rebuild_cache, progress)
+    if "-" in names:
+        results = [align_trace(name, *parameters) for name in names]
+    else:
+        with ProcessPoolExecutor(max_workers=min(jobs or os.cpu_count() or 1, len(names))) as pool:
+            results = list(pool.map(align_trace, names, *[[p] * len(names) for p in parameters]))
+    for _, output, _ in results:
+        print(output, end="")
+    if any(aligned is None for aligned, _, _ in results):
+        sys.exit(1)
+
+    width, (base, target) = merge_bins([aligned for aligned, _, _ in results], aggregate)
+    if base.shape[1] != target.shape[1]:
+        print("WARNING: Traces have {} and {} CPUs, only the first {} are compared"
+              .format(base.shape[1], target.shape[1], min(base.shape[1], target.shape[1])))
+    cpus = min(base.shape[1], target.shape[1])
+    difference = target[:, :cpus] - base[:, :cpus]
+
+    if numa_cpus:
+        nodes = [("Node " + str(node), [cpu for cpu in node_cpus if cpu < cpus])
+                 for node, node_cpus in numa_cpus.items()]
+    else:
+        nodes = [("All CPUs", list(range(cpus)))]
+    node_deltas = [(label, difference[:, node_cpus].sum(axis=1)) for label, node_cpus in nodes if node_cpus]
+
+    time_axis = np.arange(len(difference) + 1) * (width / NS_PER_SEC)
+    return time_axis, difference, node_deltas, [profile for _, _, profile in results]
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Create heatmap and find"
         " imbalances from recorded sched_update_nr_running events with trace-cmd.")
-    parser.add_argument("input_file0", nargs="?", type=argparse.FileType('r'), default=sys.stdin)
-    parser.add_argument("input_file1", nargs="?", type=argparse.FileType('r'), default=sys.stdin)
-    parser.add_argument("--sampling", default=1, type=int,
-                        help="Sampling of plotted data to reduce drawing point_time")
+    parser.add_argument("input_files", nargs="*", default=["-"],
+                        help="Trace files to compare, the first one is the base, - reads stdin")
+    parser.add_argument("--sampling", default=None, type=int,
+                        help="Plot every SAMPLING-th event instead of aggregating events to time bins")
+    parser.add_argument("--bins", default=BINS, type=int,
+                        help="Number of time bins of heat maps")
+    parser.add_argument("--aggregate", default="max", choices=AGGREGATES,
+                        help="Value of CPU in time bin: maximum, time-weighted mean or last value")
     parser.add_argument("--threshold", default=2, type=int,
                         help="Minimal difference of process count considered as imbalance")
     parser.add_argument("--duration", default=0.05, type=float,
@@ -281,9 +421,30 @@ if __name__ == '__main__':
     parser.add_argument("--image-file", type=str, default=None,
                         help="Save plotted heatmap to file instead of showing")
     parser.add_argument("--lscpu-file", type=argparse.FileType('r'), default=None,
-                        help="File with output of lscpu from observed machine")
+                        help="File with output of lscpu from observed machine, optionally followed by"
+                        " output of lscpu -p for --group-cpus core and llc")
+    parser.add_argument("--group-cpus", default="auto", choices=CPU_GROUPS,
+                        help="Draw a row of heat maps for each CPU, core, last level cache or NUMA node with"
+                        " mean number of tasks on its CPUs. auto groups CPUs only when there are more of them"
+                        " than pixels of heat map.")
     parser.add_argument("--name", type=str, default=None,
                         help="Filename to be displayed in graph. Usefull when reading input from stdin.")
+    parser.add_argument("--render-times", action="store_true", default=False,
+                        help="Print time spent in phases of reading and drawing to stderr")
+    parser.add_argument("--profile", type=str, default=None,
+                        help="Write wall and CPU time of phases, numbers of lines and events, events per second,"
+                        " peak memory and size of heat maps to this file as JSON")
+    parser.add_argument("--progress", action="store_true", default=False,
+                        help="Periodically print read size of trace reports with remaining time to stderr")
+    parser.add_argument("--no-cache", dest="use_cache", action="store_false", default=True,
+                        help="Don't read or write the parsed events cache file next to the trace file")
+    parser.add_argument("--rebuild-cache", action="store_true", default=False,
+                        help="Parse the trace file even if the cache file is up to date and rewrite the cache")
+    parser.add_argument("--difference", action="store_true", default=False,
+                        help="Plot difference of tasks on CPUs and NUMA nodes of two traces (target - base) "
+                             "on common time bins aligned to their start")
+    parser.add_argument("--jobs", default=None, type=int,
+                        help="Number of worker processes reading the traces, defaults to number of CPUs")
 
     try:
         args = parser.parse_args()
@@ -291,38 +452,74 @@ if __name__ == '__main__':
         sys.exit(1)
 
     numa_cpus = {}
+    topology = {}
     if args.lscpu_file:
-        numa_cpus = read_nodes(args.lscpu_file)
+        numa_cpus, topology = read_topology(args.lscpu_file)
 
+    names = [name if name != "-" else "stdin" for name in args.input_files]
     if args.name:
         title = "Plot of '" + args.name
     else:
-        title = "Plot of '" + args.input_file0.name \
-            + " and " + args.input_file1.name
-
-    if args.input_file0.name.endswith(".xz"):
-        args.input_file0.close()
-        import lzma
-        with lzma.open(args.input_file0.name, 'rt') as decompressed:
-            time_axis0, map_values0, differences0, imbalances0, sums0 = \
-            process_report(title, decompressed, args.sampling, args.threshold,
-                           args.duration, args.image_file, numa_cpus)
+        title = "Plot of '" + " and ".join((", ".join(names[:-1]), names[-1])) if len(names) > 1 \
+            else "Plot of '" + names[0]
+    if len(names) == 2:
+        labels = ["Base", "Target"]
     else:
-        time_axis0, map_values0, differences0, imbalances0, sums0 = \
-        process_report(title, args.input_file0, args.sampling, args.threshold,
-                       args.duration, args.image_file, numa_cpus)
-
-    if args.input_file1.name.endswith(".xz"):
-        args.input_file1.close()
-        import lzma
-        with lzma.open(args.input_file1.name, 'rt') as decompressed:
-            time_axis1, map_values1, differences1, imbalances1, sums1 = \
-            process_report(title, decompressed, args.sampling, args.threshold,
-                           args.duration, args.image_file, numa_cpus)
-    else:
-        time_axis1, map_values1, differences1, imbalances1, sums1 = \
-        process_report(title, args.input_file1, args.sampling, args.threshold,
-                       args.duration, args.image_file, numa_cpus)
-
-    draw_report(title, time_axis0, map_values0, differences0, imbalances0, sums0,
-                time_axis1, map_values1, differences1, imbalances1, sums1, args.image_file, numa_cpus)
+        labels = [os.path.basename(name) for name in names]
+
+    timer = PhaseTimer()
+    if args.difference:
+        if len(names) != 2 or args.sampling:
+            print("ERROR: --difference needs exactly two trace files and can't be used with --sampling")
+            sys.exit(1)
+        with timer.phase("read"):
+            time_axis, difference, node_deltas, profiles = difference_report(
+                args.input_files, args.bins, args.aggregate, numa_cpus, args.use_cache,
+                args.rebuild_cache, args.jobs, args.progress)
+        timer.set("matrix", list(difference.shape))
+        groups = cpu_groups(numa_cpus, topology, args.group_cpus, heatmap_height(1))
+        if groups:
+            difference, numa_cpus = group_cpus(difference, numa_cpus, groups, missing=None)
+        draw_difference(title, time_axis, difference, node_deltas, args.image_file, numa_cpus, timer)
+        if args.render_times:
+            timer.report()
+        if args.profile:
+            timer.count("events", sum(profile.get("events", 0) for profile in profiles))
+            timer.write_profile(args.profile, traces=profiles)
+        sys.exit(0)
+
+    parameters = (args.sampling, args.threshold, args.duration, args.bins, args.aggregate,
+                  args.use_cache, args.rebuild_cache, args.progress)
+    jobs = min(args.jobs or os.cpu_count() or 1, len(names))
+    with timer.phase("read"):
+        if "-" in args.input_files:
+            # Standard input can't be read by worker processes
+            results = [reduce_trace(name, *parameters) for name in args.input_files]
+        else:
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                futures = [pool.submit(reduce_trace, name, *parameters) for name in args.input_files]
+                results = [future.result() for future in futures]
+
+    reports = []
+    profiles = []
+    for name, (report, output, profile) in zip(names, results):
+        if len(names) > 2:
+            print("Trace '{}':".format(name))
+        print(output, end="")
+        reports.append(report)
+        profiles.append(profile)
+    if any(report is None for report in reports):
+        sys.exit(0)
+
+    groups = cpu_groups(numa_cpus, topology, args.group_cpus, heatmap_height(len(reports)))
+    if groups:
+        grouped = [group_cpus(report[1], numa_cpus, groups) for report in reports]
+        reports = [report[:1] + (map_values,) + report[2:] for report, (map_values, _) in zip(reports, grouped)]
+        numa_cpus = grouped[0][1]
+
+    draw_report(title, reports, labels, args.image_file, numa_cpus, timer)
+    if args.render_times:
+        timer.report()
+    if args.profile:
+        timer.count("events", sum(profile.get("events", 0) for profile in profiles))
+        timer.write_profile(args.profile, traces=profiles)
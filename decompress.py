@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+
+"""
+Decompression of input files in background threads, so it runs in
+parallel with parsing of the decompressed data.
+Copyright (C) 2020  Jiri Vozar
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from bisect import bisect_right
+import bz2
+from concurrent.futures import ThreadPoolExecutor
+import io
+import lzma
+import os
+import queue
+import struct
+import sys
+import threading
+import zlib
+
+READ_SIZE = 1 << 20
+QUEUE_SIZE = 4
+
+FORMATS = [
+    (b"\xfd7zXZ\x00", "xz"),
+    (b"\x1f\x8b", "gzip"),
+    (b"BZh", "bzip2"),
+    (b"\x28\xb5\x2f\xfd", "zstd"),
+    (b"\x04\x22\x4d\x18", "lz4"),
+]
+
+
+def detect_format(head):
+    """Return name of compression format by magic bytes at start of data or None."""
+    for magic, name in FORMATS:
+        if head.startswith(magic):
+            return name
+    return None
+
+
+def new_decompressor(compression):
+    """Return streaming decompressor object of given format."""
+    if compression == "xz":
+        return lzma.LZMADecompressor()
+    if compression == "gzip":
+        return zlib.decompressobj(wbits=31)
+    if compression == "bzip2":
+        return bz2.BZ2Decompressor()
+    try:
+        if compression == "zstd":
+            try:
+                from compression.zstd import ZstdDecompressor
+                return ZstdDecompressor()
+            except ImportError:
+                import zstandard
+                return zstandard.ZstdDecompressor().decompressobj()
+        if compression == "lz4":
+            import lz4.frame
+            return lz4.frame.LZ4FrameDecompressor()
+    except ImportError:
+        print("ERROR: Reading of {} compressed input requires module '{}'."
+              .format(compression, "zstandard" if compression == "zstd" else "lz4"))
+        print("       Exiting")
+        sys.exit(1)
+    raise ValueError("Unknown compression format " + compression)
+
+
+def decompress_blocks(decompressor, data):
+    """
+    Yield decompressed blocks of data. Blocks are limited to READ_SIZE when
+    the decompressor supports it, so well compressed input doesn't make
+    large blocks.
+    """
+    if hasattr(decompressor, 'needs_input'):
+        block = decompressor.decompress(data, max_length=READ_SIZE)
+        while True:
+            if block:
+                yield block
+            if decompressor.eof or decompressor.needs_input:
+                return
+            block = decompressor.decompress(b'', max_length=READ_SIZE)
+    elif hasattr(decompressor, 'unconsumed_tail'):
+        while True:
+            block = decompressor.decompress(data, READ_SIZE)
+            if block:
+                yield block
+            data = decompressor.unconsumed_tail
+            if decompressor.eof or (not data and len(block) < READ_SIZE):
+                return
+    else:
+        yield decompressor.decompress(data)
+
+
+def decompress_stream(raw, compression):
+    """Yield decompressed blocks of binary stream raw with concatenated compressed streams."""
+    decompressor = new_decompressor(compression)
+    padding = False
+    while True:
+        data = raw.read(READ_SIZE)
+        if not data:
+            return
+        if padding:
+            # Stream padding continues from the previous read
+            data = data.lstrip(b'\0')
+            padding = not data
+        while data:
+            for block in decompress_blocks(decompressor, data):
+                if block:
+                    yield block
+            data = b''
+            if getattr(decompressor, 'eof', False):
+                data = decompressor.unused_data.lstrip(b'\0')  # skip xz stream padding
+                padding = not data
+                decompressor = new_decompressor(compression)
+
+
+def read_varint(data, pos):
+    """Read variable-length integer of xz format. Return (value, new position)."""
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, pos
+
+
+def encode_varint(value):
+    out = bytearray()
+    while value >= 0x80:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def xz_index(raw):
+    """
+    Return list of (offset, unpadded size, uncompressed size) of blocks of
+    single-stream xz file raw from its index, or None when it can't be read.
+    """
+    size = raw.seek(0, io.SEEK_END)
+    if size < 24:
+        return None
+    raw.seek(size - 12)
+    footer = raw.read(12)
+    if footer[10:] != b"YZ":
+        return None
+    index_size = (struct.unpack('<I', footer[4:8])[0] + 1) * 4
+    index_start = size - 12 - index_size
+    if index_start < 12:
+        return None
+    raw.seek(index_start)
+    index = raw.read(index_size)
+    if index[0] != 0:
+        return None
+
+    count, pos = read_varint(index, 1)
+    blocks = []
+    offset = 12
+    for _ in range(count):
+        unpadded, pos = read_varint(index, pos)
+        uncompressed, pos = read_varint(index, pos)
+        blocks.append((offset, unpadded, uncompressed))
+        offset += (unpadded + 3) & ~3
+    # Concatenated streams or stream padding have more indexes
+    if offset != index_start:
+        return None
+    return blocks
+
+
+def xz_blocks(raw):
+    """Return blocks of xz file raw like xz_index, or None when it can't be decoded by blocks."""
+    blocks = xz_index(raw)
+    if not blocks or len(blocks) < 2:
+        return None
+    return blocks
+
+
+def parallel_workers(blocks, max_memory=None):
+    """
+    Return number of threads decoding blocks of xz file at once. Decoded
+    blocks wait in the pool, in the queue and in the reader, so with
+    max_memory bytes for them the number is lower on machines with many CPUs.
+    """
+    workers = os.cpu_count() or 1
+    if max_memory is not None:
+        largest = max(block[2] for block in blocks)
+        workers = min(workers, max_memory // largest - QUEUE_SIZE - 2)
+    return max(workers, 0)
+
+
+def decoded_memory(file_name, max_memory=None):
+    """Return peak memory of decoded xz blocks of file_name waiting for reader, 0 when it's streamed."""
+    with open(file_name, 'rb') as raw:
+        if detect_format(raw.read(8)) != "xz":
+            return 0
+        blocks = xz_blocks(raw)
+    workers = parallel_workers(blocks, max_memory) if blocks else 0
+    if not workers:
+        return 0
+    return (workers + QUEUE_SIZE + 2) * max(block[2] for block in blocks)
+
+
+def uncompressed_size(file_name):
+    """
+    Return size of decompressed content of file_name when it's stored in the
+    file (xz index or gzip trailer), size of uncompressed file or None.
+    """
+    with open(file_name, 'rb') as raw:
+        compression = detect_format(raw.read(8))
+        if not compression:
+            return os.path.getsize(file_name)
+        if compression == "xz":
+            blocks = xz_index(raw)
+            return sum(block[2] for block in blocks) if blocks else None
+        if compression == "gzip":
+            # Only modulo 2^32 and of the last member, too small values are ignored
+            size = raw.seek(-4, io.SEEK_END) + 4
+            value = struct.unpack('<I', raw.read(4))[0]
+            return value if value >= size else None
+    return None
+
+
+def decompress_xz_block(file_name, header, block):
+    """Decompress one block of xz file by wrapping it into a stream of its own."""
+    offset, unpadded, uncompressed = block
+    with open(file_name, 'rb') as f:
+        f.seek(offset)
+        data = f.read((unpadded + 3) & ~3)
+
+    index = b"\0" + encode_varint(1) + encode_varint(unpadded) + encode_varint(uncompressed)
+    index += bytes(-len(index) % 4)
+    index += struct.pack('<I', zlib.crc32(index))
+    footer = struct.pack('<I', len(index) // 4 - 1) + header[6:8]
+    footer = struct.pack('<I', zlib.crc32(footer)) + footer + b"YZ"
+    return lzma.decompress(header + data + index + footer, format=lzma.FORMAT_XZ)
+
+
+def decompress_xz_parallel(file_name, header, blocks, workers):
+    """Yield decompressed blocks of xz file in order, decoding several blocks at once."""
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = []
+        for block in blocks:
+            pending.append(executor.submit(decompress_xz_block, file_name, header, block))
+            if len(pending) > workers:
+                yield pending.pop(0).result()
+        for future in pending:
+            yield future.result()
+
+
+class ThreadedReader(io.RawIOBase):
+    """
+    Raw binary stream returning blocks produced by iterator in background
+    thread. At most QUEUE_SIZE blocks wait in memory for the reader.
+    """
+
+    def __init__(self, blocks, name):
+        super().__init__()
+        self.name = name
+        self.queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self.stop = threading.Event()
+        self.rest = memoryview(b'')
+        self.offset = 0
+        self.position = 0
+        self.done = False
+        self.thread = threading.Thread(target=self.produce, args=(blocks,), daemon=True)
+        self.thread.start()
+
+    def produce(self, blocks):
+        try:
+            for block in blocks:
+                if not self.put(block):
+                    return
+            self.put(None)
+        except BaseException as e:
+            self.put(e)
+
+    def put(self, item):
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self.offset == len(self.rest) and not self.done:
+            item = self.queue.get()
+            if item is None:
+                self.done = True
+            elif isinstance(item, BaseException):
+                self.done = True
+                raise item
+            else:
+                self.rest = memoryview(item)
+                self.offset = 0
+        size = min(len(buffer), len(self.rest) - self.offset)
+        buffer[:size] = self.rest[self.offset:self.offset + size]
+        self.offset += size
+        self.position += size
+        return size
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        self.stop.set()
+        super().close()
+
+
+def open_compressed(raw, compression, name, max_memory=None):
+    """
+    Return buffered binary stream with decompressed content of binary stream
+    raw. Blocks of xz files are decompressed in parallel when possible and
+    when blocks decoded by at least one thread fit into max_memory bytes.
+    Threads reopen the file by name, so other streams like stdin are
+    decompressed in one thread.
+    """
+    workers = 0
+    if compression == "xz" and raw.seekable() and os.path.isfile(name):
+        blocks = xz_blocks(raw)
+        raw.seek(0)
+        workers = parallel_workers(blocks, max_memory) if blocks else 0
+    if workers:
+        header = raw.read(12)
+        raw.close()
+        source = decompress_xz_parallel(name, header, blocks, workers)
+    else:
+        source = decompress_stream(raw, compression)
+    return io.BufferedReader(ThreadedReader(source, name), READ_SIZE)
+
+
+def open_compressed_at(file_name, compression, offset, max_memory=None):
+    """
+    Return buffered binary stream with decompressed content of file_name
+    from byte offset. Decompression of xz files with more blocks starts at
+    the block containing offset, unless a block doesn't fit into max_memory
+    bytes. Other files are decompressed from the start.
+    """
+    raw = open(file_name, 'rb')
+    start = 0
+    blocks = xz_blocks(raw) if compression == "xz" else None
+    workers = parallel_workers(blocks, max_memory) if blocks else 0
+    if workers:
+        raw.seek(0)
+        header = raw.read(12)
+        raw.close()
+        starts = [0]
+        for block in blocks[:-1]:
+            starts.append(starts[-1] + block[2])
+        first = bisect_right(starts, offset) - 1
+        start = starts[first]
+        source = decompress_xz_parallel(file_name, header, blocks[first:], workers)
+    else:
+        raw.seek(0)
+        source = decompress_stream(raw, compression)
+
+    stream = io.BufferedReader(ThreadedReader(source, file_name), READ_SIZE)
+    while start < offset:
+        data = stream.read(min(READ_SIZE, offset - start))
+        if not data:
+            break
+        start += len(data)
+    return stream
+
+
+def peek_format(raw):
+    """Return compression format of buffered binary stream raw without consuming data."""
+    return detect_format(raw.peek(8)[:8])
+
+
+def open_text(input_file):
+    """
+    Return text stream of input_file opened by argparse, which is
+    decompressed in background when it's compressed.
+    """
+    raw = input_file.buffer
+    compression = peek_format(raw)
+    if not compression:
+        return input_file
+    return io.TextIOWrapper(open_compressed(raw, compression, input_file.name))
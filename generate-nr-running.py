@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Generate synthetic trace reports with sched_update_nr_running events in
+the format of trace-cmd report, e.g. for benchmarks of other scripts.
+Copyright (C) 2020  Jiri Vozar
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import gzip
+import lzma
+import sys
+
+import numpy as np
+
+from nr_running import NS_PER_SEC
+from tracedat import write_trace_dat
+
+CHUNK_EVENTS = 1 << 18
+START_SECONDS = 3000  # timestamps start at uptime like in real traces
+TASKS = [("lu.C.x", 6708), ("bt.C.x", 6712), ("kworker/u96:2", 412), ("migration/3", 29), ("<idle>", 0)]
+EVENT_FORMAT = "%16s-%-5d [%03d] %5d.%06d: sched_update_nr_running: cpu=%d change=%d nr_running=%d\n"
+SWITCH_FORMAT = "%16s-%-5d [%03d] %5d.%06d: sched_switch:         %s:%d [120] R ==> %s:%d [120]\n"
+REMOTE_EVENTS = 0.1  # fraction of events recorded on other CPU, like wakeups
+
+
+def parse_imbalance(text):
+    """Parse START:DURATION:NODE:TASKS imbalance of argument."""
+    try:
+        start, duration, node, tasks = text.split(":")
+        imbalance = (float(start), float(duration), int(node), int(tasks))
+    except ValueError:
+        raise argparse.ArgumentTypeError("imbalance has to be START:DURATION:NODE:TASKS, not '{}'".format(text))
+    if imbalance[3] < 1:
+        raise argparse.ArgumentTypeError("imbalance has to add at least one task")
+    return imbalance
+
+
+def numa_layout(cpus_count, nodes, threads=1):
+    """
+    Return dictionary mapping NUMA node to list of its CPUs. Threads of one
+    core are numbered cpus_count / threads apart like on x86 machines.
+    """
+    cores = cpus_count // threads
+    layout = {}
+    for node in range(nodes):
+        node_cores = range(node * cores // nodes, (node + 1) * cores // nodes)
+        layout[node] = [core + thread * cores for thread in range(threads) for core in node_cores]
+    return layout
+
+
+def cpu_list(cpus):
+    """Return list of CPUs in format of lscpu, e.g. 0-11,24-35."""
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(str(a) if a == b else "{}-{}".format(a, b) for a, b in ranges)
+
+
+def write_lscpu(out, cpus_count, layout, threads=1, llc_cores=8):
+    """
+    Write lscpu output describing the NUMA layout followed by output of
+    lscpu -p with cores and last level caches shared by llc_cores cores.
+    """
+    out.write("Architecture:        x86_64\n")
+    out.write("CPU(s):              {}\n".format(cpus_count))
+    out.write("On-line CPU(s) list: 0-{}\n".format(cpus_count - 1))
+    out.write("Thread(s) per core:  {}\n".format(threads))
+    out.write("Core(s) per socket:  {}\n".format(cpus_count // threads // len(layout)))
+    out.write("Socket(s):           {}\n".format(len(layout)))
+    out.write("NUMA node(s):        {}\n".format(len(layout)))
+    out.write("Model name:          Synthetic CPU\n")
+    for node, cpus in layout.items():
+        out.write("{:<21}{}\n".format("NUMA node{} CPU(s):".format(node), cpu_list(cpus)))
+
+    cores = cpus_count // threads
+    out.write("# CPU,Core,Socket,Node,,L1d,L1i,L2,L3\n")
+    rows = []
+    llc_base = 0
+    for node, cpus in layout.items():
+        node_cores = sorted(set(cpu % cores for cpu in cpus))
+        for cpu in cpus:
+            core = cpu % cores
+            llc = llc_base + node_cores.index(core) // llc_cores
+            rows.append((cpu, core, node, node, core, core, core, llc))
+        llc_base += -(-len(node_cores) // llc_cores)
+    for row in sorted(rows):
+        out.write("{},{},{},{},,{},{},{},{}\n".format(*row))
+
+
+def fold(walk, max_tasks):
+    """Fold random walk into number of tasks from 0 to max_tasks, steps stay +-1."""
+    return max_tasks - np.abs(walk % (2 * max_tasks) - max_tasks)
+
+
+def cumulative_by_cpu(cpu, values, carry):
+    """Return running sums of values of each CPU continuing from carry, which is updated."""
+    order = np.argsort(cpu, kind='stable')
+    sums = np.cumsum(values[order])
+    bounds = np.searchsorted(cpu[order], np.arange(len(carry) + 1))
+    counts = np.diff(bounds)
+    before = np.concatenate(([0], sums))[bounds[:-1]]
+    sums += np.repeat(carry - before, counts)
+    result = np.empty_like(sums)
+    result[order] = sums
+    seen = counts > 0
+    carry[seen] = sums[bounds[1:][seen] - 1]
+    return result
+
+
+def generate_events(cpus_count, events, duration, layout, imbalances=(), max_tasks=2, seed=0,
+                    chunk_size=CHUNK_EVENTS):
+    """
+    Yield parts of columns (time in microseconds, cpu, change, nr_running)
+    of events. Tasks on each CPU change by one in random walk between 0 and
+    max_tasks, imbalances (start, duration, node, tasks) add tasks on all
+    CPUs of node one by one. The count of events includes the imbalances.
+    """
+    rng = np.random.default_rng(seed)
+    start_us = START_SECONDS * 10**6
+
+    injected = []
+    for start, length, node, tasks in imbalances:
+        begin = start_us + int(start * 10**6)
+        end = begin + max(int(length * 10**6), tasks)
+        for cpu in layout[node]:
+            for task in range(tasks):
+                injected += [(begin + task, cpu, 1), (end - task, cpu, -1)]
+    injected = np.array(sorted(injected), dtype=np.int64).reshape(-1, 3)
+    base_events = max(events - len(injected), 0)
+
+    walk = rng.integers(0, 2 * max_tasks, cpus_count).astype(np.int64)
+    offset = np.zeros(cpus_count, dtype=np.int64)
+    now = start_us
+    step = duration * 10**6 / max(base_events, 1)
+    generated = 0
+    used = 0
+    while generated < base_events or used < len(injected):
+        count = min(chunk_size, base_events - generated)
+        times = now + np.cumsum(rng.poisson(step, count))
+        if count:
+            now = int(times[-1])
+        generated += count
+        last = len(injected) if generated == base_events else np.searchsorted(injected[:, 0], now, 'right')
+        extra = injected[used:last]
+        used = last
+
+        # Injected changes of offset are merged by time, random walk stays
+        time = np.concatenate((times, extra[:, 0]))
+        cpu = np.concatenate((rng.integers(0, cpus_count, count), extra[:, 1]))
+        walk_steps = np.concatenate((rng.integers(0, 2, count) * 2 - 1, np.zeros(len(extra), dtype=np.int64)))
+        offset_steps = np.concatenate((np.zeros(count, dtype=np.int64), extra[:, 2]))
+        order = np.argsort(time, kind='stable')
+        time, cpu, walk_steps, offset_steps = time[order], cpu[order], walk_steps[order], offset_steps[order]
+
+        walk_after = cumulative_by_cpu(cpu, walk_steps, walk)
+        offset_after = cumulative_by_cpu(cpu, offset_steps, offset)
+        nr_running = fold(walk_after, max_tasks) + offset_after
+        change = nr_running - fold(walk_after - walk_steps, max_tasks) - (offset_after - offset_steps)
+        yield time, cpu, change, nr_running
+
+
+def format_events(rng, cpus_count, time, cpu, change, nr_running, other_events=1.0):
+    """Return lines of trace report with events and other random sched_switch events."""
+    count = len(time)
+    record_cpu = np.where(rng.random(count) < REMOTE_EVENTS, rng.integers(0, cpus_count, count), cpu)
+    tasks = rng.integers(0, len(TASKS), count)
+    others = rng.poisson(other_events, count)
+    seconds, micros = np.divmod(time, 10**6)
+
+    lines = []
+    for values in zip(tasks.tolist(), record_cpu.tolist(), seconds.tolist(), micros.tolist(),
+                      cpu.tolist(), change.tolist(), nr_running.tolist(), others.tolist()):
+        task, record, second, micro, event_cpu, event_change, running, other = values
+        comm, pid = TASKS[task]
+        lines.append(EVENT_FORMAT % (comm, pid, record, second, micro, event_cpu, event_change, running))
+        for _ in range(other):
+            lines.append(SWITCH_FORMAT % (comm, pid, record, second, micro, comm, pid, "trace-cmd", 6663))
+    return lines
+
+
+def open_output(file_name):
+    """Open text output file, compressed by xz or gzip by its extension."""
+    if file_name is None:
+        return sys.stdout
+    if file_name.endswith(".xz"):
+        return lzma.open(file_name, 'wt', preset=1)
+    if file_name.endswith(".gz"):
+        return gzip.open(file_name, 'wt', compresslevel=6)
+    return open(file_name, 'w')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic trace report with sched_update_nr_running "
+                                     "events in format of trace-cmd report.")
+    parser.add_argument("--cpus", default=48, type=int,
+                        help="Number of CPUs")
+    parser.add_argument("--events", default=100000, type=lambda text: int(float(text)),
+                        help="Number of sched_update_nr_running events, e.g. 1e7")
+    parser.add_argument("--duration", default=None, type=float,
+                        help="Duration of trace in seconds, defaults to 1000 events per second on each CPU")
+    parser.add_argument("--nodes", default=2, type=int,
+                        help="Number of NUMA nodes")
+    parser.add_argument("--threads", default=2, type=int,
+                        help="Number of threads of each core")
+    parser.add_argument("--llc-cores", default=8, type=int,
+                        help="Number of cores sharing last level cache in lscpu file")
+    parser.add_argument("--max-tasks", default=2, type=int,
+                        help="Maximal number of tasks on CPU outside imbalances")
+    parser.add_argument("--imbalance", dest="imbalances", action="append", default=[], type=parse_imbalance,
+                        help="Add TASKS tasks on each CPU of NUMA node NODE from START seconds after "
+                             "the start of trace for DURATION seconds, format START:DURATION:NODE:TASKS. "
+                             "Can be used multiple times.")
+    parser.add_argument("--other-events", default=1.0, type=float,
+                        help="Mean number of other events (sched_switch) after each event")
+    parser.add_argument("--seed", default=0, type=int,
+                        help="Seed of random generator")
+    parser.add_argument("--output", type=str, default=None,
+                        help="Output file, compressed when ending with .xz or .gz, written as "
+                             "trace.dat when ending with .dat, defaults to stdout")
+    parser.add_argument("--lscpu-file", type=argparse.FileType('w'), default=None,
+                        help="Write lscpu output with the NUMA layout to this file")
+
+    try:
+        args = parser.parse_args()
+    except SystemExit:
+        sys.exit(1)
+
+    if args.cpus < 1 or args.cpus % (args.nodes * args.threads):
+        print("ERROR: Number of CPUs has to be a multiple of number of nodes and threads")
+        sys.exit(1)
+    for _, _, node, _ in args.imbalances:
+        if not 0 <= node < args.nodes:
+            print("ERROR: Imbalance on node {}, which doesn't exist".format(node))
+            sys.exit(1)
+
+    layout = numa_layout(args.cpus, args.nodes, args.threads)
+    if args.lscpu_file:
+        write_lscpu(args.lscpu_file, args.cpus, layout, args.threads, args.llc_cores)
+        args.lscpu_file.close()
+
+    duration = args.duration or args.events / args.cpus / 1000
+    parts = generate_events(args.cpus, args.events, duration, layout, args.imbalances, args.max_tasks, args.seed)
+
+    if args.output and args.output.endswith(".dat"):
+        columns = [np.concatenate(column) for column in zip(*parts)]
+        columns[0] *= NS_PER_SEC // 10**6
+        write_trace_dat(args.output, args.cpus, *columns)
+        return
+
+    rng = np.random.default_rng(args.seed + 1)
+    with open_output(args.output) as out:
+        out.write("cpus={}\n".format(args.cpus))
+        for part in parts:
+            out.write("".join(format_events(rng, args.cpus, *part, other_events=args.other_events)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1879 @@
+# -*- coding: utf-8 -*-
+
+"""
+Shared parsing and state tracking of kernel trace reports
+with sched_update_nr_running events.
+Copyright (C) 2020  Jiri Vozar
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import json
+import mmap
+import os
+import resource
+import sys
+import re
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import numpy as np
+
+from decompress import decoded_memory, open_compressed, open_compressed_at, peek_format, uncompressed_size
+
+CPUS_RE = re.compile(r"^cpus=(\d+)$")
+EVENT_RE = re.compile(r"^.*-(\d+).*\s(\d+[.]\d+): sched_update_nr_running: cpu=(\d+) change=([-]?\d+) nr_running=(\d+)")
+EVENT_TAG = b"sched_update_nr_running:"
+NS_PER_SEC = 10**9
+CHUNK_SIZE = 1 << 24
+
+# Bump when parsing changes, so old cache files are not used
+PARSER_VERSION = 4
+CACHE_SUFFIX = ".nrcache.npz"
+INDEX_SUFFIX = ".nrindex.npz"
+AGGREGATES = ("max", "mean", "last")
+TASK_LEVELS = ["0", "1", "2", "3", "4+"]  # levels of heat map colors
+PERCENTILES = (50, 95, 99)
+FOLLOW_POLL = 0.5  # seconds between checks of growing followed file
+MAX_WINDOW_EVENTS = 1 << 22
+COLUMN_TYPES = (np.int64, np.uint16, np.int16, np.int16)  # time, cpu, change, nr_running
+# Estimates for --max-memory: memory not depending on trace length and memory per processed event
+BASE_MEMORY = 200 << 20
+EVENT_MEMORY = 400
+DECOMPRESS_MEMORY = 96 << 20  # part of BASE_MEMORY for decoded blocks of xz files
+MIN_CHUNK_SIZE = 1 << 16
+# Estimates of memory for processing of trace report in memory per its byte
+REPORT_MEMORY = 1.0
+COMPRESSION_RATIO = 10  # used when size of decompressed content isn't known
+SIZE_UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+PROGRESS_INTERVAL = 5.0  # seconds between progress reports
+PROFILE_SUFFIX = ".profile.json"
+CPU_GROUPS = ("auto", "cpu", "core", "llc", "node")  # rows of heat map
+STATE_BLOCK = 1 << 15  # events aggregated at once by StateAggregator
+LOD_MEMORY = 64 << 20  # bytes of the finest level of heat map for interactive zoom
+
+
+class PhaseTimer:
+    """Wall and CPU time of named phases of processing with counts of processed data."""
+
+    def __init__(self):
+        self.phases = []
+        self.values = {}
+        self.start = time.perf_counter()
+        self.start_cpu = time.process_time()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        start_cpu = time.process_time()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - start, time.process_time() - start_cpu))
+
+    def count(self, name, value):
+        """Add value to counter like number of lines or events."""
+        self.values[name] = self.values.get(name, 0) + int(value)
+
+    def set(self, name, value):
+        self.values[name] = value
+
+    def report(self, out=sys.stderr):
+        print("Times: " + ", ".join("{} {:.3f} s".format(name, seconds) for name, seconds, _ in self.phases),
+              file=out)
+
+    def profile(self):
+        """
+        Return dictionary with wall and CPU time of all phases, counters,
+        events per second and peak memory of the process and its children.
+        """
+        phases = {}
+        for name, wall, cpu in self.phases:
+            phase = phases.setdefault(name, {"wall": 0.0, "cpu": 0.0})
+            phase["wall"] += wall
+            phase["cpu"] += cpu
+        wall = time.perf_counter() - self.start
+        profile = {"wall": wall, "cpu": time.process_time() - self.start_cpu, "phases": phases}
+        profile.update(self.values)
+        if self.values.get("events") and wall > 0:
+            profile["events_per_second"] = self.values["events"] / wall
+        # Sizes are in kilobytes on Linux
+        profile["max_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        if children.ru_maxrss:
+            profile["children_max_rss"] = children.ru_maxrss * 1024
+            profile["children_cpu"] = children.ru_utime + children.ru_stime
+        return profile
+
+    def write_profile(self, file_name, **values):
+        """Write profile with additional values to JSON file."""
+        profile = {"script": os.path.basename(sys.argv[0])}
+        profile.update(values)
+        profile.update(self.profile())
+        with open(file_name, 'w') as f:
+            json.dump(profile, f, indent=1)
+
+
+class Progress:
+    """
+    Periodic report of bytes of trace report read so far with estimated
+    remaining time to stderr. Total size is size of decompressed report.
+    """
+
+    def __init__(self, total=None, label="", interval=PROGRESS_INTERVAL, out=sys.stderr):
+        self.total = total
+        self.label = label
+        self.interval = interval
+        self.out = out
+        self.done = 0
+        self.start = self.last = time.perf_counter()
+
+    def chunks(self, chunks):
+        """Yield chunks of binary data and report their total size."""
+        for chunk in chunks:
+            self.done += len(chunk)
+            now = time.perf_counter()
+            if now - self.last >= self.interval:
+                self.last = now
+                self.report(now - self.start)
+            yield chunk
+
+    def report(self, elapsed):
+        text = "{}Read {:.0f} MB".format(self.label, self.done / (1 << 20))
+        if self.total:
+            fraction = min(self.done / self.total, 1.0)
+            text += " of {:.0f} MB ({:.0f} %)".format(self.total / (1 << 20), 100 * fraction)
+            if fraction:
+                text += ", {:.0f} s remaining".format(elapsed * (1 - fraction) / fraction)
+        print(text, file=self.out, flush=True)
+
+
+def read_nodes(lscpu_file):
+    """Return dictionary mapping NUMA node number to list of its CPUs."""
+    return read_topology(lscpu_file)[0]
+
+
+def read_topology(lscpu_file):
+    """
+    Return dictionary mapping NUMA node number to list of its CPUs and
+    dictionary mapping "core" and "llc" to lists of CPUs sharing a core or
+    last level cache. Cores and caches are read from output of lscpu -p,
+    which can follow output of lscpu in the same file. NUMA nodes are read
+    from the Node column of lscpu -p when lscpu output is missing.
+    """
+    numa_cpus = {}
+    columns = None
+    ids = {}  # column of lscpu -p -> {id: CPUs}
+    NUMA_re = re.compile(r'NUMA.*CPU\(s\):')
+    for line in lscpu_file:
+        # Skip number of NUMA nodes, it's computed from the CPU lists
+        if line[:13] == 'NUMA node(s):':
+            continue
+
+        # Header of lscpu -p output, e.g. # CPU,Core,Socket,Node,,L1d,L1i,L2,L3
+        elif line.startswith('# CPU,'):
+            columns = line[2:].strip().split(',')
+        elif columns and line[:1].isdigit():
+            values = line.strip().split(',')
+            for name, value in zip(columns[1:], values[1:]):
+                if name and value:
+                    ids.setdefault(name, {}).setdefault(int(value), []).append(int(values[0]))
+
+        # Find NUMA nodes associated with CPUs:
+        elif NUMA_re.search(line):
+            words = line.split()
+            cpus = words[-1].split(',')
+            for cpu in cpus:
+                if '-' in cpu:
+                    w = cpu.split('-')
+                    for i in range(int(w[0]), int(w[1]) + 1):
+                        numa_cpus.setdefault(int(words[1][4:]), []).append(i)
+                else:
+                    numa_cpus.setdefault(int(words[1][4:]), []).append(int(cpu))
+
+    if not numa_cpus and "Node" in ids:
+        numa_cpus = {node: ids["Node"][node] for node in sorted(ids["Node"])}
+    topology = {}
+    if "Core" in ids:
+        topology["core"] = list(ids["Core"].values())
+    caches = [name for name in ids if re.match(r'L\d', name)]
+    if caches:
+        topology["llc"] = list(ids[max(caches, key=lambda name: (int(name[1]), name))].values())
+    return numa_cpus, topology
+
+
+def cpu_groups(numa_cpus, topology, grouping, rows=None):
+    """
+    Return list of groups of CPUs drawn as one row of heat map for grouping
+    "core", "llc" or "node", or None for a row of each CPU. Grouping "auto"
+    keeps CPUs when there are at most rows of them, otherwise it picks the
+    finest grouping with at most rows groups.
+    """
+    if not numa_cpus or grouping == "cpu":
+        return None
+    available = dict(topology, node=list(numa_cpus.values()))
+    if grouping == "auto":
+        if rows is None or sum(len(cpus) for cpus in numa_cpus.values()) <= rows:
+            return None
+        for name in ("core", "llc"):
+            if name in available and len(available[name]) <= rows:
+                return available[name]
+        return available["node"]
+    if grouping not in available:
+        print("WARNING: Grouping of CPUs by {} requires output of lscpu -p in lscpu file, "
+              "CPUs are not grouped".format(grouping))
+        return None
+    return available[grouping]
+
+
+def group_cpus(map_values, numa_cpus, groups, missing=-1):
+    """
+    Return heat map with columns of groups of CPUs instead of CPUs and NUMA
+    nodes mapped to lists of columns of their groups. Values of groups are
+    means of their CPUs without missing value (NaN when missing is None),
+    groups without any are missing. Groups are ordered by NUMA nodes of
+    their first CPUs.
+    """
+    map_values = np.asarray(map_values)
+    position = {cpu: i for i, cpu in enumerate(cpu for cpus in numa_cpus.values() for cpu in cpus
+                                               if cpu < map_values.shape[1])}
+    node_of = {cpu: node for node, cpus in numa_cpus.items() for cpu in cpus}
+    columns = []
+    for group in groups:
+        cpus = sorted((cpu for cpu in group if cpu in position), key=position.get)
+        if cpus:
+            columns.append(cpus)
+    # CPUs outside of groups stay on their own
+    grouped = set(cpu for cpus in columns for cpu in cpus)
+    columns += [[cpu] for cpu in position if cpu not in grouped]
+    groups = sorted(columns, key=lambda cpus: position[cpus[0]])
+
+    order = [cpu for group in groups for cpu in group]
+    starts = np.cumsum([0] + [len(group) for group in groups])[:-1]
+    values = map_values[:, order]
+    valid = ~np.isnan(values) if missing is None else values != missing
+    sums = np.add.reduceat(np.where(valid, values, 0), starts, axis=1)
+    counts = np.add.reduceat(valid, starts, axis=1)
+    grouped_values = np.where(counts > 0, sums / np.maximum(counts, 1), np.nan if missing is None else missing)
+
+    grouped_nodes = {}
+    for column, group in enumerate(groups):
+        grouped_nodes.setdefault(node_of[group[0]], []).append(column)
+    return grouped_values, grouped_nodes
+
+
+def node_starts(numa_cpus):
+    """Return first row of each NUMA node in heat map with CPUs ordered by nodes."""
+    return np.cumsum([0] + [len(cpus) for cpus in numa_cpus.values()])[:-1].tolist()
+
+
+def parse_size(text):
+    """Return number of bytes of size like '512M' or '4G' for argparse."""
+    match = re.fullmatch(r"(\d+(?:[.]\d+)?)\s*([KMGT]?)i?B?", text.strip(), re.IGNORECASE)
+    if not match:
+        raise ValueError("invalid size " + text)
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()])
+
+
+def chunk_size_for(max_memory):
+    """Return number of events processed at once to stay within max_memory bytes."""
+    chunk_size = (max_memory - BASE_MEMORY) // EVENT_MEMORY
+    if chunk_size < MIN_CHUNK_SIZE:
+        print("WARNING: Memory limit {} MiB is too low, using the minimal chunk size of {} events"
+              .format(max_memory >> 20, MIN_CHUNK_SIZE), file=sys.stderr)
+    return max(chunk_size, MIN_CHUNK_SIZE)
+
+
+def estimate_memory(file_name):
+    """Return estimated peak memory in bytes used by processing of trace file_name in memory."""
+    size = os.path.getsize(file_name)
+    report_size = uncompressed_size(file_name)
+    if report_size == size:
+        # Uncompressed files are memory-mapped
+        return BASE_MEMORY + int(size * (REPORT_MEMORY + 1))
+    if report_size is None:
+        report_size = size * COMPRESSION_RATIO
+    return BASE_MEMORY + decoded_memory(file_name) + int(report_size * REPORT_MEMORY)
+
+
+def open_trace(input_file, mapped=True, max_memory=None):
+    """
+    Return binary stream with trace report. Compressed input is detected by
+    magic bytes and decompressed in background, using at most max_memory
+    bytes for decoded blocks. Regular uncompressed files are memory-mapped
+    if mapped is set.
+    """
+    raw = input_file.buffer
+    compression = peek_format(raw)
+    if compression:
+        return open_compressed(raw, compression, input_file.name, max_memory)
+    if not mapped:
+        return raw
+    if os.path.isfile(input_file.name) and os.path.getsize(input_file.name) > 0:
+        input_file.close()
+        with open(input_file.name, 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return raw
+
+
+def open_trace_at(file_name, offset, max_memory=None):
+    """
+    Return binary stream with trace report file_name from byte offset of its
+    decompressed content. Uncompressed files are memory-mapped.
+    """
+    with open(file_name, 'rb') as raw:
+        compression = peek_format(raw)
+        if not compression:
+            trace = mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ)
+            trace.seek(offset)
+            return trace
+    return open_compressed_at(file_name, compression, offset, max_memory)
+
+
+def decode_line(line):
+    """Decode bytes of trace report line with line ending translated like in text mode."""
+    text = line.decode(errors='replace')
+    return text[:-2] + '\n' if text.endswith('\r\n') else text
+
+
+def read_cpus_count(input_file):
+    """Read the first 'cpus=N' line of trace report and return N."""
+    line = decode_line(input_file.readline())
+    match = CPUS_RE.findall(line)
+    if not match:
+        print("ERROR: Couldn't get number of CPUs from the trace file.")
+        print("       Unexpected trace file format. First line is expected to have form '{}'".format(CPUS_RE.pattern))
+        print("       Input line: '{}'".format(line.rstrip('\n')))
+        print("       Exiting")
+        sys.exit(1)
+    return int(match[0])
+
+
+def read_chunks(input_file, chunk_size=CHUNK_SIZE, follow=False):
+    """
+    Yield blocks of binary input_file ending at line boundaries. With follow,
+    blocks are yielded as soon as some lines are available and growing
+    regular files are read until interrupted.
+    """
+    if isinstance(input_file, mmap.mmap):
+        start = input_file.tell()
+        while start < len(input_file):
+            end = input_file.rfind(b'\n', start, start + chunk_size) + 1
+            if end <= start:
+                end = input_file.find(b'\n', start + chunk_size) + 1 or len(input_file)
+            yield input_file[start:end]
+            start = end
+        return
+
+    rest = b''
+    while True:
+        block = input_file.read1(chunk_size) if follow else input_file.read(chunk_size)
+        if not block and follow and input_file.seekable():
+            time.sleep(FOLLOW_POLL)
+            continue
+        if not block:
+            if rest:
+                yield rest
+            return
+        block = rest + block
+        end = block.rfind(b'\n') + 1
+        rest = block[end:]
+        if end:
+            yield block[:end]
+
+
+# Helpers below go over bytes at the same offset of all positions at once
+# and stop when no number continues, so short numbers need few passes.
+
+def read_numbers(data, start, width):
+    """
+    Parse decimal numbers starting at positions start of byte array data.
+    Return values and count of digits of each number, which is at most width.
+    """
+    values = np.zeros(len(start), dtype=np.int64)
+    length = np.zeros(len(start), dtype=np.int64)
+    digits = np.ones(len(start), dtype=bool)
+    last = len(data) - 1
+    for i in range(width):
+        index = start + i
+        digit = data[np.minimum(index, last)] - np.uint8(ord('0'))
+        digits &= (digit < 10) & (index <= last)
+        if not digits.any():
+            break
+        values = np.where(digits, values * 10 + digit, values)
+        length += digits
+    return values, length
+
+
+def count_digits_before(data, end, width):
+    """Return count of digits directly preceding positions end of byte array data."""
+    length = np.zeros(len(end), dtype=np.int64)
+    digits = np.ones(len(end), dtype=bool)
+    for i in range(1, width + 1):
+        index = end - i
+        digit = data[np.maximum(index, 0)] - np.uint8(ord('0'))
+        digits &= (digit < 10) & (index >= 0)
+        if not digits.any():
+            break
+        length += digits
+    return length
+
+
+def matches_at(data, positions, text):
+    """Return mask of positions of byte array data followed by bytes text."""
+    matches = positions + len(text) <= len(data)
+    last = len(data) - 1
+    for i, byte in enumerate(text):
+        matches &= data[np.minimum(positions + i, last)] == byte
+    return matches
+
+
+def contains_pid(data, start, end):
+    """
+    Return mask of ranges between positions start and end of byte array data
+    containing '-' followed by a digit. Ranges are searched from their end,
+    where the PID before the CPU and timestamp is close.
+    """
+    found = np.zeros(len(start), dtype=bool)
+    rows = np.flatnonzero(start < end)
+    position = end[rows] - 1
+    while len(rows):
+        dash = (data[position] == ord('-')) & (data[position + 1] - np.uint8(ord('0')) < 10)
+        found[rows[dash]] = True
+        position -= 1
+        left = ~dash & (position >= start[rows])
+        rows, position = rows[left], position[left]
+    return found
+
+
+def parse_chunk(chunk):
+    """
+    Parse all sched_update_nr_running events of chunk at once. Lines are
+    prefiltered by search of the event name and the fixed fields after it
+    are converted in NumPy arrays, instead of matching regex on every line.
+    Return count of lines in chunk and tuple of arrays (line index, line
+    start, line end, valid, timestamp, cpu, change, nr_running) for each
+    line containing the event name.
+    """
+    data = np.frombuffer(chunk, dtype=np.uint8)
+    pieces = chunk.split(EVENT_TAG)
+    found = np.cumsum(np.fromiter(map(len, pieces), dtype=np.int64, count=len(pieces))[:-1] + len(EVENT_TAG)) - len(EVENT_TAG)
+    newlines = np.flatnonzero(data == ord('\n'))
+
+    line = np.searchsorted(newlines, found)
+    bounds = np.concatenate(([-1], newlines, [len(data) - 1]))
+    line_start = bounds[line] + 1
+    line_end = bounds[line + 1] + 1
+
+    # Fields after the event name: ' cpu=N change=[-]N nr_running=N'
+    pos = found + len(EVENT_TAG)
+    valid = matches_at(data, pos, b" cpu=")
+    pos += len(b" cpu=")
+    cpu, length = read_numbers(data, pos, 6)
+    valid &= length > 0
+    pos += length
+    valid &= matches_at(data, pos, b" change=")
+    pos += len(b" change=")
+    negative = data[np.minimum(pos, len(data) - 1)] == ord('-')
+    pos += negative
+    change, length = read_numbers(data, pos, 6)
+    valid &= length > 0
+    change = np.where(negative, -change, change)
+    pos += length
+    valid &= matches_at(data, pos, b" nr_running=")
+    pos += len(b" nr_running=")
+    nr_running, length = read_numbers(data, pos, 6)
+    valid &= length > 0
+
+    # Timestamp 'seconds.fraction: ' before the event name, preceded by whitespace
+    frac_end = found - 2
+    valid &= matches_at(data, np.maximum(frac_end, 0), b": ")
+    frac_length = count_digits_before(data, frac_end, 12)
+    valid &= frac_length > 0
+    dot = frac_end - frac_length - 1
+    valid &= data[np.maximum(dot, 0)] == ord('.')
+    sec_length = count_digits_before(data, dot, 12)
+    valid &= sec_length > 0
+    space = dot - sec_length - 1
+    valid &= np.isin(data[np.maximum(space, 0)], np.frombuffer(b" \t\f\v\r", dtype=np.uint8))
+    valid &= space >= line_start
+    sec, length = read_numbers(data, dot - sec_length, 12)
+    frac, length = read_numbers(data, dot + 1, 9)
+    timestamp = sec * NS_PER_SEC + frac * 10 ** (9 - length)
+
+    # PID as '-N' somewhere before the timestamp, searched only in lines of valid events
+    valid &= contains_pid(data, np.where(valid, line_start, space), space - 1)
+
+    # Keep one event name per line, the last matching one like the greedy regex does
+    order = np.lexsort((-found, ~valid, line))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = line[order][1:] != line[order][:-1]
+    keep = np.sort(order[first])
+    result = (line, line_start, line_end, valid, timestamp, cpu, change, nr_running)
+    return len(newlines), tuple(column[keep] for column in result)
+
+
+class EventLog:
+    """
+    sched_update_nr_running events stored as typed columns instead of
+    a copy of all CPU values per event. Rows of CPU values are rebuilt
+    only for the events which are actually needed.
+    """
+
+    def __init__(self, cpus_count, time, cpu, change, nr_running, chunk_size=None, initial=None):
+        self.cpus_count = cpus_count
+        self.time = time              # int64 timestamps in nanoseconds
+        self.cpu = cpu                # uint16
+        self.change = change          # int16
+        self.nr_running = nr_running  # int16
+        self.chunk_size = chunk_size  # events processed at once, None for all
+        self.initial = initial        # tasks on CPUs before the first event of a window of trace
+        self.lines = None             # ReportLines of trace report for TraceChecker
+
+    def __len__(self):
+        return len(self.time)
+
+    def columns(self):
+        return self.time, self.cpu, self.change, self.nr_running
+
+    def chunks(self):
+        """
+        Yield EventLogs with consecutive parts of at most chunk_size events.
+        Parts of columns stored in files are mapped to memory one by one.
+        """
+        if self.chunk_size is None:
+            yield self
+            return
+        for start in range(0, len(self), self.chunk_size):
+            yield EventLog(self.cpus_count, *(column_part(column, start, self.chunk_size)
+                                              for column in self.columns()))
+
+    def seconds(self, indices=slice(None)):
+        """Return timestamps of selected events as float seconds."""
+        return self.time[indices] / NS_PER_SEC
+
+    def initial_row(self, missing=-1):
+        """
+        Return number of tasks on each CPU before the first event, computed
+        from the first event of every CPU as nr_running - change, unless
+        the events are a window with known state before it.
+        CPUs without any event get the missing value.
+        """
+        if self.initial is not None:
+            return np.where(self.initial < 0, missing, self.initial).astype(self.nr_running.dtype)
+        row = np.full(self.cpus_count, missing, dtype=self.nr_running.dtype)
+        seen = np.zeros(self.cpus_count, dtype=bool)
+        for chunk in self.chunks():
+            cpus, first = np.unique(chunk.cpu, return_index=True)
+            new = ~seen[cpus]
+            row[cpus[new]] = chunk.nr_running[first[new]] - chunk.change[first[new]]
+            seen[cpus[new]] = True
+            if seen.all():
+                break
+        return row
+
+    def state_rows(self, indices, initial):
+        """
+        Return matrix with number of tasks on each CPU after each event
+        from sorted indices. Values before the first event of CPU are taken
+        from initial row.
+        """
+        # Positions of events are the time of the step function
+        aggregator = StateAggregator(np.asarray(indices, dtype=np.int64), "last",
+                                     initial.astype(self.nr_running.dtype))
+        start = 0
+        for chunk in self.chunks():
+            aggregator.update(np.arange(start, start + len(chunk)), chunk.cpu, chunk.nr_running)
+            start += len(chunk)
+        return aggregator.at_edges_rows()
+
+    def window(self, start=None, end=None):
+        """
+        Return EventLog of events between start and end nanoseconds, both
+        included, with state of CPUs before start as its initial row.
+        """
+        first = np.searchsorted(self.time, start, 'left') if start is not None else 0
+        last = np.searchsorted(self.time, end, 'right') if end is not None else len(self)
+        initial = self.initial_row()
+        if first:
+            initial = self.state_rows([first - 1], initial)[0]
+        return self.part(first, last, initial)
+
+    def part(self, first, last, initial=None):
+        """Return EventLog of events from index first to last, excluded."""
+        if last <= first:
+            columns = [np.zeros(0, dtype=dtype) for dtype in COLUMN_TYPES]
+        else:
+            columns = [column_part(column, first, last - first) for column in self.columns()]
+        return EventLog(self.cpus_count, *columns, chunk_size=self.chunk_size, initial=initial)
+
+    def time_bins(self, bins):
+        """Return nanosecond edges of equally wide time bins spanning all events."""
+        first, last = int(self.time[0]), int(self.time[-1])
+        bins = max(1, min(bins, last - first))
+        return np.linspace(first, max(last, first + 1), bins + 1).astype(np.int64)
+
+    def binned_rows(self, edges, initial, aggregate="max"):
+        """
+        Return matrix with number of tasks on each CPU aggregated over time
+        bins between edges. Values before the first event of CPU are taken
+        from initial row.
+        """
+        aggregator = StateAggregator(edges, aggregate, initial.astype(self.nr_running.dtype))
+        for chunk in self.chunks():
+            aggregator.update(chunk.time, chunk.cpu, chunk.nr_running)
+        return aggregator.result()
+
+    def balance_chunks(self, initial):
+        """
+        Yield parts of events with arrays of maximal difference and sum of
+        number of tasks on CPUs. Index 0 belongs to the row before the first
+        event of the part, index i + 1 to the row after its event i.
+        """
+        tracker = BalanceTracker(initial)
+        for chunk in self.chunks():
+            differences = [tracker.difference()]
+            sums = [tracker.total]
+            for cpu, nr_running in zip(chunk.cpu.tolist(), chunk.nr_running.tolist()):
+                tracker.update(cpu, nr_running)
+                differences.append(tracker.high - tracker.low)
+                sums.append(tracker.total)
+            yield chunk, np.array(differences), np.array(sums)
+
+    def balance(self, initial):
+        """
+        Return arrays with maximal difference and sum of number of tasks
+        on CPUs. Index 0 belongs to the initial row, index i + 1 to the row
+        after event i.
+        """
+        parts = [(differences, sums) for _, differences, sums in self.balance_chunks(initial)]
+        differences = np.concatenate([parts[0][0]] + [d[1:] for d, _ in parts[1:]])
+        sums = np.concatenate([parts[0][1]] + [s[1:] for _, s in parts[1:]])
+        return differences, sums
+
+    def replay(self, checker=None):
+        """
+        Pass stored events to TraceChecker and print warnings about invalid
+        lines of the trace report in their order to its output. Messages show original
+        lines of the report kept in ReportLines, other lines are rebuilt from
+        the event values, as trace.dat files have no report lines.
+        """
+        lines = self.lines.lines if self.lines else {}
+        warnings = self.lines.warnings if self.lines else []
+        if checker is None:
+            for _, line_number, text in warnings:
+                print_invalid_line(line_number, text)
+            return
+        index = 0
+        warning = 0
+        for chunk in self.chunks():
+            for timestamp, cpu, change, nr_running in zip(chunk.time.tolist(), chunk.cpu.tolist(),
+                                                          chunk.change.tolist(), chunk.nr_running.tolist()):
+                while warning < len(warnings) and warnings[warning][0] <= index:
+                    print_invalid_line(*warnings[warning][1:], checker.out)
+                    warning += 1
+                line = lines.get(index)
+                if line is None:
+                    line = "{}.{:06d}: sched_update_nr_running: cpu={} change={} nr_running={}\n".format(
+                        timestamp // NS_PER_SEC, timestamp % NS_PER_SEC // 1000, cpu, change, nr_running)
+                checker.update(line, timestamp / NS_PER_SEC, cpu, change, nr_running)
+                index += 1
+        for _, line_number, text in warnings[warning:]:
+            print_invalid_line(line_number, text, checker.out)
+
+
+def column_part(column, start, size):
+    """Return part of column, parts of memory-mapped files are mapped on their own."""
+    if not isinstance(column, np.memmap):
+        return column[start:start + size]
+    size = min(size, len(column) - start)
+    return np.memmap(column.filename, dtype=column.dtype, mode='r',
+                     offset=column.offset + start * column.itemsize, shape=(size,))
+
+
+class StepAggregator:
+    """
+    Aggregate step function over time bins between edges, while its steps
+    are passed in consecutive parts. The function has value initial before
+    the first step. See aggregate_steps for the meaning of aggregate.
+    """
+
+    def __init__(self, edges, aggregate, initial, dtype=None):
+        if aggregate not in AGGREGATES:
+            raise ValueError("Unknown aggregate " + aggregate)
+        self.edges = edges
+        self.aggregate = aggregate
+        dtype = dtype or np.asarray(initial).dtype
+        self.at_edges = np.full(len(edges), initial, dtype=dtype)
+        if aggregate == "max":
+            lowest = np.iinfo(dtype).min if np.issubdtype(dtype, np.integer) else -np.inf
+            self.maxima = np.full(len(edges) - 1, lowest, dtype=dtype)
+        # Integral of the function at edges and at the last step
+        self.integrals = np.zeros(len(edges), dtype=np.int64)
+        self.time = None
+        self.value = initial
+        self.integral = 0
+
+    def update(self, times, values):
+        """Add steps at times to values, times have to follow the previous steps."""
+        if not len(times):
+            return
+        edges = self.edges
+        values = np.asarray(values)
+
+        # Edges from the first step on get values of these steps, edges after
+        # them are overwritten by the next parts
+        start = np.searchsorted(edges, times[0], side='left')
+        self.at_edges[start:] = values[np.searchsorted(times, edges[start:], side='right') - 1]
+
+        if self.aggregate == "max":
+            bins = np.searchsorted(edges, times, side='right') - 1
+            inside = (bins >= 0) & (bins < len(self.maxima))
+            np.maximum.at(self.maxima, bins[inside], values[inside])
+        elif self.aggregate == "mean":
+            if self.time is None:
+                self.time = min(times[0], edges[0])
+            steps = np.concatenate(([self.time], times))
+            step_values = np.concatenate(([self.value], values)).astype(np.int64)
+            integral = self.integral + np.concatenate(([0], np.cumsum(step_values[:-1] * np.diff(steps))))
+            start = np.searchsorted(edges, steps[0], side='left')
+            last = np.searchsorted(steps, edges[start:], side='right') - 1
+            self.integrals[start:] = integral[last] + step_values[last] * (edges[start:] - steps[last])
+            self.integral = integral[-1]
+        self.time = times[-1]
+        self.value = values[-1]
+
+    def result(self):
+        if self.aggregate == "last":
+            return self.at_edges[1:]
+        if self.aggregate == "max":
+            return np.maximum(self.at_edges[:-1], self.maxima)
+        if self.time is None:
+            # No steps, the function is constant
+            self.integrals = np.int64(self.value) * (self.edges - self.edges[0])
+        return np.diff(self.integrals) / np.diff(self.edges)
+
+
+class StateAggregator:
+    """
+    Aggregate number of tasks on all CPUs over time bins between edges like
+    StepAggregator of each CPU, while events are passed in consecutive
+    parts. Work per event doesn't depend on the number of CPUs, the matrix
+    of bins and CPUs is filled only once by result.
+    """
+
+    def __init__(self, edges, aggregate, initial):
+        if aggregate not in AGGREGATES:
+            raise ValueError("Unknown aggregate " + aggregate)
+        self.edges = edges
+        self.aggregate = aggregate
+        self.initial = np.asarray(initial)
+        dtype = self.initial.dtype
+        # Row i of matrices belongs to events after i edges, the last row to
+        # events after all edges. Value of CPU at edge is set by its last
+        # event not after the edge, edges without such event are filled later.
+        shape = (len(edges) + 1, len(initial))
+        self.at_edges = np.zeros(shape, dtype=dtype)
+        self.changed = np.zeros(shape, dtype=bool)
+        if aggregate == "max":
+            lowest = np.iinfo(dtype).min if np.issubdtype(dtype, np.integer) else -np.inf
+            self.maxima = np.full(shape, lowest, dtype=dtype)
+        elif aggregate == "mean":
+            # Integral of bin is its width times value at its start plus changes of steps inside it
+            self.integrals = np.zeros(shape, dtype=np.int64)
+            self.value = self.initial.astype(np.int64)
+
+    def update(self, times, cpu, values):
+        """Add events of cpu changing its value at times, times have to follow the previous events."""
+        # Small blocks of events stay in processor caches
+        for start in range(0, len(times), STATE_BLOCK):
+            self.update_block(times[start:start + STATE_BLOCK], cpu[start:start + STATE_BLOCK],
+                              values[start:start + STATE_BLOCK])
+
+    def update_block(self, times, cpu, values):
+        edges = self.edges
+        # Events of each CPU stay in time order, so events of CPU between two
+        # edges are consecutive. Stable sort of small integers takes linear time.
+        order = np.argsort(cpu, kind='stable')
+        cpu = cpu[order]
+        values = np.asarray(values)[order]
+        new_cpu = np.concatenate(([True], cpu[1:] != cpu[:-1]))
+
+        # Number of edges before each event from positions of edges in times
+        slots = np.repeat(np.arange(len(edges) + 1),
+                          np.diff(np.searchsorted(times, edges, side='right'), prepend=0, append=len(times)))[order]
+        last = np.flatnonzero(np.append(new_cpu[1:], True) | np.append(slots[1:] != slots[:-1], True))
+        self.at_edges[slots[last], cpu[last]] = values[last]
+        self.changed[slots[last], cpu[last]] = True
+
+        if self.aggregate == "max":
+            # Events at an edge belong to the bin starting there
+            rows = np.repeat(np.arange(len(edges) + 1),
+                             np.diff(np.searchsorted(times, edges, side='left'), prepend=0,
+                                     append=len(times)))[order]
+            self.combine(self.maxima, rows, cpu, new_cpu, values, np.maximum)
+        elif self.aggregate == "mean":
+            times = times[order]
+            values = values.astype(np.int64)
+            before = np.concatenate(([0], values[:-1]))
+            before[new_cpu] = self.value[cpu[new_cpu]]
+            self.value[cpu[last]] = values[last]
+            changes = (values - before) * (edges[np.minimum(slots, len(edges) - 1)] - times)
+            self.combine(self.integrals, slots, cpu, new_cpu, changes, np.add)
+
+    @staticmethod
+    def combine(cells, rows, cpu, new_cpu, values, ufunc):
+        """Combine values of events into cells of their rows and CPUs by ufunc, events are sorted by CPU."""
+        starts = np.flatnonzero(new_cpu | np.concatenate(([True], rows[1:] != rows[:-1])))
+        rows, cpu = rows[starts], cpu[starts]
+        cells[rows, cpu] = ufunc(cells[rows, cpu], ufunc.reduceat(values, starts))
+
+    def at_edges_rows(self):
+        """Return matrix with value of each CPU at each edge."""
+        index = np.where(self.changed[:-1], np.arange(len(self.edges))[:, np.newaxis], -1)
+        np.maximum.accumulate(index, axis=0, out=index)
+        values = np.take_along_axis(self.at_edges, np.maximum(index, 0), axis=0)
+        return np.where(index >= 0, values, self.initial)
+
+    def result(self):
+        at_edges = self.at_edges_rows()
+        if self.aggregate == "last":
+            return at_edges[1:]
+        if self.aggregate == "max":
+            return np.maximum(at_edges[:-1], self.maxima[1:-1])
+        widths = np.diff(self.edges)[:, np.newaxis]
+        return (at_edges[:-1].astype(np.int64) * widths + self.integrals[1:-1]) / widths
+
+
+def aggregate_steps(times, values, edges, aggregate="max"):
+    """
+    Aggregate step function over time bins between edges. The function has
+    value values[0] before times[0] and values[i + 1] from times[i].
+    Aggregate is maximal value ("max"), time-weighted mean ("mean") or value
+    at the end of bin ("last").
+    """
+    values = np.asarray(values)
+    aggregator = StepAggregator(edges, aggregate, values[0], values.dtype)
+    aggregator.update(times, values[1:])
+    return aggregator.result()
+
+
+def combine_bins(edges, values, aggregate):
+    """Aggregate pairs of neighbouring time bins between edges to one bin, rows of values are bins."""
+    if aggregate == "max":
+        return np.maximum(values[0::2], values[1::2])
+    if aggregate == "last":
+        return values[1::2]
+    widths = np.diff(edges).reshape((-1,) + (1,) * (values.ndim - 1))
+    return ((values[0::2] * widths[0::2] + values[1::2] * widths[1::2])
+            / (widths[0::2] + widths[1::2])).astype(values.dtype)
+
+
+class LevelOfDetail:
+    """
+    Heat map rows, differences and sums aggregated over time bins of
+    power-of-two resolutions for interactive zoom. The finest level has as
+    many bins as fit in LOD_MEMORY, each coarser level joins pairs of bins
+    of the previous one up to bins of the whole trace. Views with narrower
+    bins are aggregated from events, starting from the state of CPUs at the
+    closest edge of the finest level. Parts of events are passed with arrays
+    of differences and sums from EventLog.balance_chunks.
+    """
+
+    def __init__(self, events, initial, aggregate, bins):
+        self.events = events
+        self.aggregate = aggregate
+        first, last = int(events.time[0]), int(events.time[-1])
+        bins = max(1, min(bins, last - first))
+        itemsize = np.dtype(np.float32).itemsize if aggregate == "mean" else events.nr_running.itemsize
+        levels = 0
+        finest = bins * 2
+        while (finest * events.cpus_count * itemsize <= LOD_MEMORY
+               and finest <= max(len(events), bins) and finest <= last - first):
+            levels += 1
+            finest *= 2
+        self.levels = levels
+        self.edges = np.linspace(first, max(last, first + 1), (bins << levels) + 1).astype(np.int64)
+
+        aggregator = StateAggregator(self.edges, aggregate, initial.astype(events.nr_running.dtype))
+        for chunk in events.chunks():
+            aggregator.update(chunk.time, chunk.cpu, chunk.nr_running)
+        self.at_edges = aggregator.at_edges_rows()
+        rows = aggregator.result()
+        self.rows = rows.astype(np.float32) if aggregate == "mean" else rows
+        self.differences = []
+        self.sums = []
+
+    def update(self, chunk, differences, sums):
+        if not self.differences:
+            self.differences.append(np.asarray(differences[:1], dtype=np.int32))
+            self.sums.append(np.asarray(sums[:1], dtype=np.int32))
+        self.differences.append(np.asarray(differences[1:], dtype=np.int32))
+        self.sums.append(np.asarray(sums[1:], dtype=np.int32))
+
+    def finish(self):
+        """Build coarser levels after all events were passed."""
+        # Index 0 belongs to the state before the first event, index i + 1 to the state after event i
+        self.differences = np.concatenate(self.differences)
+        self.sums = np.concatenate(self.sums)
+        level = (self.edges, self.rows, aggregate_steps(self.events.time, self.differences, self.edges, self.aggregate),
+                 aggregate_steps(self.events.time, self.sums, self.edges, self.aggregate))
+        self.pyramid = [level]
+        for _ in range(self.levels):
+            edges = level[0]
+            level = (edges[::2],) + tuple(combine_bins(edges, values, self.aggregate) for values in level[1:])
+            self.pyramid.append(level)
+
+    def view(self, start, end, bins):
+        """
+        Return time axis, heat map rows, differences and sums like plot_data
+        with at least bins time bins between start and end seconds.
+        """
+        start = max(round(start * NS_PER_SEC), int(self.edges[0]))
+        end = min(round(end * NS_PER_SEC), int(self.edges[-1]))
+        if end <= start:
+            start, end = int(self.edges[0]), int(self.edges[-1])
+        for edges, rows, differences, sums in reversed(self.pyramid):
+            first = max(int(np.searchsorted(edges, start, 'right')) - 1, 0)
+            last = min(int(np.searchsorted(edges, end, 'left')), len(edges) - 1)
+            if last - first >= bins:
+                return self.plotted(edges[first:last + 1], rows[first:last], differences[first:last],
+                                    sums[first:last])
+
+        edges = np.linspace(start, end, min(bins, end - start) + 1).astype(np.int64)
+        time = self.events.time
+        closest = np.searchsorted(self.edges, start, 'right') - 1
+        part_start = np.searchsorted(time, self.edges[closest], 'right')
+        part_end = np.searchsorted(time, end, 'right')
+        rows = self.events.part(part_start, part_end).binned_rows(edges, self.at_edges[closest], self.aggregate)
+        # Steps of lines from the first event after start
+        steps = np.searchsorted(time, start, 'right')
+        differences = aggregate_steps(time[steps:part_end], self.differences[steps:part_end + 1], edges,
+                                      self.aggregate)
+        sums = aggregate_steps(time[steps:part_end], self.sums[steps:part_end + 1], edges, self.aggregate)
+        return self.plotted(edges, rows, differences, sums)
+
+    @staticmethod
+    def plotted(edges, rows, differences, sums):
+        # The last row is only closing the last bin
+        rows = np.vstack((rows, np.zeros_like(rows[-1:])))
+        return ((edges / NS_PER_SEC).tolist(), rows, np.append(differences, differences[-1]).tolist(),
+                np.append(sums, sums[-1]).tolist())
+
+
+class BalanceTracker:
+    """
+    Maximal difference and sum of number of tasks on CPUs updated in
+    constant time per event. It keeps histogram with count of CPUs for
+    each nr_running value, so minimum and maximum move only by the
+    change of the updated CPU instead of scanning all CPUs.
+    """
+
+    def __init__(self, row):
+        self.row = [int(value) for value in row]
+        self.total = sum(self.row)
+        self.low = min(self.row, default=0)
+        self.high = max(self.row, default=0)
+        # Values can be negative, e.g. -1 for CPUs without data
+        self.offset = -min(self.low, 0)
+        self.histogram = [0] * (max(self.high, 0) + self.offset + 1)
+        for value in self.row:
+            self.histogram[value + self.offset] += 1
+
+    def difference(self):
+        return self.high - self.low
+
+    def update(self, cpu, value):
+        """Set number of tasks on cpu to value."""
+        old = self.row[cpu]
+        if old == value:
+            return
+        self.row[cpu] = value
+        self.total += value - old
+
+        histogram = self.histogram
+        histogram[old + self.offset] -= 1
+        if value + self.offset < 0:
+            # Make place for negative values bellow the current minimum
+            grow = -(value + self.offset)
+            histogram[:0] = [0] * grow
+            self.offset += grow
+        elif value + self.offset >= len(histogram):
+            histogram.extend([0] * (value + self.offset - len(histogram) + 1))
+        histogram[value + self.offset] += 1
+
+        if value > self.high:
+            self.high = value
+        if value < self.low:
+            self.low = value
+        while histogram[self.high + self.offset] == 0:
+            self.high -= 1
+        while histogram[self.low + self.offset] == 0:
+            self.low += 1
+
+
+class EventWindow:
+    """
+    Events of the last window nanoseconds of a growing trace with number of
+    tasks on CPUs at the start of the window, so memory stays bounded.
+    At most max_events newest events are kept.
+    """
+
+    def __init__(self, cpus_count, window, max_events=MAX_WINDOW_EVENTS):
+        self.cpus_count = cpus_count
+        self.window = window
+        self.max_events = max_events
+        self.start_row = np.full(cpus_count, -1, dtype=np.int16)
+        self.seen = np.zeros(cpus_count, dtype=bool)
+        self.slots = np.zeros(cpus_count, dtype=np.int64)  # index of CPU in tracker
+        self.tracker = None
+        self.columns = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint16),
+                        np.zeros(0, dtype=np.int16), np.zeros(0, dtype=np.int16))
+
+    def append(self, time, cpu, change, nr_running):
+        """
+        Add events and return lists with maximal difference and sum of tasks
+        on CPUs before each of them. Number of tasks on CPU before its first
+        event is computed as nr_running - change.
+        """
+        # CPUs are counted in the difference and sum from their first event
+        # with initial value, so results don't depend on how events are split
+        cpus, first = np.unique(cpu, return_index=True)
+        new = ~self.seen[cpus]
+        joins = np.sort(first[new])
+        self.start_row[cpu[joins]] = nr_running[joins] - change[joins]
+        self.seen[cpu[joins]] = True
+
+        differences = []
+        sums = []
+        slots = self.slots[cpu]
+        segments = np.unique(np.concatenate(([0], joins, [len(cpu)]))).tolist()
+        joined = set(joins.tolist())
+        for start, end in zip(segments[:-1], segments[1:]):
+            if start in joined:
+                new_cpu = cpu[start]
+                row = self.tracker.row if self.tracker else []
+                slots[cpu == new_cpu] = self.slots[new_cpu] = len(row)
+                self.tracker = BalanceTracker(row + [int(self.start_row[new_cpu])])
+            tracker = self.tracker
+            for slot, value in zip(slots[start:end].tolist(), nr_running[start:end].tolist()):
+                differences.append(tracker.high - tracker.low)
+                sums.append(tracker.total)
+                tracker.update(slot, value)
+
+        self.columns = tuple(np.concatenate((old, values)) for old, values
+                             in zip(self.columns, (time, cpu, change, nr_running)))
+        self.trim()
+        return differences, sums
+
+    def trim(self):
+        """Drop events older than window, keeping state at start of window."""
+        time, cpu, change, nr_running = self.columns
+        if not len(time):
+            return
+        keep = max(np.searchsorted(time, time[-1] - self.window), len(time) - self.max_events)
+        if keep <= 0:
+            return
+        # The last dropped event of each CPU gives its state at start of window
+        cpus, last = np.unique(cpu[:keep][::-1], return_index=True)
+        self.start_row[cpus] = nr_running[:keep][::-1][last]
+        self.columns = tuple(column[keep:] for column in self.columns)
+
+    def events(self):
+        """Return EventLog with events of the window."""
+        return EventLog(self.cpus_count, *self.columns)
+
+
+class ImbalanceDetector:
+    """
+    Find intervals in which maximal difference of number of tasks on CPUs is
+    at least threshold and which last at least duration seconds. Differences
+    are passed in batches as values before events at given times.
+    """
+
+    def __init__(self, threshold, duration, report_start=False, out=None):
+        self.threshold = threshold
+        self.duration = duration
+        self.report_start = report_start
+        self.out = out
+        self.imbalances = []
+        self.start = 0
+        self.start_reported = False
+        self.last_time = 0
+
+    def report(self, end):
+        self.imbalances.append([(self.start, self.threshold), (end, self.threshold)])
+        print(f"Imbalance from timestamp {self.start}"
+              f" lasting {end - self.start} seconds", file=self.out, flush=self.report_start)
+
+    def update(self, times, differences):
+        for timestamp, diff in zip(times, differences):
+            # Check the start of imbalance
+            if diff >= self.threshold and self.start == 0:
+                self.start = timestamp
+                self.start_reported = False
+            if self.report_start and self.start != 0 and not self.start_reported \
+               and (timestamp - self.start) >= self.duration:
+                print(f"Imbalance started at timestamp {self.start}", file=self.out, flush=True)
+                self.start_reported = True
+            if diff < self.threshold and self.start != 0:
+                # Print and store long imbalances
+                if (timestamp - self.start) >= self.duration:
+                    self.report(timestamp)
+                self.start = 0
+            self.last_time = timestamp
+
+    def finish(self):
+        """Report imbalance lasting to the very end of input."""
+        if self.start != 0 and (self.last_time - self.start) >= self.duration:
+            self.report(self.last_time)
+            self.start = 0
+
+
+def print_invalid_line(line_number, text, out=None):
+    print("WARNING: Line number {} contains 'sched_update_nr_running:' string, but does not match findall regex '{}'!".format(line_number, EVENT_RE.pattern), file=out)
+    print(text, end='', file=out)
+
+
+class ReportLines:
+    """
+    Original lines of trace report, which TraceChecker prints, so they can
+    be stored in the cache with events: lines of events inconsistent with
+    the previous event of their CPU, that previous line and invalid lines.
+    Events are checked by their values while chunks are parsed.
+    """
+
+    def __init__(self):
+        self.lines = {}     # index of event -> its line
+        self.warnings = []  # (index of the next event, line number, line) of invalid lines
+        self.count = 0      # events parsed so far
+        self.last_nr_running = np.full(1 << 16, -1, dtype=np.int64)
+        self.last_lines = {}  # CPU -> (index, line) of its last event
+
+    def update(self, chunk, line_count, line, line_start, line_end, valid, cpu, change, nr_running):
+        """Collect lines of parsed chunk, its arrays are returned by parse_chunk."""
+        if not valid.all():
+            before = np.cumsum(valid) - valid
+            for i in np.flatnonzero(~valid).tolist():
+                self.warnings.append((self.count + int(before[i]), line_count + 1 + int(line[i]),
+                                      decode_line(chunk[line_start[i]:line_end[i]])))
+        start, end = line_start[valid], line_end[valid]
+        cpu = cpu[valid].astype(np.uint16).astype(np.intp)
+        change = change[valid].astype(np.int64)
+        nr_running = nr_running[valid].astype(np.int64)
+
+        # Previous event of the same CPU in this chunk or before it
+        order = np.argsort(cpu, kind='stable')
+        same = cpu[order][1:] == cpu[order][:-1]
+        previous = np.full(len(cpu), -1, dtype=np.int64)
+        previous[order[1:][same]] = order[:-1][same]
+        inside = previous >= 0
+        previous_nr_running = np.where(inside, nr_running[np.maximum(previous, 0)], self.last_nr_running[cpu])
+        seen = previous_nr_running >= 0
+
+        # The same conditions as in TraceChecker.update
+        expected = nr_running - change
+        flagged = (expected < 0) | (seen & (expected != previous_nr_running))
+        for i in np.flatnonzero(flagged).tolist():
+            self.lines[self.count + i] = decode_line(chunk[start[i]:end[i]])
+            if inside[i]:
+                j = int(previous[i])
+                self.lines[self.count + j] = decode_line(chunk[start[j]:end[j]])
+            elif seen[i]:
+                index, text = self.last_lines[int(cpu[i])]
+                self.lines[index] = text
+
+        last = order[np.append(~same, True)] if len(cpu) else order
+        self.last_nr_running[cpu[last]] = nr_running[last]
+        for i in last.tolist():
+            self.last_lines[int(cpu[i])] = (self.count + i, decode_line(chunk[start[i]:end[i]]))
+        self.count += len(cpu)
+
+    def arrays(self):
+        """Return dictionary of arrays stored in the cache."""
+        indices = sorted(self.lines)
+        texts = [self.lines[i].encode() for i in indices] + [text.encode() for _, _, text in self.warnings]
+        return {"line_events": np.array(indices, dtype=np.int64),
+                "warning_lines": np.array([w[:2] for w in self.warnings], dtype=np.int64).reshape(-1, 2),
+                "line_lengths": np.array(list(map(len, texts)), dtype=np.int64),
+                "line_data": np.frombuffer(b"".join(texts), dtype=np.uint8)}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Return ReportLines stored in the cache."""
+        report_lines = cls()
+        data = arrays["line_data"].tobytes()
+        ends = np.cumsum(arrays["line_lengths"]).tolist()
+        texts = [data[start:end].decode() for start, end in zip([0] + ends[:-1], ends)]
+        indices = arrays["line_events"].tolist()
+        report_lines.lines = dict(zip(indices, texts))
+        report_lines.warnings = [(index, line_number, text) for (index, line_number), text
+                                 in zip(arrays["warning_lines"].tolist(), texts[len(indices):])]
+        return report_lines
+
+
+def iter_event_chunks(chunks, checker=None, line_count=1, timer=None, report_lines=None):
+    """
+    Parse binary chunks of trace report lines and yield typed columns (time,
+    cpu, change, nr_running) of valid events of each chunk. Events are passed
+    also to the optional TraceChecker. Line numbers in warnings about invalid
+    lines start after line_count lines. Lines are counted by the optional
+    PhaseTimer and lines for TraceChecker are kept in optional ReportLines.
+    """
+    for chunk in chunks:
+        lines, (line, line_start, line_end, valid, timestamp, cpu, change, nr_running) = parse_chunk(chunk)
+        if checker or not valid.all():
+            # Warnings and checker messages are printed in order of lines
+            for i in range(len(valid)):
+                text = decode_line(chunk[line_start[i]:line_end[i]])
+                if not valid[i]:
+                    print_invalid_line(line_count + 1 + line[i], text, checker.out if checker else None)
+                elif checker:
+                    checker.update(text, int(timestamp[i]) / NS_PER_SEC, int(cpu[i]), int(change[i]), int(nr_running[i]))
+        if report_lines:
+            report_lines.update(chunk, line_count, line, line_start, line_end, valid, cpu, change, nr_running)
+        line_count += lines
+        if timer:
+            timer.count("lines", lines)
+            timer.count("invalid_lines", len(valid) - np.count_nonzero(valid))
+
+        yield (timestamp[valid].astype(np.int64), cpu[valid].astype(np.uint16),
+               change[valid].astype(np.int16), nr_running[valid].astype(np.int16))
+
+
+class EventSpill:
+    """
+    Columns of events written to files in directory instead of memory.
+    EventLog returned by events maps them back part by part.
+    """
+
+    def __init__(self, directory, chunk_size):
+        self.chunk_size = chunk_size
+        self.paths = [os.path.join(directory, name + ".bin") for name in ("time", "cpu", "change", "nr_running")]
+        self.files = [open(path, 'wb') for path in self.paths]
+        self.length = 0
+
+    def append(self, columns):
+        for f, column, dtype in zip(self.files, columns, COLUMN_TYPES):
+            np.asarray(column, dtype=dtype).tofile(f)
+        self.length += len(columns[0])
+
+    def events(self, cpus_count):
+        for f in self.files:
+            f.close()
+        if not self.length:
+            columns = [np.zeros(0, dtype=dtype) for dtype in COLUMN_TYPES]
+        else:
+            columns = [np.memmap(path, dtype=dtype, mode='r') for path, dtype in zip(self.paths, COLUMN_TYPES)]
+        return EventLog(cpus_count, *columns, chunk_size=self.chunk_size)
+
+
+def read_event_log(input_file, checker=None, spill=None, timer=None, progress=None, index=None, report_lines=None):
+    """
+    Parse binary trace report into EventLog. Events are passed also to the
+    optional TraceChecker, so both are filled in a single pass over the input.
+    With EventSpill, columns are written to its files instead of memory.
+    Lines are counted by the optional PhaseTimer and read bytes by Progress.
+    Checkpoints of chunks are added to the optional TraceIndex and lines for
+    TraceChecker to the optional ReportLines.
+    """
+    cpus_count = read_cpus_count(input_file)
+    columns = ([], [], [], [])
+
+    chunks = read_chunks(input_file)
+    if progress:
+        chunks = progress.chunks(chunks)
+    if index:
+        chunks = index.chunks(chunks, cpus_count, input_file.tell())
+    for chunk_columns in iter_event_chunks(chunks, checker, timer=timer, report_lines=report_lines):
+        if index:
+            index.update(*chunk_columns)
+        if spill:
+            spill.append(chunk_columns)
+            continue
+        for column, values in zip(columns, chunk_columns):
+            column.append(values)
+
+    if spill:
+        return spill.events(cpus_count)
+
+    time, cpu, change, nr_running = (np.concatenate(c) if c else np.zeros(0) for c in columns)
+    events = EventLog(cpus_count, time.astype(np.int64), cpu.astype(np.uint16),
+                      change.astype(np.int16), nr_running.astype(np.int16))
+    events.lines = report_lines
+    return events
+
+
+def cache_key(file_name):
+    """Return values identifying content of trace file for its parse cache."""
+    stat = os.stat(file_name)
+    return np.array([PARSER_VERSION, stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+def load_cache(file_name):
+    """Return EventLog from cache of trace file_name or None if it's missing or stale."""
+    try:
+        with np.load(file_name + CACHE_SUFFIX) as cache:
+            if not np.array_equal(cache['key'], cache_key(file_name)):
+                return None
+            events = EventLog(int(cache['cpus_count']), cache['time'], cache['cpu'],
+                              cache['change'], cache['nr_running'])
+            if 'line_events' in cache:
+                events.lines = ReportLines.from_arrays(cache)
+            return events
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def save_cache(file_name, events):
+    """Store EventLog next to trace file_name. Unwritable location is skipped."""
+    cache_file = file_name + CACHE_SUFFIX
+    tmp_file = cache_file + ".tmp"
+    try:
+        lines = events.lines.arrays() if events.lines else {}
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, key=cache_key(file_name), cpus_count=events.cpus_count,
+                     time=events.time, cpu=events.cpu,
+                     change=events.change, nr_running=events.nr_running, **lines)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        print("WARNING: Couldn't write cache file '{}': {}".format(cache_file, e), file=sys.stderr)
+
+
+class TraceIndex:
+    """
+    Sparse index of trace report: byte offsets of chunks of its decompressed
+    content with line count, timestamp of the first event and number of
+    tasks on each CPU before each of them. Reading of a window of trace
+    starts at the last chunk before it instead of the start of the report.
+    """
+
+    def __init__(self, cpus_count=0, offsets=(), lines=(), times=(), states=()):
+        self.cpus_count = cpus_count
+        self.offsets = list(offsets)
+        self.lines = list(lines)
+        self.times = list(times)
+        self.states = list(states)
+
+    def chunks(self, chunks, cpus_count, offset):
+        """Yield chunks of trace report starting at byte offset and track their position."""
+        self.cpus_count = cpus_count
+        self.state = np.full(cpus_count, -1, dtype=np.int16)
+        self.offset = offset
+        self.line_count = 1
+        for chunk in chunks:
+            self.chunk = (self.offset, self.line_count)
+            yield chunk
+            self.offset += len(chunk)
+            self.line_count += chunk.count(b'\n')
+
+    def update(self, time, cpu, change, nr_running):
+        """Add checkpoint before parsed events of the current chunk and apply them to the state."""
+        if not len(time):
+            return
+        self.offsets.append(self.chunk[0])
+        self.lines.append(self.chunk[1])
+        self.times.append(int(time[0]))
+        self.states.append(self.state.copy())
+        update_state(self.state, cpu, nr_running)
+
+    def finish(self, initial):
+        """Set state of CPUs before their first event to initial row."""
+        self.states = [np.where(state < 0, initial, state) for state in self.states]
+
+    def checkpoint(self, start):
+        """Return (offset, line count, state) of the last checkpoint before start nanoseconds."""
+        i = max(int(np.searchsorted(self.times, start, 'left')) - 1, 0) if start is not None else 0
+        return self.offsets[i], self.lines[i], self.states[i].copy()
+
+
+def update_state(state, cpu, nr_running):
+    """Set state of CPUs to number of tasks after their last event."""
+    cpus, last = np.unique(cpu[::-1], return_index=True)
+    state[cpus] = nr_running[len(cpu) - 1 - last]
+
+
+def load_index(file_name):
+    """Return TraceIndex of trace file_name or None if it's missing or stale."""
+    try:
+        with np.load(file_name + INDEX_SUFFIX) as index:
+            if not np.array_equal(index['key'], cache_key(file_name)) or not len(index['offsets']):
+                return None
+            return TraceIndex(int(index['cpus_count']), index['offsets'], index['lines'],
+                              index['times'], index['states'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def save_index(file_name, index):
+    """Store TraceIndex next to trace file_name. Unwritable location is skipped."""
+    index_file = file_name + INDEX_SUFFIX
+    tmp_file = index_file + ".tmp"
+    states = np.array(index.states, dtype=np.int16).reshape(-1, index.cpus_count)
+    try:
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, key=cache_key(file_name), cpus_count=index.cpus_count,
+                     offsets=np.array(index.offsets, dtype=np.int64), lines=np.array(index.lines, dtype=np.int64),
+                     times=np.array(index.times, dtype=np.int64), states=states)
+        os.replace(tmp_file, index_file)
+    except OSError as e:
+        print("WARNING: Couldn't write index file '{}': {}".format(index_file, e), file=sys.stderr)
+
+
+def read_binary_trace(file_name):
+    """Return EventLog of trace.dat file or exit with error for unsupported file."""
+    from tracedat import read_trace_dat, TraceDatError
+    try:
+        return read_trace_dat(file_name)
+    except TraceDatError as e:
+        print("ERROR: Couldn't read trace.dat file '{}'.".format(file_name))
+        print("       {}".format(e))
+        print("       Exiting")
+        sys.exit(1)
+
+
+def read_trace(input_file, checker=None, use_cache=True, rebuild_cache=False, spill=None, timer=None,
+               progress=False):
+    """
+    Return EventLog of trace report or trace.dat input_file. Events of regular files are
+    stored in a sidecar cache file and later runs load them from it as long
+    as the trace file and PARSER_VERSION stay the same. Lines of trace
+    reports which checker prints are stored in the cache too, so its
+    messages are the same as when the report is parsed. With EventSpill,
+    events of trace reports are stored in its files and the cache isn't used.
+    Sizes of input are recorded by the optional PhaseTimer and with progress,
+    read bytes of trace reports are reported periodically to stderr.
+    """
+    if timer:
+        timer.set("input", input_file.name)
+        if os.path.isfile(input_file.name):
+            timer.set("input_bytes", os.path.getsize(input_file.name))
+
+    # The index is small, so it's written also with EventSpill
+    index = TraceIndex() if use_cache and os.path.isfile(input_file.name) else None
+    use_cache = use_cache and os.path.isfile(input_file.name) and not spill
+    from tracedat import is_trace_dat
+    binary = os.path.isfile(input_file.name) and is_trace_dat(input_file.name)
+    if use_cache and not rebuild_cache:
+        events = load_cache(input_file.name)
+        if events is not None:
+            input_file.close()
+            if checker or events.lines:
+                events.replay(checker)
+            if timer:
+                timer.set("input_format", "cache")
+                timer.count("events", len(events))
+                timer.set("cpus", events.cpus_count)
+            return events
+
+    if binary:
+        input_file.close()
+        if spill:
+            print("WARNING: Events of trace.dat files are always read to memory", file=sys.stderr)
+        events = read_binary_trace(input_file.name)
+        if checker:
+            events.replay(checker)
+        input_format = "trace.dat"
+    else:
+        if progress:
+            total = uncompressed_size(input_file.name) if os.path.isfile(input_file.name) else None
+            progress = Progress(total, label=os.path.basename(input_file.name) + ": ")
+        with open_trace(input_file, mapped=not spill, max_memory=DECOMPRESS_MEMORY if spill else None) as trace:
+            events = read_event_log(trace, checker, spill, timer, progress, index,
+                                    ReportLines() if use_cache else None)
+        input_format = "report"
+        if index:
+            index.finish(events.initial_row())
+            save_index(input_file.name, index)
+
+    if timer:
+        timer.set("input_format", input_format)
+        timer.count("events", len(events))
+        timer.set("cpus", events.cpus_count)
+    if use_cache:
+        save_cache(input_file.name, events)
+    return events
+
+
+def read_trace_window(input_file, start=None, end=None, checker=None, use_cache=True, rebuild_cache=False,
+                      spill=None, timer=None, progress=False):
+    """
+    Return EventLog of events of trace report or trace.dat input_file between
+    start and end seconds. With index of trace report stored next to it,
+    only the window is parsed, starting from the last checkpoint before it.
+    Otherwise the whole trace is read like by read_trace, which writes the index.
+    """
+    start = None if start is None else round(start * NS_PER_SEC)
+    end = None if end is None else round(end * NS_PER_SEC)
+    index = None
+    if use_cache and not rebuild_cache and os.path.isfile(input_file.name):
+        index = load_index(input_file.name)
+    if index is None:
+        events = read_trace(input_file, None, use_cache, rebuild_cache, spill, timer, progress).window(start, end)
+        if checker:
+            events.replay(checker)
+        return events
+
+    input_file.close()
+    offset, line_count, state = index.checkpoint(start)
+    columns = ([], [], [], [])
+    with open_trace_at(input_file.name, offset, DECOMPRESS_MEMORY if spill else None) as trace:
+        chunks = read_chunks(trace)
+        if progress:
+            chunks = Progress(label=os.path.basename(input_file.name) + ": ").chunks(chunks)
+        for timestamp, cpu, change, nr_running in iter_event_chunks(chunks, line_count=line_count, timer=timer):
+            # Events before the window only change the state at its start
+            first = np.searchsorted(timestamp, start, 'left') if start is not None else 0
+            last = np.searchsorted(timestamp, end, 'right') if end is not None else len(timestamp)
+            update_state(state, cpu[:first], nr_running[:first])
+            chunk_columns = tuple(column[first:max(first, last)] for column in (timestamp, cpu, change, nr_running))
+            if spill:
+                spill.append(chunk_columns)
+            else:
+                for column, values in zip(columns, chunk_columns):
+                    column.append(values)
+            if last < len(timestamp):
+                break
+
+    if spill:
+        events = spill.events(index.cpus_count)
+    else:
+        events = EventLog(index.cpus_count, *(np.concatenate(c) if c else np.zeros(0, dtype=dtype)
+                                              for c, dtype in zip(columns, COLUMN_TYPES)))
+    events.initial = state
+    if checker:
+        events.replay(checker)
+    if timer:
+        timer.set("input", input_file.name)
+        timer.set("input_format", "index")
+        timer.count("events", len(events))
+        timer.set("cpus", events.cpus_count)
+    return events
+
+
+def utilization(events):
+    """
+    Return arrays (cpus, runtime, idle) with seconds when CPUs with events
+    were running some task or idle. State of CPU before its first event is
+    given by nr_running - change and lasts from the first event of the trace.
+    If CPU was idle before and after its first event, the time until it
+    starts running for the first time is not counted.
+    """
+    if not len(events):
+        return np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0)
+    start_time = events.time[0] / NS_PER_SEC
+    stop_time = events.time[-1] / NS_PER_SEC
+    seen = np.zeros(events.cpus_count, dtype=bool)
+    last_seconds = np.zeros(events.cpus_count)
+    last_running = np.zeros(events.cpus_count, dtype=bool)
+    runtime = np.zeros(events.cpus_count)
+    initial = np.zeros(events.cpus_count)
+    begin = np.full(events.cpus_count, start_time)
+    waiting = np.zeros(events.cpus_count, dtype=bool)
+
+    for chunk in events.chunks():
+        order = np.argsort(chunk.cpu, kind='stable')
+        cpu = chunk.cpu[order].astype(np.int64)
+        seconds = chunk.time[order] / NS_PER_SEC
+        running = chunk.nr_running[order] > 0
+        first = np.flatnonzero(np.concatenate(([True], cpu[1:] != cpu[:-1])))
+        last = np.append(first[1:], len(cpu)) - 1
+        cpus = cpu[first]
+
+        # Running before the first event of CPU counts from start of the trace
+        new = ~seen[cpus]
+        previous_running = chunk.nr_running[order][first] - chunk.change[order][first] > 0
+        initial[cpus[new]] = np.where(previous_running[new], seconds[first[new]] - start_time, 0.0)
+        waiting[cpus[new]] = ~previous_running[new] & ~running[first[new]]
+        seen[cpus[new]] = True
+
+        # Each event ends the state after the previous event of its CPU,
+        # times are added in the order of events to get the same sums for any chunks
+        previous_seconds = np.concatenate(([0.0], seconds[:-1]))
+        previous_seconds[first] = last_seconds[cpus]
+        was_running = np.concatenate(([False], running[:-1]))
+        was_running[first] = last_running[cpus] & ~new
+        np.add.at(runtime, cpu, np.where(was_running, seconds - previous_seconds, 0.0))
+
+        # Counting starts at the first run of CPUs idle before and after their first event
+        run_cpus, first_run = np.unique(cpu[running], return_index=True)
+        started = waiting[run_cpus]
+        begin[run_cpus[started]] = seconds[running][first_run[started]]
+        waiting[run_cpus[started]] = False
+
+        last_seconds[cpus] = seconds[last]
+        last_running[cpus] = running[last]
+
+    cpus = np.flatnonzero(seen)
+    np.add.at(runtime, cpus, np.where(last_running[cpus], stop_time - last_seconds[cpus], 0.0))
+    begin[waiting] = stop_time
+    runtime = runtime[cpus] + initial[cpus]
+    idle = stop_time - begin[cpus] - runtime
+    return cpus, runtime, idle
+
+
+class TimeStatistics:
+    """
+    Statistics of the trace, in which every state is weighted by how long it
+    lasted instead of by number of events. Parts of events are passed with
+    arrays of differences and sums from EventLog.balance_chunks. Times are
+    summed in integer nanoseconds, so results don't depend on the parts.
+    """
+
+    def __init__(self, events, initial, threshold):
+        self.threshold = threshold
+        self.initial = initial
+        self.count = 0
+        self.start = int(events.time[0]) if len(events) else 0
+        self.stop = int(events.time[-1]) if len(events) else 0
+        self.previous = self.start
+        # Integrals of difference and sum and time spent with each difference
+        self.difference_integral = 0
+        self.sum_integral = 0
+        self.difference_times = np.zeros(1)
+        # Time of each CPU with number of tasks of each level
+        self.seen = np.zeros(events.cpus_count, dtype=bool)
+        self.last_time = np.zeros(events.cpus_count, dtype=np.int64)
+        self.last_level = np.zeros(events.cpus_count, dtype=np.int64)
+        self.level_times = np.zeros((events.cpus_count, len(TASK_LEVELS)))
+
+    def update(self, chunk, differences, sums):
+        if not len(chunk):
+            return
+        # Values before each event last from the previous event
+        weights = np.diff(np.concatenate(([self.previous], chunk.time)))
+        before = np.asarray(differences[:-1], dtype=np.int64)
+        self.difference_integral += int(np.dot(before, weights))
+        self.sum_integral += int(np.dot(np.asarray(sums[:-1], dtype=np.int64), weights))
+        histogram = np.bincount(before, weights=weights)
+        if len(histogram) > len(self.difference_times):
+            self.difference_times = np.append(self.difference_times,
+                                              np.zeros(len(histogram) - len(self.difference_times)))
+        self.difference_times[:len(histogram)] += histogram
+        self.previous = int(chunk.time[-1])
+        self.count += len(chunk)
+
+        # Levels of CPUs before their first event last from start of the trace
+        order = np.argsort(chunk.cpu, kind='stable')
+        cpu = chunk.cpu[order].astype(np.int64)
+        time = chunk.time[order]
+        levels = np.clip(chunk.nr_running[order], 0, len(TASK_LEVELS) - 1).astype(np.int64)
+        first = np.flatnonzero(np.concatenate(([True], cpu[1:] != cpu[:-1])))
+        last = np.append(first[1:], len(cpu)) - 1
+        cpus = cpu[first]
+        new = ~self.seen[cpus]
+        self.last_time[cpus[new]] = self.start
+        self.last_level[cpus[new]] = np.clip(self.initial[cpus[new]], 0, len(TASK_LEVELS) - 1)
+        self.seen[cpus[new]] = True
+
+        # Each event ends the level after the previous event of its CPU
+        previous_time = np.concatenate(([0], time[:-1]))
+        previous_time[first] = self.last_time[cpus]
+        previous_level = np.concatenate(([0], levels[:-1]))
+        previous_level[first] = self.last_level[cpus]
+        self.level_times += np.bincount(cpu * len(TASK_LEVELS) + previous_level, weights=time - previous_time,
+                                        minlength=self.level_times.size).reshape(self.level_times.shape)
+        self.last_time[cpus] = time[last]
+        self.last_level[cpus] = levels[last]
+
+    def finish(self, imbalances=()):
+        """Return dict with statistics, imbalances are added as found by ImbalanceDetector."""
+        cpus = np.flatnonzero(self.seen)
+        np.add.at(self.level_times, (cpus, self.last_level[cpus]), self.stop - self.last_time[cpus])
+        duration = self.stop - self.start
+        total = self.difference_times.sum()
+
+        def mean(integral):
+            return integral / total if total > 0 else None
+
+        percentiles = [None for _ in PERCENTILES]
+        if total > 0:
+            positions = np.searchsorted(np.cumsum(self.difference_times), np.array(PERCENTILES) / 100 * total)
+            percentiles = np.minimum(positions, len(self.difference_times) - 1).tolist()
+        above = self.difference_times[self.threshold:].sum() if self.threshold >= 0 else total
+        fractions = self.level_times[cpus] / duration if duration > 0 else self.level_times[cpus]
+        return {
+            "events": self.count,
+            "start": self.start / NS_PER_SEC,
+            "duration": duration / NS_PER_SEC,
+            "threshold": self.threshold,
+            "mean_sum": mean(self.sum_integral),
+            "mean_difference": mean(self.difference_integral),
+            "difference_percentiles": dict(zip(map(str, PERCENTILES), percentiles)),
+            "above_threshold_seconds": above / NS_PER_SEC,
+            "imbalances": len(imbalances),
+            "imbalance_seconds": sum(end[0] - begin[0] for begin, end in imbalances),
+            "cpus": {str(c): dict(zip(TASK_LEVELS, f)) for c, f in zip(cpus.tolist(), fractions.tolist())},
+        }
+
+
+def print_statistics(statistics, out=None):
+    """Print statistics returned by TimeStatistics.finish as tables."""
+    from prettytable import PrettyTable
+
+    def number(value, pattern='{:.3f}'):
+        return '-' if value is None else pattern.format(value)
+
+    table = PrettyTable(['Statistic', 'Value'])
+    table.align['Statistic'] = 'l'
+    table.add_row(['Events', statistics["events"]])
+    table.add_row(['Duration (s)', number(statistics["duration"])])
+    table.add_row(['Mean sum of tasks', number(statistics["mean_sum"])])
+    table.add_row(['Mean difference', number(statistics["mean_difference"])])
+    for percentile, value in statistics["difference_percentiles"].items():
+        table.add_row(['Difference p' + percentile, number(value, '{}')])
+    table.add_row(['Difference >= {} (s)'.format(statistics["threshold"]),
+                   number(statistics["above_threshold_seconds"])])
+    table.add_row(['Imbalances', statistics["imbalances"]])
+    table.add_row(['Imbalance time (s)', number(statistics["imbalance_seconds"])])
+    print(table, file=out)
+
+    cpu_table = PrettyTable(['CPU'] + [level + ' tasks %' for level in TASK_LEVELS])
+    for cpu, fractions in statistics["cpus"].items():
+        cpu_table.add_row([cpu] + ['{:4.1f}'.format(fractions[level] * 100) for level in TASK_LEVELS])
+    print(cpu_table, file=out)
+
+
+class TraceChecker:
+    """
+    Track inconsistencies between consecutive events of the same CPU and
+    print them with utilization of CPUs. Messages and tables are printed to out.
+    """
+
+    def __init__(self, out=None):
+        self.out = out  # None is the current sys.stdout
+        self.cpu_state = dict()
+        self.utilization = None
+        self.cpu_nr_running = dict()
+        self.inconsistent_events = defaultdict(lambda: 0)
+        self.previous_line = dict()
+        self.events_count = 0
+        self.start_time = 0
+        self.stop_time = 0
+
+    def update(self, line, point_time, cpu, change, nr_running):
+        out = self.out
+        self.events_count += 1
+        self.stop_time = point_time
+
+        prev_nr_running = nr_running - change
+        if prev_nr_running < 0:
+            print("WARNING: Detected line with nr_running - change < 0", "nr_running", nr_running, "change", change, "nr_running - change", prev_nr_running, file=out)
+            print(line, end='', file=out)
+
+        if self.events_count == 1:
+            self.start_time = point_time
+
+        recorded_inconsistent_event = False
+        # Check for any unexpected events
+        if cpu in self.cpu_nr_running:
+            detected_change = nr_running - self.cpu_nr_running[cpu]
+            if detected_change != change:
+                recorded_inconsistent_event = True
+                self.inconsistent_events[cpu] += 1
+                print('WARNING: Detected missed event number', sum(self.inconsistent_events.values()), '- number', self.inconsistent_events[cpu], ' for cpu', cpu, file=out)
+                print('\tchange ', change, 'computed change ', detected_change, 'nr_running ', nr_running, 'old nr_running ', self.cpu_nr_running[cpu], file=out)
+                print('\tPrevious line:', self.previous_line[cpu], end='', file=out)
+                print('\tCurrent line: ', line, end='', file=out)
+
+        if recorded_inconsistent_event == False and cpu in self.cpu_state:
+            old_state = self.cpu_state[cpu]
+            if (old_state == "Running" and prev_nr_running == 0) or (old_state == "Idle" and prev_nr_running > 0):
+                recorded_inconsistent_event = True
+                self.inconsistent_events[cpu] += 1
+                print("WARNING: Detected inconsistent data. Previous state was", old_state, ", which does not correspond to computed previous nr_running value", prev_nr_running, file=out)
+                print('\tPrevious line:', self.previous_line[cpu], end='', file=out)
+                print('\tCurrent line: ', line, end='', file=out)
+
+        self.cpu_nr_running[cpu] = nr_running
+        self.previous_line[cpu] = line
+
+        self.cpu_state[cpu] = "Running" if nr_running > 0 else "Idle"
+
+    def finish(self, events):
+        """Compute utilization of CPUs from all events of the trace."""
+        self.utilization = utilization(events)
+
+    def print_tables(self, numa_cpus={}):
+        """Print utilization tables and summary of unexpected events."""
+        from prettytable import PrettyTable
+        out = self.out
+
+        # Create utilization table
+        cpu_util_table = PrettyTable(['CPU', 'Runtime (s)', 'Runtime %', 'Idle (s)', 'Idle %', 'Total time (s)'])
+        cpus, runtime, idle = self.utilization
+        cpu_util = dict()
+
+        for cpu, (run, idle_time) in zip(cpus.tolist(), zip(runtime, idle)):
+            cpu_util[cpu] = [run, idle_time]
+            total = run + idle_time
+            result = [cpu,
+                      '{:4.1f}'.format(run), '{:4.1f}'.format(run / total * 100.0),
+                      '{:4.1f}'.format(idle_time), '{:4.1f}'.format(idle_time / total * 100.0),
+                      '{:4.1f}'.format(total)]
+            cpu_util_table.add_row(result)
+
+        print(cpu_util_table, file=out)
+
+        numa_util_table = PrettyTable(['NUMA node', 'Runtime %', 'Idle %'])
+
+        if numa_cpus:
+            numa_util = dict()
+            for node in sorted(numa_cpus.keys()):
+                if not node in numa_util:
+                    numa_util[node] = np.zeros(2)
+                for cpu in numa_cpus[node]:
+                    if not cpu in cpu_util:
+                        # Cpu was idle whole time
+                        cpu_util[cpu] = [np.float64(0.0), np.float64(self.stop_time - self.start_time)]
+                    numa_util[node] += cpu_util[cpu]
+                total = numa_util[node][0] + numa_util[node][1]
+                result = [node,
+                          '{:4.1f}'.format(numa_util[node][0] / total * 100),
+                          '{:4.1f}'.format(numa_util[node][1] / total * 100)]
+                numa_util_table.add_row(result)
+            print(numa_util_table, file=out)
+
+        average_util = np.zeros(2)
+        for cpu in cpu_util:
+            average_util += cpu_util[cpu]
+
+        average_util_table = PrettyTable(['Average', 'Runtime %', 'Idle %'])
+        total = average_util[0] + average_util[1]
+        result = ['',
+                  '{:4.1f}'.format(average_util[0] / total * 100),
+                  '{:4.1f}'.format(average_util[1] / total * 100)]
+        average_util_table.add_row(result)
+        print(average_util_table, file=out)
+
+        # Info about missed events
+        inconsistent_events = self.inconsistent_events
+        if inconsistent_events:
+            missed_events_table = PrettyTable(['Unexpected events', 'Unexpected events %', 'Average # of unexp. events per CPU', 'Worst CPU', 'Worst CPU results', 'Best CPU', 'Best CPU results'])
+            me_summary = dict()
+            me_summary["total"] = sum(inconsistent_events.values())
+            me_summary["worst_cpu"] = max(inconsistent_events, key=inconsistent_events.get)
+            me_summary["best_cpu"] = min(inconsistent_events, key=inconsistent_events.get)
+            me_summary["average"] = me_summary["total"] / len(inconsistent_events)
+            missed_events_table.add_row([me_summary["total"],
+                                         '{:.2g}%'.format(me_summary["total"] / self.events_count * 100.0),
+                                         '{:.2g}'.format(me_summary["average"]),
+                                         me_summary["worst_cpu"], inconsistent_events[me_summary["worst_cpu"]],
+                                         me_summary["best_cpu"], inconsistent_events[me_summary["best_cpu"]]])
+            print(missed_events_table, file=out)
+            print("Total sched_update_nr_running events:", self.events_count, file=out)
+
+        else:
+            print("No unexpected events found\n", file=out)
@@ -2,7 +2,10 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+from concurrent.futures import Future, ProcessPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime, timedelta
+import io
+import json
 import os
 import sys
 import re
@@ -15,6 +18,26 @@ from matplotlib.colors import ListedColormap, BoundaryNorm
 from matplotlib import collections as mc
 from matplotlib.ticker import MultipleLocator
 
+from nr_running import read_nodes, node_starts, PhaseTimer
+from decompress import open_text
+
+MAX_CPU_TICKS = 64  # more CPUs are labeled by multiples of a step
+READ_SIZE = 1 << 24  # bytes of mpstat output parsed at once
+FIELD_DTYPE = "S16"  # fields are converted from strings after selecting lines
+TAIL_SIZE = 4096  # bytes searched for empty lines at the end of input
+
+HEADER_RE = re.compile(r".*\)\s+(\d+[/-]\d+[/-]\d+)\s+_.*\((\d+) CPU\).*")
+DATE_FORMATS = ["%m/%d/%y", "%Y-%m-%d", "%m/%d/%Y"]
+JSON_STATISTICS_RE = re.compile(r'"statistics"\s*:\s*\[')
+JSON_FIELD_RE = re.compile(r'"([a-z-]+)"\s*:\s*("[^"]*"|\d+)')
+JSON_SEPARATOR_RE = re.compile(r"[\s,]*")
+
+
+def cpu_step(cpus):
+    """Return step of labeled CPUs, so at most MAX_CPU_TICKS of them are labeled."""
+    return -(-cpus // MAX_CPU_TICKS)
+
+
 def draw_reports(cpu_values, time_axis, file_names, image_file=None, numa_cpus={}):
     cols = int(np.ceil(np.sqrt(len(cpu_values))))
     rows = int(np.ceil(len(cpu_values) / cols))
@@ -53,13 +76,12 @@ def draw_reports(cpu_values, time_axis, file_names, image_file=None, numa_cpus={
         # Separate CPUs with lines by NUMA nodes
         if numa_cpus:
             ax.grid(True, which='major', axis='y', linestyle='--', color='k')
-            plt.yticks(range(0, vmap.shape[0] - 1, len(numa_cpus[0])),
-                    map(lambda x: "Node " + str(x), range(len(numa_cpus.keys()))))
-            ax.yaxis.set_minor_locator(MultipleLocator(1))
+            plt.yticks(node_starts(numa_cpus), ["Node " + str(node) for node in numa_cpus])
+            ax.yaxis.set_minor_locator(MultipleLocator(cpu_step(vmap.shape[0])))
             ax.set_ylabel("CPUs (grouped by NUMA nodes)")
         else:
             ax.set_ylabel("CPUs")
-            plt.yticks(range(vmap.shape[0]))
+            plt.yticks(range(0, vmap.shape[0], cpu_step(vmap.shape[0])))
 
     #plt.subplots_adjust(left=0.05, right=0.90, top=0.95, bottom=0.1)
 
@@ -113,13 +135,12 @@ def draw_dual_reports(cpu_values, numa_values, time_axis, file_names, image_file
             # Separate CPUs with lines by NUMA nodes
             if numa_cpus:
                 ax.grid(True, which='major', axis='y', linestyle='--', color='k')
-                plt.yticks(range(0, cpu_values[j + i * cols].shape[0] - 1, len(numa_cpus[0])),
-                        map(lambda x: "Node " + str(x), range(len(numa_cpus.keys()))))
-                ax.yaxis.set_minor_locator(MultipleLocator(1))
+                plt.yticks(node_starts(numa_cpus), ["Node " + str(node) for node in numa_cpus])
+                ax.yaxis.set_minor_locator(MultipleLocator(cpu_step(cpu_values[j + i * cols].shape[0])))
                 ax.set_ylabel("CPUs (grouped by NUMA nodes)")
             else:
                 ax.set_ylabel("CPUs")
-                plt.yticks(range(cpu_values[j + i * cols].shape[0]))
+                plt.yticks(range(0, cpu_values[j + i * cols].shape[0], cpu_step(cpu_values[j + i * cols].shape[0])))
 
             # NUMA graph
             ax = axs.flat[j + i * cols * 2 + cols]
@@ -157,169 +178,325 @@ def draw_dual_reports(cpu_values, numa_values, time_axis, file_names, image_file
     plt.close()
 
 
-def read_nodes(lscpu_file):
-    numa_cpus = {}
-    NUMA_re=re.compile(r'NUMA.*CPU\(s\):')
-    for line in lscpu_file:
-        # Find number of CPUs and NUMA nodes:
-        if line[:7] == 'CPU(s):':
-            cpu_nb = int(line[7:])
-        elif line[:13] == 'NUMA node(s):':
-            nodes_nb = int(line[13:])
-
-        # Find NUMA nodes associated with CPUs:
-        elif NUMA_re.search(line):
-            words = line.split()
-            cpus = words[-1].split(',')
-            for cpu in cpus:
-                if '-' in cpu:
-                    w = cpu.split('-')
-                    for i in range(int(w[0]), int(w[1]) + 1):
-                        numa_cpus.setdefault(int(words[1][4:]), []).append(i)
-                else:
-                    numa_cpus.setdefault(int(words[1][4:]), []).append(int(cpu))
-
-    return numa_cpus
-
-
-def process_report(input_file, time_offset=0.0):
-    cpus_count = 0
-    time_axis = []
-    cpu_values = []
-    differences = []
-    imbalances = []
+def mpstat_date(text):
+    """Return date of mpstat header in any of the formats used by sysstat."""
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, date_format).date()
+        except ValueError:
+            pass
+    print("Wrong mpstat header")
+    exit(1)
 
-    # Get CPUs count and start date
-    reg_exp=re.compile(r".*\)\s+(\d+/\d+/\d+)\s+_.*\((\d+) CPU\).*")
 
-    line = input_file.readline()  # read first data line
-    match = reg_exp.findall(line)
+def parse_time(text):
+    """Return time of day of mpstat interval in 24-hour or 12-hour format."""
+    try:
+        return datetime.strptime(text, "%H:%M:%S").time()
+    except ValueError:
+        return datetime.strptime(text, "%I:%M:%S %p").time()
+
+
+def interval_times(times, start_date, time_offset):
+    """
+    Return time axis of intervals starting at times of day given as strings.
+    Each distinct string is parsed once, next day starts when hour decreases.
+    """
+    parsed = {}
+    axis = []
+    last_hour = 0
+    for text in times:
+        time = parsed.get(text)
+        if time is None:
+            time = parsed[text] = parse_time(text)
+        if time.hour < last_hour:
+            start_date += timedelta(days=1)
+        last_hour = time.hour
+        axis.append(datetime.combine(start_date, time).timestamp())
+
+    if not time_offset and axis:
+        time_offset = axis[0]
+    return [timestamp - time_offset for timestamp in axis]
+
+
+def stack_rows(parts, width):
+    """Return rows of parts (single rows or blocks of them) as one array padded to common width."""
+    parts = [np.atleast_2d(part) for part in parts]
+    width = max([width] + [part.shape[1] for part in parts])
+    return np.vstack([np.zeros((0, width))]
+                     + [np.pad(part, ((0, 0), (0, width - part.shape[1]))) for part in parts])
+
+
+def read_text_report(raw, measuretype, by_index):
+    """
+    Parse mpstat text output from buffered binary stream raw by blocks of
+    READ_SIZE bytes. Columns of time, label, %usr and %sys of all lines of
+    a block are split at once and converted after header lines are left out.
+    Return (start date, times of intervals, rows of usr + sys values,
+    numbers of values in rows).
+    """
+    match = HEADER_RE.findall(raw.readline().decode())
     if not match:
         print("Wrong mpstat header")
         exit(1)
+    start_date = mpstat_date(match[0][0])
+    width = int(match[0][1]) if by_index else 0
 
-    start_date = datetime.strptime(match[0][0], "%m/%d/%y").date()
-    cpus_count = int(match[0][1])
-
-    input_file.readline()  # skip first empty line
-    data = input_file.readline().split()  # read first data line
-
-    if time_offset:
-        curr_time = datetime.combine(start_date,
-            datetime.strptime(data[0], "%H:%M:%S").time())
+    raw.readline()  # skip first empty line
+    header = raw.readline().split()  # read first data line
+    label = measuretype.encode()
+    if label not in header or b"%usr" not in header or b"%sys" not in header:
+        print("Wrong mpstat header")
+        exit(1)
+    time_fields = header.index(label)  # time with optional AM/PM
+    usr = header.index(b"%usr")
+    system = header.index(b"%sys")
+
+    times = [b" ".join(header[:time_fields]).decode()]
+    parts = []
+    counts = []
+    row = np.zeros(width)  # values of the last interval
+    count = 0
+    tail = b""  # whitespace at the end of input
+    rest = b""
+    complete = False
+    while True:
+        data = raw.read(READ_SIZE)
+        if not data:
+            # Incomplete interval is counted only when followed by empty line
+            complete = tail.count(b"\n") >= 2
+            break
+        data = rest + data
+        end = data.rfind(b"\n") + 1
+        data, rest = data[:end], data[end:]
+        last = data[-TAIL_SIZE:]
+        stripped = len(last.rstrip())
+        tail = last[stripped:] if stripped else tail + last
+
+        average = (b"\n" + data).find(b"\nAverage:")
+        if average >= 0:
+            data = data[:average]
+            complete = True
+        if data and not data.isspace():
+            try:
+                matrix = np.loadtxt(io.BytesIO(data), dtype=FIELD_DTYPE, comments=None, ndmin=2,
+                                    usecols=list(range(time_fields)) + [time_fields, usr, system])
+            except ValueError:
+                print("Wrong number of fields in mpstat data")
+                exit(1)
+            labels = matrix[:, time_fields]
+            starts = labels == label
+            lines = ~starts & (labels != b"all")
+            interval = np.cumsum(starts)[lines]  # 0 for lines of the last interval
+            new = int(starts.sum())
+            values = matrix[lines]
+            sums = values[:, -2].astype(float) + values[:, -1].astype(float)
+            if by_index:
+                columns = values[:, time_fields].astype(int)
+            else:
+                # Values are in order of lines of intervals
+                columns = np.arange(len(interval)) - np.searchsorted(interval, interval)
+                columns[interval == 0] += count
+                width = max(width, int(columns.max()) + 1 if len(columns) else 0)
+
+            block = np.zeros((new + 1, width))
+            block[0, :len(row)] = row
+            block[interval, columns] = sums
+            block_counts = np.bincount(interval, minlength=new + 1)
+            block_counts[0] += count
+            times += [b" ".join(time).decode() for time in matrix[starts, :time_fields]]
+            parts.append(block[:-1])
+            counts.append(block_counts[:-1])
+            row = block[-1]
+            count = block_counts[-1]
+        if complete:
+            break
+
+    if complete:
+        parts.append(row)
+        counts.append([count])
     else:
-        curr_time = datetime.combine(start_date,
-            datetime.strptime(data[0], "%H:%M:%S").time())
-        time_offset = curr_time.timestamp()
-
-    time_axis = []
-    row = np.zeros(cpus_count)
-
-    for line in input_file:
-        data = line.split()
+        times.pop()
+    return start_date, times, stack_rows(parts, width), np.concatenate([[]] + counts)
+
+
+def json_statistics(input_file):
+    """
+    Yield header of the first host of mpstat -o JSON output in text stream
+    input_file as dictionary and then its statistics of intervals, which
+    are decoded one by one as the file is read.
+    """
+    text = ""
+    match = None
+    while not match:
+        data = input_file.read(READ_SIZE)
         if not data:
-            cpu_values.append(row)
-            time_axis.append(curr_time.timestamp() - time_offset)
-            row = np.zeros(cpus_count)
-            continue
-        if data[0] == "Average:":
-            break  # end of file
-        if data[1] == "CPU":  # Time when measure started
-            last_time = curr_time
-            curr_time = datetime.combine(start_date,
-                datetime.strptime(data[0], "%H:%M:%S").time())
-            if curr_time.hour < last_time.hour:
-                start_date += timedelta(days=1)
-                curr_time += timedelta(days=1)
+            print("Wrong mpstat header")
+            exit(1)
+        text += data
+        match = JSON_STATISTICS_RE.search(text)
+    yield {key: json.loads(value) for key, value in JSON_FIELD_RE.findall(text[:match.start()])}
+
+    decoder = json.JSONDecoder()
+    position = match.end()
+    while True:
+        position = JSON_SEPARATOR_RE.match(text, position).end()
+        if text.startswith("]", position):
+            return
+        try:
+            statistics, position = decoder.raw_decode(text, position)
+        except json.JSONDecodeError:
+            data = input_file.read(READ_SIZE)
+            if not data:
+                return  # output of running mpstat ends in the middle
+            text = text[position:] + data
+            position = 0
             continue
-        if data[1] == "all":
+        yield statistics
+
+
+def read_json_report(input_file, measuretype, by_index):
+    """
+    Parse output of mpstat -o JSON from text stream input_file, values are
+    taken by their names. Return the same as read_text_report.
+    """
+    statistics = json_statistics(input_file)
+    header = next(statistics)
+    start_date = mpstat_date(str(header.get("date")))
+    width = int(header.get("number-of-cpus", 0)) if by_index else 0
+    load, name = ("cpu-load", "cpu") if measuretype == "CPU" else ("node-load", "node")
+
+    times = []
+    rows = []
+    counts = []
+    for interval in statistics:
+        if load not in interval:
             continue
-        row[int(data[1])] = float(data[2]) + float(data[4])  # usr + sys values
+        values = [item for item in interval[load] if item[name] != "all"]
+        sums = [item["usr"] + item["sys"] for item in values]
+        if by_index:
+            row = np.zeros(width)
+            row[[int(item[name]) for item in values]] = sums
+        else:
+            row = np.array(sums)
+        times.append(interval["timestamp"])
+        rows.append(row)
+        counts.append(len(values))
+    return start_date, times, stack_rows(rows, width), np.array(counts)
+
+
+def read_report(input_file, time_offset=0.0, measuretype="CPU", by_index=True):
+    """
+    Return (rows of usr + sys utilization of intervals, time axis) from mpstat
+    text or JSON output in input_file. Values are placed by CPU numbers when
+    by_index is set, otherwise in order of lines and empty intervals are left out.
+    """
+    input_file = open_text(input_file)
+    raw = input_file.buffer
+    if raw.peek(READ_SIZE).lstrip().startswith(b"{"):
+        start_date, times, rows, counts = read_json_report(input_file, measuretype, by_index)
+    else:
+        start_date, times, rows, counts = read_text_report(raw, measuretype, by_index)
+
+    time_axis = interval_times(times, start_date, time_offset)
+    if not by_index:
+        kept = counts > 0
+        rows = rows[kept]
+        time_axis = [timestamp for timestamp, keep in zip(time_axis, kept) if keep]
+    return rows, time_axis
 
-    return cpu_values, time_axis
+
+def process_report(input_file, time_offset=0.0):
+    return read_report(input_file, time_offset)
 
 
 def process_dual_report(input_file, time_offset=0.0, measuretype="CPU"):
-    cpus_count = 0
-    time_axis = []
-    cpu_values = []
-    differences = []
-    imbalances = []
+    return read_report(input_file, time_offset, measuretype, by_index=False)
 
-    # Get CPUs count and start date
-    reg_exp=re.compile(r".*\)\s+(\d+/\d+/\d+)\s+_.*\((\d+) CPU\).*")
 
-    line = input_file.readline()  # read first data line
-    match = reg_exp.findall(line)
-    if not match:
-        print("Wrong mpstat header")
-        exit(1)
+def init_worker():
+    """Draw images without window in worker processes."""
+    plt.switch_backend('agg')
 
-    start_date = datetime.strptime(match[0][0], "%m/%d/%y").date()
 
-    input_file.readline()  # skip first empty line
-    data = input_file.readline().split()  # read first data line
+def read_file(file_name, *parameters):
+    """Return result of read_report of file_name opened in worker process."""
+    with open(file_name, 'r') as input_file:
+        return read_report(input_file, *parameters)
 
-    if time_offset:
-        curr_time = datetime.combine(start_date,
-            datetime.strptime(data[0], "%H:%M:%S").time())
-    else:
-        curr_time = datetime.combine(start_date,
-            datetime.strptime(data[0], "%H:%M:%S").time())
-        time_offset = curr_time.timestamp()
 
-    time_axis = []
-    row = []
+def submit_read(pool, input_file, *parameters):
+    """Submit parsing of input_file to pool, standard input can't be read by worker processes."""
+    if input_file is sys.stdin:
+        future = Future()
+        future.set_result(read_report(input_file, *parameters))
+        return future
+    return pool.submit(read_file, input_file.name, *parameters)
 
-    for line in input_file:
-        data = line.split()
-        if not data:
-            if row:
-                cpu_values.append(row)
-                time_axis.append(curr_time.timestamp() - time_offset)
-                row = []
-            continue
-        if data[0] == "Average:":
-            break  # end of file
-        if data[1] == measuretype:  # Time when measure started
-            last_time = curr_time
-            curr_time = datetime.combine(start_date,
-                datetime.strptime(data[0], "%H:%M:%S").time())
-            if curr_time.hour < last_time.hour:
-                start_date += timedelta(days=1)
-                curr_time += timedelta(days=1)
-            continue
-        if data[1] == "all":
-            continue
-        row.append(float(data[2]) + float(data[4]))  # usr + sys values
 
-    return cpu_values, time_axis
+def read_reports(pool, input_files, *parameters):
+    """Return results of read_report of input_files parsed in parallel."""
+    futures = [submit_read(pool, f, *parameters) for f in input_files]
+    return [future.result() for future in futures]
+
 
+def draw_group(cpu_values, time_axis, file_names, image_file, numa_cpus):
+    """Draw group of files to image_file in worker process. Return number of samples."""
+    draw_reports(cpu_values, time_axis, file_names, image_file, numa_cpus)
+    return sum(len(ta) for ta in time_axis)
 
-def create_multiple(input_files, lscpu_file):
+
+def create_multiple(input_files, lscpu_file, timer, jobs=None):
+    """
+    Draw images of groups of files with the same name before 'loop'. Files
+    are parsed in worker processes in order of groups and each complete
+    group is drawn by another worker. At most jobs tasks are submitted at
+    once, so only few groups wait in memory of the main process.
+    """
     numa_cpus = {}
     if lscpu_file:
         numa_cpus = read_nodes(lscpu_file)
 
-    cpu_values = {}
-    time_axis = {}
-    file_names = {}
-
+    groups = {}
     for f in input_files:
         key = f.name.rpartition("loop")[0].rstrip(".")
-        mv, ta = process_report(f, 0)
-        cpu_values.setdefault(key, []).append(mv)
-        time_axis.setdefault(key, []).append(ta)
-        file_names.setdefault(key, []).append(os.path.basename(f.name))
-
-    for key in cpu_values.keys():
-        print("Drawing " + key)
-        draw_reports(cpu_values[key], time_axis[key], file_names[key],
-                     key + ".png", numa_cpus)
+        groups.setdefault(key, []).append(f)
+    files = [(key, index, f) for key, group in groups.items() for index, f in enumerate(group)]
+    parsed = {key: [None] * len(group) for key, group in groups.items()}
+    remaining = {key: len(group) for key, group in groups.items()}
+
+    jobs = jobs or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=min(jobs, len(files)), initializer=init_worker) as pool:
+        running = {}
+        position = 0
+        while position < len(files) or running:
+            while position < len(files) and len(running) < jobs:
+                key, index, f = files[position]
+                running[submit_read(pool, f, 0)] = (key, index)
+                position += 1
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                key, index = running.pop(future)
+                if index is None:
+                    timer.count("samples", future.result())
+                    continue
+                parsed[key][index] = future.result()
+                remaining[key] -= 1
+                if remaining[key]:
+                    continue
+                # Parsed data of the group are passed to drawing worker and dropped here
+                results = parsed.pop(key)
+                print("Drawing " + key)
+                file_names = [os.path.basename(f.name) for f in groups[key]]
+                future = pool.submit(draw_group, [mv for mv, _ in results], [ta for _, ta in results],
+                                     file_names, key + ".png", numa_cpus)
+                running[future] = (key, None)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Create heatmaps from multiple mpstat data"
+        " (text or JSON output of mpstat -o JSON)"
         " with optional alignment to system uptime and reordering by NUMA nodes.")
     parser.add_argument("input_file", nargs="+", type=argparse.FileType('r'), default=sys.stdin)
     parser.add_argument("--image-file", type=str, default=None,
@@ -334,14 +511,23 @@ if __name__ == '__main__':
     parser.add_argument('--multiple', dest='multiple', action='store_true', default=False,
                         help="Create multiple outputs grouping files by names before 'loop'")
     parser.add_argument("--title", type=str, default=None, help="Future title")
+    parser.add_argument("--jobs", default=None, type=int,
+                        help="Number of worker processes parsing files and drawing groups of --multiple, "
+                             "defaults to number of CPUs")
+    parser.add_argument("--profile", type=str, default=None,
+                        help="Write wall and CPU time of phases and peak memory to JSON file")
 
     try:
         args = parser.parse_args()
     except SystemExit:
         sys.exit(1)
 
+    timer = PhaseTimer()
     if args.multiple:
-        create_multiple(args.input_file, args.lscpu_file)
+        with timer.phase("read and draw"):
+            create_multiple(args.input_file, args.lscpu_file, timer, args.jobs)
+        if args.profile:
+            timer.write_profile(args.profile, files=len(args.input_file))
         sys.exit()
 
     numa_cpus = {}
@@ -353,29 +539,46 @@ if __name__ == '__main__':
     time_axis = []
     file_names = []
 
+    jobs = min(args.jobs or os.cpu_count() or 1, len(args.input_file))
     if not args.dual:
-        for f in args.input_file:
-            mv, ta = process_report(f, args.time_offset)
+        with timer.phase("read"):
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                results = read_reports(pool, args.input_file, args.time_offset)
+        for f, (mv, ta) in zip(args.input_file, results):
+            timer.count("samples", len(ta))
             cpu_values.append(mv)
             time_axis.append(ta)
             file_names.append(os.path.basename(f.name))
 
-        draw_reports(cpu_values, time_axis, file_names, args.image_file, numa_cpus)
+        with timer.phase("draw"):
+            draw_reports(cpu_values, time_axis, file_names, args.image_file, numa_cpus)
     else:
         if len(args.input_file) % 2 != 0:
             print("Number of files for dual graphs must be even.")
             sys.exit(1)
 
-        for i in range(len(args.input_file) // 2):
-            cpu_v, ta = process_dual_report(args.input_file[i], args.time_offset, "CPU")
-            numa_v, ta2 = process_dual_report(args.input_file[i + len(args.input_file) // 2], args.time_offset, "NODE")
+        half = len(args.input_file) // 2
+        with timer.phase("read"):
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                cpu_futures = [submit_read(pool, f, args.time_offset, "CPU", False)
+                               for f in args.input_file[:half]]
+                numa_futures = [submit_read(pool, f, args.time_offset, "NODE", False)
+                                for f in args.input_file[half:]]
+                results = [(cpu.result(), numa.result()) for cpu, numa in zip(cpu_futures, numa_futures)]
+
+        for i, ((cpu_v, ta), (numa_v, ta2)) in enumerate(results):
             if len(ta) != len(ta2):
-                print("Files", args.input_file[i], "and", args.input_file[i + len(args.input_file) // 2],
+                print("Files", args.input_file[i], "and", args.input_file[i + half],
                       "have different number of records.")
                 continue
             cpu_values.append(cpu_v)
             numa_values.append(numa_v)
             time_axis.append(ta)
             file_names.append(os.path.basename(args.input_file[i].name))
+            timer.count("samples", len(ta))
+
+        with timer.phase("draw"):
+            draw_dual_reports(cpu_values, numa_values, time_axis, file_names, args.image_file, numa_cpus)
 
-        draw_dual_reports(cpu_values, numa_values, time_axis, file_names, args.image_file, numa_cpus)
+    if args.profile:
+        timer.write_profile(args.profile, files=len(args.input_file))
@@ -21,19 +21,32 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 import argparse
+import itertools
+import json
+import os
 import sys
-import re
+import tempfile
+import time
 
 import numpy as np
-# import matplotlib
-# matplotlib.use('agg')  # For machines without tkinter
-import matplotlib.pyplot as plt
-from matplotlib.colors import ListedColormap, BoundaryNorm
-from matplotlib import collections as mc
-from matplotlib.ticker import MultipleLocator
 
+from nr_running import read_topology, read_trace, read_trace_window, TraceChecker, PhaseTimer, AGGREGATES, NS_PER_SEC, CPU_GROUPS
+from nr_running import cpu_groups, group_cpus, node_starts
+from nr_running import open_trace, read_chunks, iter_event_chunks, EventWindow, ImbalanceDetector, CPUS_RE, decode_line
+from nr_running import TimeStatistics, print_statistics, StepAggregator, EventSpill, parse_size, chunk_size_for
+from nr_running import LevelOfDetail
+from render import render_report, HEATMAP_COLORS
 
-def draw_report(title, time_axis, map_values, differences, imbalances, sums, image_file=None, numa_cpus={}):
+FOLLOW_CHUNK_SIZE = 1 << 16
+FIGURE_SIZE = (20, 10)
+DPI = 100
+HEATMAP_LEFT = 0.05
+HEATMAP_RIGHT = 0.9
+MAX_CPU_TICKS = 64  # more CPUs are labeled by multiples of a step
+
+
+def heatmap_rows(map_values, numa_cpus={}):
+    """Return rows of heat map for pcolormesh from matrix with a row for each time."""
     # Transpose heat map data to right axes
     map_values = np.array(map_values)[:-1, :].transpose()
 
@@ -45,218 +58,412 @@ def draw_report(title, time_axis, map_values, differences, imbalances, sums, ima
         map_values = map_values[new_order]
 
     # Add blank row to correctly plot all rows with data
-    map_values = np.vstack((map_values, np.zeros(map_values.shape[1])))
-
-    cmap = ListedColormap(['#000000', '#305090', '#40b080', '#f0e020', '#f04010'])
-    boundaries = [-0.5, 0.5, 1.5, 2.5, 3.5, 4.5]
-    norm = BoundaryNorm(boundaries, cmap.N, clip=True)
-
-    fig, axs = plt.subplots(nrows=3, ncols=1, gridspec_kw=dict(height_ratios=[4, 1, 2]),
-                            sharex=True, figsize=(20, 10))  # , constrained_layout=True)
-    fig.subplots_adjust(hspace=0.05)
-
-    # Draw the main heat map
-    x_grid, y_grid = np.meshgrid(time_axis, range(len(map_values)))
-    mesh = axs[0].pcolormesh(x_grid, y_grid, map_values, vmin=0, vmax=4, cmap=cmap, norm=norm)
-
-    axs[0].set_xlim(time_axis[0], time_axis[-1])
-    axs[0].set_ylim([0, map_values.shape[0] - 1])
-
-    # Create colorbar
-    cbar = fig.colorbar(mesh, cax=plt.axes([0.95, 0.05, 0.02, 0.9]),
-                        extend='max', ticks=range(5))
-    cbar.ax.set_yticklabels(['0', '1', '2', '3', '4+'])
-    cbar.ax.set_ylabel("Number of tasks on CPU core")
-    plt.subplots_adjust(bottom=0.05, right=0.9, top=0.95, left=0.05)
-
-    # Draw line with differences
-    axs[1].step(time_axis, differences, where='post', color='black', alpha=0.8)
-
-    # Draw imbalances
-    for i in imbalances:
-        axs[1].plot(i[0][0], i[0][1], 'rx')
-    lc = mc.LineCollection(imbalances,
-                           colors=np.tile((1, 0, 0, 1), (len(imbalances), 1)),
-                           linewidths=2)
-    axs[1].add_collection(lc)
-
-    # Draw line with sums
-    axs[2].step(time_axis, sums, where='post', color='black', alpha=0.8)
-
-    axs[0].set_ylabel("CPUs")
-    axs[1].set_ylabel("Max difference")
-    axs[2].set_ylabel("Sum of tasks")
-    axs[2].set_xlabel("Timestamp (seconds)")
-
-    axs[1].set_ylim(bottom=0)
-    axs[1].grid()
-    axs[2].set_ylim(bottom=0)
-    axs[2].grid()
-
-    # Separate CPUs with lines by NUMA nodes
-    plt.sca(axs[0])
-    if numa_cpus:
-        axs[0].grid(True, which='major', axis='y', linestyle='--', color='w')
-        axs[0].yaxis.set_minor_locator(MultipleLocator(1))
-        plt.yticks(range(0, map_values.shape[0] - 1, len(numa_cpus[0])),
-                   map(lambda x: "Node " + str(x), range(len(numa_cpus.keys()))))
-    else:
-        axs[0].set_yticks(range(map_values.shape[0] - 1))
-
-    plt.title(title)
+    return np.vstack((map_values, np.zeros(map_values.shape[1])))
+
+
+def follow_zoom(fig, ax, mesh, lines, view, numa_cpus={}):
+    """
+    Redraw heat map and lines of shown figure with data of view whenever
+    limits of time axis change, so they have bins of screen pixels.
+    """
+    artists = {"mesh": mesh}
+
+    def redraw(ax):
+        start, end = ax.get_xlim()
+        bins = max(1, int(ax.get_window_extent().width))
+        time_axis, map_values, differences, sums = view(start, end, bins)
+        rows = heatmap_rows(map_values, numa_cpus)
+        artists["mesh"].remove()
+        artists["mesh"] = ax.pcolorfast(time_axis, np.arange(len(rows) + 1) - 0.5, rows,
+                                        cmap=mesh.get_cmap(), norm=mesh.norm)
+        for line, values in zip(lines, (differences, sums)):
+            line.set_data(time_axis, values)
+        fig.canvas.draw_idle()
+
+    ax.callbacks.connect('xlim_changed', redraw)
+
+
+def draw_report(title, time_axis, map_values, differences, imbalances, sums, image_file=None, numa_cpus={},
+                timer=None, view=None):
+    """
+    Draw report with matplotlib to image_file or show it. Shown report is
+    redrawn by function view(start, end, bins) returning data like plot_data
+    when it's zoomed or panned.
+    """
+    timer = timer or PhaseTimer()
+
+    # Matplotlib is imported only when it's used, PNG files are rendered without it
+    import matplotlib
+    if image_file:
+        matplotlib.use('agg')  # No window is needed for image files
+    import matplotlib.pyplot as plt
+    from matplotlib.colors import ListedColormap, BoundaryNorm
+    from matplotlib import collections as mc
+    from matplotlib.ticker import MultipleLocator
+
+    with timer.phase("heat map"):
+        map_values = heatmap_rows(map_values, numa_cpus)
+
+        cmap = ListedColormap(HEATMAP_COLORS)
+        boundaries = [-0.5, 0.5, 1.5, 2.5, 3.5, 4.5]
+        norm = BoundaryNorm(boundaries, cmap.N, clip=True)
+
+        fig, axs = plt.subplots(nrows=3, ncols=1, gridspec_kw=dict(height_ratios=[4, 1, 2]),
+                                sharex=True, figsize=FIGURE_SIZE, dpi=DPI)  # , constrained_layout=True)
+        fig.subplots_adjust(hspace=0.05)
+
+        # Draw the main heat map, columns of time bins are centered between bin edges
+        x_axis = time_axis
+        if len(time_axis) > map_values.shape[1]:
+            x_axis = (np.array(time_axis[:-1]) + time_axis[1:]) / 2
+        mesh = axs[0].pcolormesh(x_axis, range(len(map_values)), map_values, cmap=cmap, norm=norm,
+                                 rasterized=True)
+
+        axs[0].set_xlim(time_axis[0], time_axis[-1])
+        axs[0].set_ylim([0, map_values.shape[0] - 1])
+
+        # Create colorbar
+        cbar = fig.colorbar(mesh, cax=plt.axes([0.95, 0.05, 0.02, 0.9]),
+                            extend='max', ticks=range(5))
+        cbar.ax.set_yticklabels(['0', '1', '2', '3', '4+'])
+        cbar.ax.set_ylabel("Number of tasks on CPU core")
+        plt.subplots_adjust(bottom=0.05, right=HEATMAP_RIGHT, top=0.95, left=HEATMAP_LEFT)
+
+    with timer.phase("lines"):
+        # Draw line with differences
+        difference_line, = axs[1].step(time_axis, differences, where='post', color='black', alpha=0.8,
+                                       rasterized=True)
+
+        # Draw imbalances, all markers and lines are single artists
+        if imbalances:
+            axs[1].plot([i[0][0] for i in imbalances], [i[0][1] for i in imbalances], 'rx')
+        lc = mc.LineCollection(imbalances,
+                               colors=np.tile((1, 0, 0, 1), (len(imbalances), 1)),
+                               linewidths=2, rasterized=True)
+        axs[1].add_collection(lc)
+
+        # Draw line with sums
+        sum_line, = axs[2].step(time_axis, sums, where='post', color='black', alpha=0.8, rasterized=True)
+
+    with timer.phase("axes"):
+        axs[0].set_ylabel("CPUs")
+        axs[1].set_ylabel("Max difference")
+        axs[2].set_ylabel("Sum of tasks")
+        axs[2].set_xlabel("Timestamp (seconds)")
+
+        axs[1].set_ylim(bottom=0)
+        axs[1].grid()
+        axs[2].set_ylim(bottom=0)
+        axs[2].grid()
+
+        # Separate CPUs with lines by NUMA nodes, which can have different sizes
+        plt.sca(axs[0])
+        cpus = map_values.shape[0] - 1
+        step = -(-cpus // MAX_CPU_TICKS)
+        if numa_cpus:
+            axs[0].grid(True, which='major', axis='y', linestyle='--', color='w')
+            axs[0].yaxis.set_minor_locator(MultipleLocator(step))
+            plt.yticks(node_starts(numa_cpus), ["Node " + str(node) for node in numa_cpus])
+        else:
+            axs[0].set_yticks(range(0, cpus, step))
+
+        plt.title(title)
 
     if image_file:
-        plt.savefig(image_file)
+        with timer.phase("save"):
+            plt.savefig(image_file)
+            plt.close(fig)
     else:
+        if view:
+            follow_zoom(fig, axs[0], mesh, (difference_line, sum_line), view, numa_cpus)
         plt.show()
 
 
-def read_nodes(lscpu_file):
-    numa_cpus = {}
-    NUMA_re = re.compile(r'NUMA.*CPU\(s\):')
-    for line in lscpu_file:
-        # Find number of CPUs and NUMA nodes:
-        if line[:7] == 'CPU(s):':
-            cpu_nb = int(line[7:])
-        elif line[:13] == 'NUMA node(s):':
-            nodes_nb = int(line[13:])
-
-        # Find NUMA nodes associated with CPUs:
-        elif NUMA_re.search(line):
-            words = line.split()
-            cpus = words[-1].split(',')
-            for cpu in cpus:
-                if '-' in cpu:
-                    w = cpu.split('-')
-                    for i in range(int(w[0]), int(w[1]) + 1):
-                        numa_cpus.setdefault(int(words[1][4:]), []).append(i)
-                else:
-                    numa_cpus.setdefault(int(words[1][4:]), []).append(int(cpu))
-
-    return numa_cpus
-
-
-def process_report(title, input_file, sampling, threshold, duration, image_file=None, numa_cpus={}):
-    time_axis = []
-    map_values = []
-    differences = []
-    imbalances = []
-    sums = []
-    counter = 0
-
-    reg_exp = re.compile(r"^cpus=(\d+)$")
-    line = input_file.readline()
-    line_count = 1
-    match = reg_exp.findall(line)
-    if match:
-        cpus_count = int(match[0])
+def heatmap_width():
+    """Return width of heat map in pixels of saved image."""
+    return int(FIGURE_SIZE[0] * DPI * (HEATMAP_RIGHT - HEATMAP_LEFT))
+
+
+def heatmap_height():
+    """Return approximate height of heat map in pixels of saved image."""
+    return int(FIGURE_SIZE[1] * DPI * 0.9 * 4 / 7)
+
+
+def plot_data(events, initial, sampling=None, bins=None, aggregate="max", detector=None, statistics=None,
+              lod=None):
+    """
+    Return time axis, heat map rows, differences and sums to be plotted.
+    Differences before each event are passed also to the optional
+    ImbalanceDetector, TimeStatistics and LevelOfDetail in the same pass
+    over events.
+    """
+    if sampling:
+        all_differences, all_sums = events.balance(initial)
+        if detector:
+            detector.update(events.seconds().tolist(), all_differences[:-1].tolist())
+        if statistics:
+            statistics.update(events, all_differences, all_sums)
+
+        # Store plotting data of every sampling-th event
+        sampled = np.arange(sampling - 1, len(events), sampling)
+        map_values = np.vstack((initial, events.state_rows(sampled, initial)))
+        time_axis = events.seconds(sampled).tolist()
+
+        # Differences and sums belong to rows of map_values without the last one
+        plotted = np.concatenate(([0], sampled[:-1] + 1))
+        differences = all_differences[plotted].tolist()
+        sums = all_sums[plotted].tolist()
+        return time_axis, map_values, differences, sums
+
+    # Aggregate data to time bins, events are processed by chunks when they don't fit in memory
+    edges = events.time_bins(bins or heatmap_width())
+    difference_steps = sum_steps = None
+    for chunk, chunk_differences, chunk_sums in events.balance_chunks(initial):
+        if difference_steps is None:
+            difference_steps = StepAggregator(edges, aggregate, chunk_differences[0], chunk_differences.dtype)
+            sum_steps = StepAggregator(edges, aggregate, chunk_sums[0], chunk_sums.dtype)
+        difference_steps.update(chunk.time, chunk_differences[1:])
+        sum_steps.update(chunk.time, chunk_sums[1:])
+        if detector:
+            detector.update(chunk.seconds().tolist(), chunk_differences[:-1].tolist())
+        if statistics:
+            statistics.update(chunk, chunk_differences, chunk_sums)
+        if lod:
+            lod.update(chunk, chunk_differences, chunk_sums)
+    if lod:
+        lod.finish()
+
+    # The last row is only closing the last bin
+    map_values = events.binned_rows(edges, initial, aggregate)
+    map_values = np.vstack((map_values, np.zeros_like(map_values[-1:])))
+    time_axis = (edges / NS_PER_SEC).tolist()
+    differences = difference_steps.result()
+    differences = np.append(differences, differences[-1]).tolist()
+    sums = sum_steps.result()
+    sums = np.append(sums, sums[-1]).tolist()
+    return time_axis, map_values, differences, sums
+
+
+def save_report(title, time_axis, map_values, differences, imbalances, sums, image_file=None, numa_cpus={},
+                renderer="raster", timer=None, groups=None, lod=None):
+    timer = timer or PhaseTimer()
+    view = None
+    if lod:
+        cpu_nodes = numa_cpus
+
+        def lod_view(start, end, bins):
+            time_axis, map_values, differences, sums = lod.view(start, end, bins)
+            if groups:
+                map_values = group_cpus(map_values, cpu_nodes, groups)[0]
+            return time_axis, map_values, differences, sums
+        view = lod_view
+    if groups:
+        # Rows of groups of CPUs are drawn instead of rows of CPUs
+        with timer.phase("heat map"):
+            map_values, numa_cpus = group_cpus(map_values, numa_cpus, groups)
+    if image_file and image_file.lower().endswith(".png") and renderer == "raster":
+        size = (FIGURE_SIZE[0] * DPI, FIGURE_SIZE[1] * DPI)
+        render_report(image_file, title, time_axis, map_values, differences, imbalances, sums, numa_cpus,
+                      size, HEATMAP_LEFT, HEATMAP_RIGHT, timer)
     else:
-        print("ERROR: Couldn't get number of CPUs from the trace file.")
-        print("       Unexpected trace file format. First line is expected to have form '{}'".format(reg_exp.pattern))
-        print("       Input line: '{}'".format(line.rstrip('\n')))
-        print("       Exiting")
-        sys.exit(1)
+        draw_report(title, time_axis, map_values, differences, imbalances, sums, image_file, numa_cpus, timer,
+                    view)
+
 
-    # For each line in trace report, row is NumPy array representing number of processes on each CPU
-    # -1 means no data yet
-    last_row = np.full(cpus_count, -1)
-    map_values.append(last_row)
-
-    point_time = 0
-
-    reg_exp = re.compile(r"^.*-(\d+).*\s(\d+[.]\d+): sched_update_nr_running: cpu=(\d+) change=([-]?\d+) nr_running=(\d+)")
-    for line in input_file:
-        line_count += 1
-        match = reg_exp.findall(line)
-
-        # Check the correct event
-        if not match:
-            if "sched_update_nr_running:" in line:
-                print("WARNING: Line number {} contains 'sched_update_nr_running:' string, but does not match findall regex '{}'!".format(line_count,reg_exp.pattern))
-                print(line, end='')
-            continue
-
-        pid = int(match[0][0])
-        point_time = float(match[0][1])
-        cpu = int(match[0][2])
-        change = int(match[0][3])
-        nr_running = int(match[0][4])
-
-        if last_row[cpu] == -1:
-        # First time we got data for this CPU. Compute previous value as nr_running - change
-        # and update all data already stored
-            for val in map_values:
-                val[cpu] = nr_running - change
-
-        row = np.copy(last_row)
-        row[cpu] = nr_running
-
-        # Store plotting data with optional sampling
-        counter += 1
-        if counter >= sampling:
-            counter = 0
-            map_values.append(row)
-            time_axis.append(point_time)
-        last_row = row
-
-    last_imbalance_start = 0
-
-    if len(time_axis) == 0:
+def process_report(title, events, sampling, threshold, duration, image_file=None, numa_cpus={}, checker=None,
+                   bins=None, aggregate="max", renderer="raster", timer=None, stats=False, stats_file=None,
+                   groups=None):
+    timer = timer or PhaseTimer()
+
+    if len(events) == 0:
         print("No sched_update_nr_running found. Exiting.")
         sys.exit(0)
 
-    # Second run to compute imbalances - process all rows from map_values
-    for i, time in enumerate(time_axis):
-        row_min = min(map_values[i])
-        row_max = max(map_values[i])
-        diff = row_max - row_min
-
-        # Check the start of imbalance
-        if diff >= threshold and last_imbalance_start == 0:
-            last_imbalance_start = time
-        if diff < threshold and last_imbalance_start != 0:
-            # Print and store long imbalances
-            if (time - last_imbalance_start) >= duration:
-                imbalances.append([(last_imbalance_start, threshold),
-                                   (time, threshold)])
-                print(f"Imbalance from timestamp {last_imbalance_start}"
-                      f" lasting {time - last_imbalance_start} seconds")
-            last_imbalance_start = 0
-
-        differences.append(diff)
-        sums.append(sum(map_values[i]))
-
-    # Check for unreported imbalance lasting to the very end of input
-    if last_imbalance_start != 0 \
-       and (time_axis[-1] - last_imbalance_start) >= duration:
-        imbalances.append([(last_imbalance_start, threshold),
-                           (time_axis[-1], threshold)])
-        print(f"Imbalance from timestamp {last_imbalance_start}"
-              f" lasting {time_axis[-1] - last_imbalance_start} seconds")
+    # Compute imbalances from all events, the difference before each event lasts until it
+    detector = ImbalanceDetector(threshold, duration)
+
+    with timer.phase("aggregate"):
+        # For each plotted column, row is NumPy array representing number of processes on each CPU
+        # The first row is computed as nr_running - change from the first event of each CPU
+        # -1 means no data for the CPU at all
+        initial = events.initial_row()
+        statistics = TimeStatistics(events, initial, threshold) if stats or stats_file else None
+        # Shown heat map is redrawn from levels of detail when it's zoomed, events in files are too large
+        lod = None
+        if not image_file and not sampling and events.chunk_size is None:
+            lod = LevelOfDetail(events, initial, aggregate, bins or heatmap_width())
+        time_axis, map_values, differences, sums = plot_data(events, initial, sampling, bins, aggregate,
+                                                             detector, statistics, lod)
+
+    detector.finish()
+    imbalances = detector.imbalances
+    timer.set("matrix", list(np.shape(map_values)))
+    timer.set("imbalances", len(imbalances))
 
     if not imbalances:
         print("No imbalance found")
 
-    draw_report(title, time_axis, map_values, differences, imbalances, sums, image_file, numa_cpus)
+    if checker:
+        with timer.phase("utilization"):
+            checker.finish(events)
+            checker.print_tables(numa_cpus)
+
+    if statistics:
+        statistics = statistics.finish(imbalances)
+        if stats:
+            print_statistics(statistics)
+        if stats_file:
+            json.dump(statistics, stats_file, indent=2)
+            stats_file.write("\n")
+
+    save_report(title, time_axis, map_values, differences, imbalances, sums, image_file, numa_cpus,
+                renderer, timer, groups, lod)
     return time_axis, map_values, differences, imbalances
 
 
+def refresh_report(title, window, detector, image_file, numa_cpus={}, bins=None, aggregate="max",
+                   renderer="raster", groups=None):
+    """Draw report of events in window to image_file, replacing it at once."""
+    events = window.events()
+    if len(events) == 0:
+        return
+    time_axis, map_values, differences, sums = plot_data(events, window.start_row, None, bins, aggregate)
+    imbalances = [i for i in detector.imbalances if i[1][0] >= time_axis[0]]
+
+    # Viewers of the image never see partially written file
+    base, extension = os.path.splitext(image_file)
+    temporary = base + ".tmp" + extension
+    save_report(title, time_axis, map_values, differences, imbalances, sums, temporary, numa_cpus, renderer,
+                groups=groups)
+    os.replace(temporary, image_file)
+
+
+def follow_report(title, input_file, threshold, duration, image_file=None, numa_cpus={}, window=60.0,
+                  refresh=5.0, cpus_count=None, bins=None, aggregate="max", renderer="raster", groups=None,
+                  timer=None):
+    """
+    Read trace report while it's being written, print imbalances as they
+    start and end and redraw heat map of the last window seconds to
+    image_file every refresh seconds. Memory use doesn't grow with the input.
+    """
+    timer = timer or PhaseTimer()
+    stream = open_trace(input_file, mapped=False)
+    first = stream.readline()
+    match = CPUS_RE.findall(decode_line(first))
+    chunks = read_chunks(stream, FOLLOW_CHUNK_SIZE, follow=True)
+    if match:
+        cpus_count = int(match[0])
+    else:
+        # Output of trace_pipe has no header, the first line is an event
+        cpus_count = cpus_count or os.cpu_count()
+        chunks = itertools.chain([first], chunks)
+
+    timer.set("cpus", cpus_count)
+    events = EventWindow(cpus_count, int(window * NS_PER_SEC))
+    detector = ImbalanceDetector(threshold, duration, report_start=True)
+    last_refresh = time.monotonic()
+    warned = False
+
+    try:
+        for timestamp, cpu, change, nr_running in iter_event_chunks(chunks, line_count=1 if match else 0):
+            inside = cpu < cpus_count
+            if not inside.all():
+                if not warned:
+                    print("WARNING: Ignoring events of CPUs above {}, use --cpus to set the number of CPUs"
+                          .format(cpus_count - 1), flush=True)
+                    warned = True
+                timestamp, cpu, change, nr_running = (c[inside] for c in (timestamp, cpu, change, nr_running))
+            if not len(timestamp):
+                continue
+
+            timer.count("events", len(timestamp))
+            with timer.phase("aggregate"):
+                differences, _ = events.append(timestamp, cpu, change, nr_running)
+                detector.update((timestamp / NS_PER_SEC).tolist(), differences)
+
+                # Imbalances out of the window are not drawn anymore
+                window_start = events.columns[0][0] / NS_PER_SEC
+                detector.imbalances = [i for i in detector.imbalances if i[1][0] >= window_start]
+
+            if image_file and time.monotonic() - last_refresh >= refresh:
+                with timer.phase("refresh"):
+                    refresh_report(title, events, detector, image_file, numa_cpus, bins, aggregate, renderer,
+                                   groups)
+                last_refresh = time.monotonic()
+    except KeyboardInterrupt:
+        pass
+
+    detector.finish()
+    timer.set("imbalances", len(detector.imbalances))
+    if image_file:
+        with timer.phase("refresh"):
+            refresh_report(title, events, detector, image_file, numa_cpus, bins, aggregate, renderer, groups)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Create heatmap and find"
         " imbalances from recorded sched_update_nr_running events with trace-cmd.")
     parser.add_argument("input_file", nargs="?", type=argparse.FileType('r'), default=sys.stdin)
-    parser.add_argument("--sampling", default=1, type=int,
-                        help="Sampling of plotted data to reduce drawing point_time")
+    parser.add_argument("--sampling", default=None, type=int,
+                        help="Plot every SAMPLING-th event instead of aggregating events to time bins")
+    parser.add_argument("--bins", default=None, type=int,
+                        help="Number of time bins of heat map, defaults to its width in pixels")
+    parser.add_argument("--aggregate", default="max", choices=AGGREGATES,
+                        help="Value of CPU in time bin: maximum, time-weighted mean or last value")
     parser.add_argument("--threshold", default=2, type=int,
                         help="Minimal difference of process count considered as imbalance")
     parser.add_argument("--duration", default=0.05, type=float,
                         help="Minimal duration of imbalance worth reporting")
     parser.add_argument("--image-file", type=str, default=None,
                         help="Save plotted heatmap to file instead of showing")
+    parser.add_argument("--start", default=None, type=float,
+                        help="Process only events from this timestamp in seconds. With index file written"
+                        " next to the trace file by an earlier run, only this part of trace is parsed.")
+    parser.add_argument("--end", default=None, type=float,
+                        help="Process only events up to this timestamp in seconds")
+    parser.add_argument("--renderer", default="raster", choices=("raster", "matplotlib"),
+                        help="Renderer of PNG image files, raster draws them without matplotlib")
     parser.add_argument("--lscpu-file", type=argparse.FileType('r'), default=None,
-                        help="File with output of lscpu from observed machine")
+                        help="File with output of lscpu from observed machine, optionally followed by"
+                        " output of lscpu -p for --group-cpus core and llc")
+    parser.add_argument("--group-cpus", default="auto", choices=CPU_GROUPS,
+                        help="Draw a row of heat map for each CPU, core, last level cache or NUMA node with"
+                        " mean number of tasks on its CPUs. auto groups CPUs only when there are more of them"
+                        " than pixels of heat map.")
     parser.add_argument("--name", type=str, default=None,
                         help="Filename to be displayed in graph. Usefull when reading input from stdin.")
+    parser.add_argument("--info-file", type=argparse.FileType('w'), default=None,
+                        help="Also write utilization and consistency tables of check-nr-running.py"
+                        " to this file, computed in the same pass over the input")
+    parser.add_argument("--stats", action="store_true", default=False,
+                        help="Print time-weighted statistics of number of tasks and their differences")
+    parser.add_argument("--stats-file", type=argparse.FileType('w'), default=None,
+                        help="Write time-weighted statistics to this file as JSON")
+    parser.add_argument("--render-times", action="store_true", default=False,
+                        help="Print time spent in phases of reading and drawing to stderr")
+    parser.add_argument("--profile", type=str, default=None,
+                        help="Write wall and CPU time of phases, numbers of lines and events, events per second,"
+                        " peak memory and size of heat map to this file as JSON")
+    parser.add_argument("--progress", action="store_true", default=False,
+                        help="Periodically print read size of trace report with remaining time to stderr")
+    parser.add_argument("--follow", action="store_true", default=False,
+                        help="Read trace report or trace_pipe output while it's being written, print imbalances"
+                        " as they happen and periodically redraw IMAGE_FILE with the last WINDOW seconds")
+    parser.add_argument("--window", default=60.0, type=float,
+                        help="Seconds of trace kept in memory and drawn with --follow")
+    parser.add_argument("--refresh", default=5.0, type=float,
+                        help="Seconds between redraws of IMAGE_FILE with --follow")
+    parser.add_argument("--cpus", default=None, type=int,
+                        help="Number of CPUs with --follow when input has no 'cpus=N' line, defaults to local CPUs")
+    parser.add_argument("--max-memory", type=parse_size, default=None,
+                        help="Keep memory use under this size like 4G. Parsed events are stored in files"
+                        " of SCRATCH_DIR and processed by parts, the cache file isn't used.")
+    parser.add_argument("--scratch-dir", type=str, default=None,
+                        help="Directory for event files of --max-memory, defaults to system temporary directory")
+    parser.add_argument("--no-cache", dest="use_cache", action="store_false", default=True,
+                        help="Don't read or write the parsed events cache file and index file next to the trace file")
+    parser.add_argument("--rebuild-cache", action="store_true", default=False,
+                        help="Parse the trace file even if the cache file is up to date and rewrite the cache")
 
     try:
         args = parser.parse_args()
@@ -264,20 +471,54 @@ if __name__ == '__main__':
         sys.exit(1)
 
     numa_cpus = {}
+    topology = {}
     if args.lscpu_file:
-        numa_cpus = read_nodes(args.lscpu_file)
+        numa_cpus, topology = read_topology(args.lscpu_file)
+    groups = cpu_groups(numa_cpus, topology, args.group_cpus, heatmap_height())
 
     if args.name:
         title = "Plot of '" + args.name
     else:
         title = "Plot of '" + args.input_file.name
 
-    if args.input_file.name.endswith(".xz"):
-        args.input_file.close()
-        import lzma
-        with lzma.open(args.input_file.name, 'rt') as decompressed:
-            process_report(title, decompressed, args.sampling, args.threshold,
-                           args.duration, args.image_file, numa_cpus)
-    else:
-        process_report(title, args.input_file, args.sampling, args.threshold,
-                       args.duration, args.image_file, numa_cpus)
+    if args.follow:
+        if args.info_file or args.sampling or args.start is not None or args.end is not None:
+            print("ERROR: --info-file, --sampling, --start and --end can't be used with --follow")
+            sys.exit(1)
+        timer = PhaseTimer()
+        follow_report(title, args.input_file, args.threshold, args.duration, args.image_file, numa_cpus,
+                      args.window, args.refresh, args.cpus, args.bins, args.aggregate, args.renderer, groups,
+                      timer)
+        if args.profile:
+            timer.write_profile(args.profile, input=args.input_file.name)
+        sys.exit(0)
+
+    checker = None
+    if args.info_file:
+        checker = TraceChecker(args.info_file)
+
+    if args.max_memory and args.sampling:
+        print("ERROR: --sampling can't be used with --max-memory, heat map of time bins has to be used")
+        sys.exit(1)
+
+    spill = None
+    if args.max_memory:
+        # The directory is removed at exit
+        scratch_dir = tempfile.TemporaryDirectory(prefix="nr_running-", dir=args.scratch_dir)
+        spill = EventSpill(scratch_dir.name, chunk_size_for(args.max_memory))
+
+    timer = PhaseTimer()
+    with timer.phase("read"):
+        if args.start is not None or args.end is not None:
+            events = read_trace_window(args.input_file, args.start, args.end, checker, args.use_cache,
+                                       args.rebuild_cache, spill, timer, args.progress)
+        else:
+            events = read_trace(args.input_file, checker, args.use_cache, args.rebuild_cache, spill, timer,
+                                args.progress)
+    process_report(title, events, args.sampling, args.threshold,
+                   args.duration, args.image_file, numa_cpus, checker,
+                   args.bins, args.aggregate, args.renderer, timer, args.stats, args.stats_file, groups)
+    if args.render_times:
+        timer.report()
+    if args.profile:
+        timer.write_profile(args.profile)
@@ -50,7 +50,11 @@ function usage_msg() {
   printf " --parallel=MAX_JOBS    - Use GNU parallel to start parallel processing (one job per one input file).\n"
   printf "                          Specify maximum number of parallel jobs. Use 0 to use all available CPUs.\n"
   printf "                          Note: plotting large trace files consumes lots of memory.\n"
-  printf "                                Make sure there is enough RAM for parallel processing.\n"
+  printf "                                Make sure there is enough RAM for parallel processing or use --max-memory.\n"
+  printf " --max-memory=SIZE      - Limit memory used by processing of one file, e.g. 2G. Events are stored in temporary\n"
+  printf "                          files and processed by parts. Jobs of GNU parallel start when SIZE of memory is free.\n"
+  printf " --profile              - Write time of phases, throughput and peak memory of each file to JSON file, e.g.\n"
+  printf "                          'report.trace.profile.json' for 'report.trace.xz'.\n"
   printf " -h | --help            - This message\n\n"
   exit 1
 }
@@ -63,7 +67,9 @@ argDry=0;
 argLscpu=""
 argParallel=0
 argParallelJobs=0
-ARGLIST=$(getopt -o 'h' --long 'lscpu:,dry,parallel:,help' -n "$0" -- "$@") || usage_msg
+argMaxMemory=""
+argProfile=0
+ARGLIST=$(getopt -o 'h' --long 'lscpu:,dry,parallel:,max-memory:,profile,help' -n "$0" -- "$@") || usage_msg
 eval set -- "${ARGLIST}"
 while true
 do
@@ -71,6 +77,8 @@ do
   --lscpu)      shift; argLscpu=$1;;
   --dry)        argDry=1;;
   --parallel)   shift;argParallel=1;argParallelJobs=$1;;
+  --max-memory) shift; argMaxMemory=$1;;
+  --profile)    argProfile=1;;
   -h|--help)    usage_msg;;
   --)           shift; break;;
   *)            usage_msg;;
@@ -82,8 +90,10 @@ done
 [[ -z "$1" ]] && { echo "No kernel trace files to process provided."; usage_msg; }
 
 SCRIPT_DIR="$(dirname "${BASH_SOURCE[0]}")"
-#This is needed to avoid _tkinter.TclError: couldn't connect to display "localhost:10.0" type of error
-unset DISPLAY
+
+declare -a memOpt=()
+[[ -n "$argMaxMemory" ]] && memOpt=("--max-memory=$argMaxMemory")
+declare -a profileOpt=()
 
 if [[ "$argParallel" == "0" ]]; then
 
@@ -91,14 +101,13 @@ if [[ "$argParallel" == "0" ]]; then
     out_file="${file%.*}.png"
     out_file1="${file%.*}.info"
     echo "Processing file '$file', output in '${out_file}' and '${out_file1}'"
-    COMMAND=("${SCRIPT_DIR}/plot-nr-running.py" "--lscpu-file" "$argLscpu" "--image-file" "$out_file" "$file")
-    COMMAND1=("${SCRIPT_DIR}/check-nr-running.py" "--lscpu-file" "$argLscpu" "$file")
-    
+    profileOpt=()
+    (( argProfile == 1 )) && profileOpt=("--profile" "${file%.*}.profile.json")
+    COMMAND=("${SCRIPT_DIR}/plot-nr-running.py" "--lscpu-file" "$argLscpu" "--image-file" "$out_file" "--info-file" "$out_file1" "${memOpt[@]}" "${profileOpt[@]}" "$file")
+
     if [[ "$argDry" == "1" ]]; then
       printf "'%s' " "${COMMAND[@]}"
       echo
-      printf "'%s' " "${COMMAND1[@]}"
-      printf " > '%s\n'" "$out_file1"
       continue
     fi
 
@@ -109,28 +118,15 @@ if [[ "$argParallel" == "0" ]]; then
       echo "Failed to process ${file}. The command was:"
       printf "%s\n" "${COMMAND[*]}"
     fi
-
-    "${COMMAND1[@]}" > "$out_file1"
-    ret_code=$?
-
-    if [[ "$ret_code" -ne 0 ]]; then
-      echo "Failed to process ${file}. The command was:"
-      printf "%s" "${COMMAND1[*]}"
-      printf " > '%s\n'" "$out_file1"
-    fi
   done
 
 else
   command -v "parallel" >/dev/null 2>&1 || { echo >&2 "GNU parallel is required, but it's not installed."; exit 1; }
-  declare -a parOpt=("--verbose" "--memfree=4G")
+  declare -a parOpt=("--verbose" "--memfree=${argMaxMemory:-4G}")
   [[ "$argDry" == "1" ]] && parOpt+=("--dry-run")
   (( argParallelJobs > 0 )) && parOpt+=("--jobs=$argParallelJobs")
-  COMMAND=("parallel" "${parOpt[@]}" "${SCRIPT_DIR}/check-nr-running.py" "--lscpu=$argLscpu" "{}" ">" "{.}.info" ":::" "$@")
-  printf "'%s' " "${COMMAND[@]}"
-  echo
-  "${COMMAND[@]}"
-
-  COMMAND=("parallel" "${parOpt[@]}" "${SCRIPT_DIR}/plot-nr-running.py" "--lscpu=$argLscpu" "--image-file" "{.}.png" "{}" ">" "{.}.log" ":::" "$@")
+  (( argProfile == 1 )) && profileOpt=("--profile" "{.}.profile.json")
+  COMMAND=("parallel" "${parOpt[@]}" "${SCRIPT_DIR}/plot-nr-running.py" "--lscpu-file=$argLscpu" "--image-file" "{.}.png" "--info-file" "{.}.info" "${memOpt[@]}" "${profileOpt[@]}" "{}" ">" "{.}.log" ":::" "$@")
   printf "'%s' " "${COMMAND[@]}"
   echo
   "${COMMAND[@]}"
@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Search for trace reports with sched_update_nr_running events and process
+them by plot-nr-running.py in a pool of long-lived worker processes.
+Copyright (C) 2020  Jiri Vozar
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import contextlib
+import fnmatch
+import hashlib
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import time
+
+from prettytable import PrettyTable
+
+from nr_running import read_topology, read_trace, TraceChecker, PhaseTimer, EventSpill, AGGREGATES, PROFILE_SUFFIX
+from nr_running import estimate_memory, parse_size, chunk_size_for, cpu_groups, CPU_GROUPS
+
+MANIFEST_NAME = ".plot-nr-running.manifest.json"
+PROFILE_SUMMARY = "profile-summary.json"
+HASH_BLOCK = 1 << 20
+MB = 1 << 20
+
+# plot-nr-running.py module loaded once in each worker process
+plot = None
+
+
+def load_plot(renderer):
+    """Import plot-nr-running.py and plotting modules in worker process."""
+    global plot
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "plot-nr-running.py")
+    spec = importlib.util.spec_from_file_location("plot_nr_running", path)
+    plot = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(plot)
+    if renderer == "matplotlib":
+        import matplotlib
+        matplotlib.use('agg')
+        import matplotlib.pyplot  # noqa: F401
+
+
+def output_files(trace):
+    """Return names of image, info and log files of trace."""
+    base = os.path.splitext(trace)[0]
+    return base + ".png", base + ".info", base + ".log"
+
+
+def process_trace(trace, numa_cpus, topology, parameters, max_memory=None, scratch_dir=None, use_cache=True,
+                  profile=False):
+    """
+    Process trace like plot-nr-running.sh in worker, optionally writing its
+    profile to TRACE.profile.json. CPUs of NUMA nodes and topology read from
+    lscpu file are grouped by the group_cpus parameter. Return (status,
+    seconds).
+    """
+    image_file, info_file, log_file = output_files(trace)
+    start = time.perf_counter()
+    timer = PhaseTimer()
+    status = "ok"
+    with open(log_file, 'w') as log, open(info_file, 'w') as info, contextlib.redirect_stdout(log):
+        try:
+            spill = None
+            if max_memory:
+                scratch = tempfile.TemporaryDirectory(prefix="nr_running-", dir=scratch_dir)
+                spill = EventSpill(scratch.name, chunk_size_for(max_memory))
+            checker = TraceChecker(info)
+            groups = cpu_groups(numa_cpus, topology, parameters["group_cpus"], plot.heatmap_height())
+            with open(trace, 'r') as input_file, timer.phase("read"):
+                events = read_trace(input_file, checker, use_cache and not spill, False, spill, timer)
+            plot.process_report("Plot of '" + os.path.basename(trace), events, None,
+                                parameters["threshold"], parameters["duration"], image_file, numa_cpus,
+                                checker, parameters["bins"], parameters["aggregate"], parameters["renderer"],
+                                timer, groups=groups)
+        except SystemExit as e:
+            # Traces without events exit successfully without image
+            if e.code:
+                status = "failed with exit code {}".format(e.code)
+        except Exception as e:
+            print("ERROR: {}: {}".format(type(e).__name__, e))
+            status = "failed: {}".format(e)
+        finally:
+            if max_memory:
+                scratch.cleanup()
+    if profile:
+        # Peak memory is of the whole life of the worker
+        timer.write_profile(os.path.splitext(trace)[0] + PROFILE_SUFFIX, status=status)
+    return status, time.perf_counter() - start
+
+
+def find_traces(topdir, tracename, pattern=None):
+    """Yield sorted paths of files matching tracename under topdir, whose path contains pattern."""
+    for directory, dirs, files in os.walk(topdir):
+        dirs.sort()
+        for name in sorted(fnmatch.filter(files, tracename)):
+            path = os.path.join(directory, name)
+            if not pattern or fnmatch.fnmatch(path, "*" + pattern + "*"):
+                yield path
+
+
+def file_hash(path):
+    """Return SHA-256 hex digest of content of file."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def available_memory():
+    """Return available memory in bytes from /proc/meminfo, or total physical memory."""
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def summarize_profiles(topdir, pattern=None):
+    """
+    Sum profiles written by --profile in each directory under topdir and
+    write them to PROFILE_SUMMARY in the directory. Return dictionary of
+    summaries by directory.
+    """
+    directories = {}
+    for path in find_traces(topdir, "*" + PROFILE_SUFFIX, pattern):
+        directories.setdefault(os.path.dirname(path), []).append(path)
+
+    summaries = {}
+    for directory, paths in directories.items():
+        summary = {"files": len(paths), "wall": 0.0, "cpu": 0.0, "lines": 0, "events": 0, "max_rss": 0,
+                   "phases": {}, "slowest": None}
+        slowest = -1.0
+        for path in paths:
+            with open(path) as f:
+                profile = json.load(f)
+            for name in ("wall", "cpu", "lines", "events"):
+                summary[name] += profile.get(name, 0)
+            summary["max_rss"] = max(summary["max_rss"], profile.get("max_rss", 0))
+            for name, times in profile.get("phases", {}).items():
+                phase = summary["phases"].setdefault(name, {"wall": 0.0, "cpu": 0.0})
+                phase["wall"] += times["wall"]
+                phase["cpu"] += times["cpu"]
+            if profile.get("wall", 0) > slowest:
+                slowest = profile["wall"]
+                summary["slowest"] = os.path.basename(path)[:-len(PROFILE_SUFFIX)]
+        if summary["wall"]:
+            summary["events_per_second"] = summary["events"] / summary["wall"]
+        with open(os.path.join(directory, PROFILE_SUMMARY), 'w') as f:
+            json.dump(summary, f, indent=1)
+        summaries[directory] = summary
+    return summaries
+
+
+def print_summaries(summaries, out=None):
+    table = PrettyTable(["Directory", "Files", "Time (s)", "CPU (s)", "Events", "Events/s", "Peak RSS (MB)",
+                         "Slowest phase", "Slowest file"])
+    for directory, summary in summaries.items():
+        phases = summary["phases"]
+        slowest_phase = max(phases, key=lambda name: phases[name]["wall"]) if phases else "-"
+        table.add_row([directory, summary["files"], "{:.1f}".format(summary["wall"]),
+                       "{:.1f}".format(summary["cpu"]), summary["events"],
+                       "{:.0f}".format(summary.get("events_per_second", 0)), summary["max_rss"] >> 20,
+                       slowest_phase, summary["slowest"]])
+    print(table, file=out)
+
+
+def load_manifest(path):
+    """Return dictionary of processed traces stored in manifest file."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        print("WARNING: Manifest '{}' is damaged, all traces are processed again".format(path))
+        return {}
+
+
+def save_manifest(path, manifest):
+    """Write manifest file atomically, so interrupted run doesn't damage it."""
+    temporary = path + ".tmp"
+    with open(temporary, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(temporary, path)
+
+
+def new_pool(jobs, renderer):
+    return ProcessPoolExecutor(max_workers=jobs, initializer=load_plot, initargs=(renderer,))
+
+
+def run_tasks(tasks, jobs, budget, args, finished):
+    """
+    Run tasks (trace, numa_cpus, topology, parameters, memory) in pool of jobs workers,
+    starting them only while sum of their estimated memory fits the budget.
+    Traces which don't fit the budget alone are processed by parts. Call
+    finished(task, status, seconds) for each task in order of completion.
+    """
+    # Largest traces go first, the small ones fill the rest of the budget
+    pending = sorted(tasks, key=lambda task: task[4], reverse=True)
+    running = {}
+    used = 0
+    pool = new_pool(jobs, args.renderer)
+    try:
+        while pending or running:
+            for task in list(pending):
+                if len(running) >= jobs:
+                    break
+                memory = min(task[4], budget)
+                if running and used + memory > budget:
+                    continue
+                pending.remove(task)
+                max_memory = budget if task[4] > budget else None
+                if args.verbose:
+                    print("Starting '{}', estimated memory {} MB{}".format(
+                        task[0], task[4] // MB, ", processed by parts" if max_memory else ""))
+                future = pool.submit(process_trace, task[0], task[1], task[2], task[3], max_memory,
+                                     args.scratch_dir, args.use_cache, args.profile)
+                running[future] = task
+                used += memory
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            broken = False
+            for future in done:
+                task = running.pop(future)
+                used -= min(task[4], budget)
+                try:
+                    status, seconds = future.result()
+                except BrokenProcessPool:
+                    # Worker was killed, e.g. by OOM killer, other running tasks fail too
+                    status, seconds = "failed: worker process terminated", 0.0
+                    broken = True
+                finished(task, status, seconds)
+            if broken:
+                for future, task in running.items():
+                    finished(task, "failed: worker process terminated", 0.0)
+                running = {}
+                used = 0
+                pool.shutdown()
+                pool = new_pool(jobs, args.renderer)
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Search for trace reports with sched_update_nr_running events and "
+                    "process them by plot-nr-running.py in parallel. Writes TRACE.png, "
+                    "TRACE.info and TRACE.log next to each trace file.")
+    parser.add_argument("--topdir", type=str, default=".",
+                        help="Directory where search for trace files starts")
+    parser.add_argument("--pattern", type=str, default=None,
+                        help="Process only trace files with this pattern in their path")
+    parser.add_argument("--tracename", type=str, default="*.trace.xz",
+                        help="Pattern of names of trace files")
+    parser.add_argument("--lscpu", type=str, default="lscpu.txt",
+                        help="Name of lscpu file in directory of each trace file")
+    parser.add_argument("--new", action="store_true", default=False,
+                        help="Process only trace files, which weren't processed with the same "
+                             "content, lscpu file and parameters according to the manifest")
+    parser.add_argument("--manifest", type=str, default=None,
+                        help="Manifest of processed traces, defaults to " + MANIFEST_NAME + " in TOPDIR")
+    parser.add_argument("--dry", action="store_true", default=False,
+                        help="Only print trace files to process")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="Maximal number of parallel jobs, defaults to number of CPUs")
+    parser.add_argument("--max-memory", type=parse_size, default=None,
+                        help="Memory available to all jobs, e.g. 8G, defaults to available memory")
+    parser.add_argument("--scratch-dir", type=str, default=None,
+                        help="Directory for temporary files of traces processed by parts")
+    parser.add_argument("--threshold", default=2, type=int,
+                        help="Minimal difference of process count considered as imbalance")
+    parser.add_argument("--duration", default=0.05, type=float,
+                        help="Minimal duration of imbalance worth reporting")
+    parser.add_argument("--bins", default=None, type=int,
+                        help="Number of time bins of heat map, defaults to its width in pixels")
+    parser.add_argument("--aggregate", default="max", choices=AGGREGATES,
+                        help="Value of CPU in time bin: maximum, time-weighted mean or last value")
+    parser.add_argument("--renderer", default="raster", choices=("raster", "matplotlib"),
+                        help="Renderer of PNG image files, raster draws them without matplotlib")
+    parser.add_argument("--group-cpus", default="auto", choices=CPU_GROUPS,
+                        help="Draw a row of heat map for each CPU, core, last level cache or NUMA node like"
+                        " plot-nr-running.py. Cores and caches are read from output of lscpu -p following"
+                        " output of lscpu in the lscpu file.")
+    parser.add_argument("--no-cache", dest="use_cache", action="store_false", default=True,
+                        help="Don't read or write cache files of parsed events")
+    parser.add_argument("--profile", action="store_true", default=False,
+                        help="Write profile of each trace to TRACE" + PROFILE_SUFFIX + " and their sums to "
+                             + PROFILE_SUMMARY + " in each directory")
+    parser.add_argument("--summarize-profiles", action="store_true", default=False,
+                        help="Only sum existing profiles of traces, e.g. written by plot-nr-running.sh --profile, "
+                             "to " + PROFILE_SUMMARY + " in each directory")
+    parser.add_argument("-v", "--verbose", action="store_true", default=False,
+                        help="Verbose mode")
+
+    try:
+        args = parser.parse_args()
+    except SystemExit:
+        sys.exit(1)
+
+    if args.summarize_profiles:
+        print_summaries(summarize_profiles(args.topdir, args.pattern))
+        sys.exit(0)
+
+    manifest_file = args.manifest or os.path.join(args.topdir, MANIFEST_NAME)
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_file))
+    manifest = load_manifest(manifest_file)
+    parameters = {name: getattr(args, name)
+                  for name in ("threshold", "duration", "bins", "aggregate", "renderer", "group_cpus")}
+
+    # Read lscpu file once for all traces in directory
+    nodes = {}
+    tasks = []
+    skipped = []
+    for trace in find_traces(args.topdir, args.tracename, args.pattern):
+        directory = os.path.dirname(trace)
+        if directory not in nodes:
+            lscpu_file = os.path.join(directory, args.lscpu)
+            if os.path.exists(lscpu_file):
+                with open(lscpu_file) as f:
+                    nodes[directory] = read_topology(f) + (file_hash(lscpu_file),)
+            else:
+                print("WARNING: File '{}' not found, NUMA nodes aren't shown".format(lscpu_file))
+                nodes[directory] = ({}, {}, None)
+        numa_cpus, topology, lscpu_hash = nodes[directory]
+
+        key = os.path.relpath(os.path.abspath(trace), manifest_dir)
+        stat = os.stat(trace)
+        record = manifest.get(key, {})
+        # Hash of unchanged file isn't computed again
+        if record.get("size") == stat.st_size and record.get("mtime_ns") == stat.st_mtime_ns:
+            digest = record["sha256"]
+        else:
+            digest = file_hash(trace)
+        trace_parameters = dict(parameters, lscpu=lscpu_hash)
+        if (args.new and record.get("sha256") == digest and record.get("parameters") == trace_parameters
+                and record.get("status") == "ok" and all(map(os.path.exists, output_files(trace)[1:]))):
+            skipped.append(trace)
+            if args.verbose:
+                print("Excluding '{}' processed with the same content and parameters".format(trace))
+            continue
+        manifest[key] = {"sha256": digest, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+                         "parameters": trace_parameters, "status": "pending"}
+        tasks.append((trace, numa_cpus, topology, parameters, estimate_memory(trace), key))
+
+    jobs = args.jobs or os.cpu_count() or 1
+    budget = args.max_memory or available_memory()
+    print("Found {} trace files to process, {} already processed, {} jobs in {} MB of memory"
+          .format(len(tasks), len(skipped), jobs, budget // MB))
+    if args.dry:
+        for trace, _, _, _, memory, _ in tasks:
+            print("'{}' estimated memory {} MB{}".format(trace, memory // MB,
+                                                      ", processed by parts" if memory > budget else ""))
+        sys.exit(0)
+    if not tasks:
+        sys.exit(0)
+
+    failed = []
+
+    def finished(task, status, seconds):
+        trace, key = task[0], task[5]
+        print("{} '{}' in {:.1f} s".format("Processed" if status == "ok" else "ERROR: " + status + ",",
+                                            trace, seconds))
+        if status != "ok":
+            failed.append(trace)
+        manifest[key]["status"] = status
+        save_manifest(manifest_file, manifest)
+
+    try:
+        run_tasks(tasks, jobs, budget, args, finished)
+    except KeyboardInterrupt:
+        print("Interrupted")
+        sys.exit(1)
+
+    if args.profile:
+        print_summaries(summarize_profiles(args.topdir, args.pattern))
+    print("Successfully processed {} of {} trace files".format(len(tasks) - len(failed), len(tasks)))
+    if failed:
+        print("Failed trace files:")
+        for trace in failed:
+            print("'{}'".format(trace))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -61,13 +61,15 @@ function usage_msg() {
   printf "                          Specify maximum number of parallel jobs. Use 0 to use all available CPUs.\n"
   printf "                          Note: plotting large trace files consumes lots of memory.\n"
   printf "                                Make sure there is enough RAM for parallel processing.\n"
+  printf " --profile              - Write profile of each trace file to TRACE.profile.json and sum them to\n"
+  printf "                          profile-summary.json in each directory.\n"
   printf " -v | --verbose         - Verbose mode.\n"
   printf " -h | --help            - This message\n\n"
   exit 1
 }
 
-argVerbose=0; argNew=0; argDry=0; argLscpu="lscpu.txt"; argParallel=0; argParallelJobs=0; argTopdir="./"; argPattern=""; argTrace="*.trace.xz"
-ARGLIST=$(getopt -o 'vh' --long 'lscpu:,topdir:,pattern:,tracename:,new,dry,parallel:,verbose,help' -n "$0" -- "$@") || usage_msg
+argVerbose=0; argNew=0; argDry=0; argLscpu="lscpu.txt"; argParallel=0; argParallelJobs=0; argTopdir="./"; argPattern=""; argTrace="*.trace.xz"; argProfile=0
+ARGLIST=$(getopt -o 'vh' --long 'lscpu:,topdir:,pattern:,tracename:,new,dry,parallel:,profile,verbose,help' -n "$0" -- "$@") || usage_msg
 eval set -- "${ARGLIST}"
 while true
 do
@@ -79,6 +81,7 @@ do
   --new)        argNew=1;;
   --dry)        argDry=1;;
   --parallel)   shift;argParallel=1;argParallelJobs=$1;;
+  --profile)    argProfile=1;;
   --verbose)    argVerbose=1;;
   -h|--help)    usage_msg;;
   --)           shift; break;;
@@ -145,6 +148,7 @@ echo "========================================================================="
 PROCESS_COMMAND=("${SOURCE_DIR}/plot-nr-running.sh" "--lscpu" "$argLscpu")
 (( argDry == 1 )) && PROCESS_COMMAND+=("--dry")
 (( argParallel == 1 )) && PROCESS_COMMAND+=("--parallel" "$argParallelJobs")
+(( argProfile == 1 )) && PROCESS_COMMAND+=("--profile")
 printf "Command to be executed in each directory:\n"
 printf "%s " "${PROCESS_COMMAND[@]}"
 printf "\$(%s)\n" "${LOCAL_FIND[*]}"
@@ -197,6 +201,12 @@ for DIR in "${FOUND_DIRS[@]}"; do
   popd >/dev/null || { echo "Critical error. popd in $(pwd) has failed. Please report it to authors"; exit 1; }
 done
 
+if (( argProfile == 1 && argDry == 0 )); then
+  SUMMARY_COMMAND=("${SOURCE_DIR}/plot-nr-running_batch.py" "--summarize-profiles" "--topdir" "$argTopdir")
+  [[ -n "$argPattern" ]] && SUMMARY_COMMAND+=("--pattern" "$argPattern")
+  "${SUMMARY_COMMAND[@]}"
+fi
+
 if (( ${#OK_DIR[@]} > 0 )); then
   echo "Successfully processed trace files from following directories:"
   printf "'%s' " "${OK_DIR[@]}"
@@ -3,7 +3,10 @@
 
 import argparse
 from datetime import datetime
+import os
+import struct
 import sys
+import time
 
 import numpy as np
 # import matplotlib
@@ -12,6 +15,19 @@ import matplotlib.pyplot as plt
 from matplotlib.colors import BoundaryNorm, LinearSegmentedColormap
 from matplotlib.ticker import MultipleLocator
 
+from nr_running import read_nodes, node_starts, PhaseTimer
+from decompress import open_text
+
+MAX_CPU_TICKS = 64  # more CPUs are labeled by multiples of a step
+MULTIPLE_TASKS = 1000  # value of CPU running more sampled tasks
+
+# Binary log of sampler: magic, then frames of sample header and threads
+LOG_MAGIC = b"PSRLOG1\n"
+FRAME = struct.Struct("<dI")  # time of sample, number of threads
+THREAD_DTYPE = np.dtype([("tid", "<u4"), ("cpu", "<u2")])
+STAT_SIZE = 4096
+PROCESSOR_FIELD = 36  # 39th field of stat counted from state after command name
+
 
 def draw_report(map_values, time_axis, task_count, input_file,
                 image_file=None, numa_cpus={}):
@@ -54,15 +70,15 @@ def draw_report(map_values, time_axis, task_count, input_file,
     plt.ylabel("CPUs (grouped by NUMA nodes)")
     plt.xlabel("Time in seconds")
 
-    # Separate CPUs with lines by NUMA nodes
+    # Separate CPUs with lines by NUMA nodes, at most MAX_CPU_TICKS are labeled
+    step = -(-map_values.shape[0] // MAX_CPU_TICKS)
     if numa_cpus:
         ax.grid(True, which='major', axis='y', linestyle='--', color='k')
-        plt.yticks(range(0, map_values.shape[0] - 1, len(numa_cpus[0])),
-                   map(lambda x: "Node " + str(x),
-                       range(len(numa_cpus.keys()))))
-        ax.yaxis.set_minor_locator(MultipleLocator(1))
+        plt.yticks(node_starts(numa_cpus),
+                   ["Node " + str(node) for node in numa_cpus])
+        ax.yaxis.set_minor_locator(MultipleLocator(step))
     else:
-        plt.yticks(range(map_values.shape[0]))
+        plt.yticks(range(0, map_values.shape[0], step))
 
     plt.subplots_adjust(left=0.05, right=0.90, top=0.95, bottom=0.1)
 
@@ -80,33 +96,27 @@ def draw_report(map_values, time_axis, task_count, input_file,
         plt.show()
 
 
-def read_nodes(lscpu_file):
-    numa_cpus = {}
-    NUMA_re=re.compile(r'NUMA.*CPU\(s\):')
-    for line in lscpu_file:
-        # Find NUMA nodes associated with CPUs:
-        if line[:13] == 'NUMA node(s):':
-            continue
-        elif NUMA_re.search(line):
-            words = line.split()
-            cpus = words[-1].split(',')
-            for cpu in cpus:
-                if '-' in cpu:
-                    w = cpu.split('-')
-                    for i in range(int(w[0]), int(w[1]) + 1):
-                        numa_cpus.setdefault(int(words[1][4:]), []).append(i)
-                else:
-                    numa_cpus.setdefault(int(words[1][4:]),
-                                         []).append(int(cpu))
+def process_report(input_file, time_offset=0.0, image_file=None, numa_cpus={}, timer=None):
+    timer = timer or PhaseTimer()
+    cpus_count = max(np.concatenate(list(numa_cpus.values()))) + 1
 
-    return numa_cpus
+    stream = open_text(input_file)
+    with timer.phase("read"):
+        if stream.buffer.peek(len(LOG_MAGIC)).startswith(LOG_MAGIC):
+            map_values, time_axis, threads = read_log(stream.buffer.read(), cpus_count, time_offset)
+        else:
+            map_values, time_axis, threads = read_samples(stream, cpus_count, time_offset)
+    timer.set("samples", len(time_axis))
+    timer.set("threads", len(threads))
 
+    with timer.phase("draw"):
+        draw_report(map_values, time_axis, len(threads), input_file,
+                    image_file, numa_cpus)
 
-def process_report(input_file, time_offset=0.0, image_file=None, numa_cpus={}):
-    cpus_count = max(np.concatenate(list(numa_cpus.values()))) + 1
-    time_axis = []
-    map_values = []
 
+def read_samples(input_file, cpus_count, time_offset=0.0):
+    """Return (rows of map, time axis, threads) of ps samples."""
+    map_values = []
     time_axis = []
     row = np.zeros(cpus_count)
     threads = {}
@@ -145,12 +155,128 @@ def process_report(input_file, time_offset=0.0, image_file=None, numa_cpus={}):
         if row[psr] == 0:
             row[psr] = threads[lwp]
         else:
-            row[psr] = 1000  # Multiple tasks on single core
+            row[psr] = MULTIPLE_TASKS  # Multiple tasks on single core
 
     map_values.append(row)
-
-    draw_report(map_values, time_axis, len(threads), input_file,
-                image_file, numa_cpus)
+    return map_values, time_axis, threads
+
+
+def read_log(data, cpus_count, time_offset=0.0):
+    """
+    Return (rows of map, time axis, threads) of binary log of sampler like
+    read_samples. Threads are numbered in order of their first sample.
+    """
+    times = []
+    parts = []
+    position = len(LOG_MAGIC)
+    while position + FRAME.size <= len(data):
+        timestamp, count = FRAME.unpack_from(data, position)
+        position += FRAME.size
+        if position + count * THREAD_DTYPE.itemsize > len(data):
+            break  # sampler was killed while writing
+        parts.append(np.frombuffer(data, THREAD_DTYPE, count, position))
+        times.append(timestamp)
+        position += count * THREAD_DTYPE.itemsize
+
+    tasks = np.concatenate([np.zeros(0, THREAD_DTYPE)] + parts)
+    if len(tasks) and tasks["cpu"].max() >= cpus_count:
+        print("ERROR: Sampled CPU {} is missing in lscpu file".format(tasks["cpu"].max()))
+        sys.exit(1)
+    samples = np.repeat(np.arange(len(parts)), [len(part) for part in parts])
+    tids, first, inverse = np.unique(tasks["tid"], return_index=True, return_inverse=True)
+    order = np.argsort(first, kind="stable")
+    numbers = np.empty(len(tids), dtype=int)
+    numbers[order] = np.arange(1, len(tids) + 1)
+
+    cells = samples * cpus_count + tasks["cpu"]
+    map_values = np.zeros(len(parts) * cpus_count)
+    map_values[cells] = numbers[inverse]
+    map_values[np.bincount(cells, minlength=len(map_values)) > 1] = MULTIPLE_TASKS
+
+    if not time_offset and times:
+        time_offset = times[0]
+    time_axis = [timestamp - time_offset for timestamp in times]
+    threads = dict(zip(tids[order].tolist(), range(1, len(tids) + 1)))
+    return map_values.reshape(len(parts), cpus_count), time_axis, threads
+
+
+class TaskSampler:
+    """
+    Reader of CPUs of threads of processes from PROC_ROOT/PID/task/TID/stat.
+    Stat files stay open and are read again from the start in each sample,
+    only the task directories are listed to find new threads.
+    """
+
+    def __init__(self, pids, proc_root="/proc"):
+        self.task_dirs = [os.path.join(proc_root, str(pid), "task") for pid in pids]
+        self.files = {}  # thread ID: file descriptor of its stat file
+
+    def tasks(self):
+        """Return dictionary of thread IDs with their task directories."""
+        tasks = {}
+        for task_dir in self.task_dirs:
+            try:
+                names = os.listdir(task_dir)
+            except FileNotFoundError:
+                continue  # process exited
+            tasks.update((int(name), task_dir) for name in names if name.isdigit())
+        return tasks
+
+    def sample(self):
+        """Return list of (thread ID, CPU) of threads, which is empty when all processes exited."""
+        tasks = self.tasks()
+        for tid in self.files.keys() - tasks.keys():
+            os.close(self.files.pop(tid))
+
+        sample = []
+        for tid in sorted(tasks):
+            try:
+                if tid not in self.files:
+                    self.files[tid] = os.open(os.path.join(tasks[tid], str(tid), "stat"), os.O_RDONLY)
+                data = os.pread(self.files[tid], STAT_SIZE, 0)
+            except OSError:
+                continue  # thread exited since listing
+            # Command name in parentheses can contain spaces
+            fields = data[data.rfind(b")") + 2:].split()
+            if len(fields) > PROCESSOR_FIELD:
+                sample.append((tid, int(fields[PROCESSOR_FIELD])))
+        return sample
+
+    def close(self):
+        for fd in self.files.values():
+            os.close(fd)
+        self.files = {}
+
+
+def sample_tasks(pids, output, rate, duration=None, proc_root="/proc"):
+    """
+    Write CPUs of threads of processes pids sampled rate times per second
+    to binary log file output, until the processes exit, duration passes
+    or sampling is interrupted. Return number of samples.
+    """
+    sampler = TaskSampler(pids, proc_root)
+    period = 1.0 / rate
+    samples = 0
+    start = time.monotonic()
+    with open(output, 'wb') as f:
+        f.write(LOG_MAGIC)
+        try:
+            while duration is None or samples * period < duration:
+                timestamp = time.time()
+                sample = sampler.sample()
+                if not sample:
+                    break
+                f.write(FRAME.pack(timestamp, len(sample)))
+                f.write(np.array(sample, dtype=THREAD_DTYPE).tobytes())
+                samples += 1
+                delay = start + samples * period - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            sampler.close()
+    return samples
 
 
 if __name__ == '__main__':
@@ -169,12 +295,42 @@ if __name__ == '__main__':
     parser.add_argument("--time-offset", type=float, default=0,
                         help="Timestamp of system's boot"
                         " to align time axis to uptime")
+    parser.add_argument("--profile", type=str, default=None,
+                        help="Write wall and CPU time of phases and peak"
+                        " memory to JSON file")
+    parser.add_argument("--sample", type=int, nargs="+", default=None,
+                        metavar="PID",
+                        help="Instead of plotting, sample CPUs of threads of"
+                        " processes from proc file system to binary log"
+                        " --output, which is plotted like ps output")
+    parser.add_argument("--output", type=str, default=None,
+                        help="Binary log file written by --sample")
+    parser.add_argument("--rate", type=float, default=10,
+                        help="Samples per second of --sample")
+    parser.add_argument("--duration", type=float, default=None,
+                        help="Seconds of --sample, defaults to sampling until"
+                        " the processes exit or it's interrupted")
+    parser.add_argument("--proc-root", type=str, default="/proc",
+                        help="Directory of proc file system read by --sample")
 
     try:
         args = parser.parse_args()
     except SystemExit:
         sys.exit(1)
 
+    if args.sample:
+        if not args.output or args.rate <= 0:
+            print("Argument --sample requires --output and positive --rate.")
+            sys.exit(1)
+        samples = sample_tasks(args.sample, args.output, args.rate,
+                               args.duration, args.proc_root)
+        if not samples:
+            print("ERROR: No threads of processes {} found in '{}'".format(
+                " ".join(map(str, args.sample)), args.proc_root))
+            sys.exit(1)
+        print("Written {} samples to '{}'".format(samples, args.output))
+        sys.exit()
+
     numa_cpus = {}
     if args.lscpu_file:
         numa_cpus = read_nodes(args.lscpu_file)
@@ -182,5 +338,8 @@ if __name__ == '__main__':
         print("Argument --lscpu-file is required.")
         sys.exit(1)
 
+    timer = PhaseTimer()
     process_report(args.input_file, args.time_offset,
-                   args.image_file, numa_cpus)
+                   args.image_file, numa_cpus, timer)
+    if args.profile:
+        timer.write_profile(args.profile, input=args.input_file.name)
@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+
+"""
+Rendering of heat map reports directly to PNG files without matplotlib.
+Copyright (C) 2020  Jiri Vozar
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import math
+import struct
+import zlib
+
+import numpy as np
+
+from nr_running import PhaseTimer, aggregate_steps, node_starts
+
+# Colors of 0, 1, 2, 3 and 4+ tasks on CPU
+HEATMAP_COLORS = ['#000000', '#305090', '#40b080', '#f0e020', '#f04010']
+
+BLACK = (0, 0, 0, 255)
+LINE = (51, 51, 51, 255)  # black with alpha 0.8
+GRID = (176, 176, 176, 255)
+WHITE = (255, 255, 255, 255)
+RED = (255, 0, 0, 255)
+
+TEXT_SCALE = 2  # minimal scale of font, used up to the height of 1000 pixels
+TEXT_HEIGHT = 500  # pixels of image height per scale of font
+LABEL_GAP = 3  # space between vertical axis labels and tick labels per scale of font
+
+# 5x7 font of ASCII characters 32-126, one byte per column with the top row in the lowest bit
+FONT = bytes.fromhex(
+    "000000000000005f00000007000700147f147f14242a7f2a12231308646236495522500005030000001c2241000041221c00"
+    "082a1c2a0808083e080800503000000808080808006060000020100804023e5149453e00427f400042615149462141454b31"
+    "1814127f1027454545393c4a49493001710905033649494936064949291e0036360000005636000000081422411414141414"
+    "41221408000201510906324979413e7e1111117e7f494949363e414141227f4141221c7f494949417f090901013e41415132"
+    "7f0808087f00417f41002040413f017f081422417f404040407f0204027f7f0408107f3e4141413e7f090909063e4151215e"
+    "7f09192946464949493101017f01013f4040403f1f2040201f7f2018207f63140814630304780403615149454300007f4141"
+    "020408102041417f000004020102044040404040000102040020545454787f484444383844444420384444487f3854545418"
+    "087e090102081454543c7f0804047800447d40002040443d00007f10284400417f40007c041804787c080404783844444438"
+    "7c14141408081414187c7c080404084854545420043f4440203c4040207c1c2040201c3c4030403c44281028440c5050503c"
+    "4464544c44000836410000007f000000413608001008081008")
+
+
+def color_table(colors):
+    """Return lookup table with RGBA values of hex colors."""
+    return np.array([[int(c[i:i + 2], 16) for i in (1, 3, 5)] + [255] for c in colors], dtype=np.uint8)
+
+
+def glyphs(text):
+    """Return boolean bitmap of text written by 5x7 font."""
+    codes = np.frombuffer(text.encode('ascii', 'replace'), dtype=np.uint8).astype(int) - 32
+    codes[(codes < 0) | (codes > 94)] = ord('?') - 32
+    columns = np.frombuffer(FONT, dtype=np.uint8).reshape(95, 5)[codes]
+    columns = np.hstack((columns, np.zeros((len(codes), 1), dtype=np.uint8))).reshape(-1)[:-1]
+    return (columns[np.newaxis, :] >> np.arange(7)[:, np.newaxis]) & 1 == 1
+
+
+def write_png(file_name, pixels):
+    """Write RGBA pixel buffer to PNG file."""
+    height, width, _ = pixels.shape
+
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data))
+
+    # Every row starts with filter type byte 0 (no filter)
+    rows = np.hstack((np.zeros((height, 1), dtype=np.uint8), pixels.reshape(height, -1)))
+    with open(file_name, 'wb') as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)))
+        f.write(chunk(b"IDAT", zlib.compress(rows.tobytes(), 6)))
+        f.write(chunk(b"IEND", b""))
+
+
+def nice_ticks(low, high, count=10):
+    """Return round tick values between low and high."""
+    if high <= low:
+        return np.array([low])
+    step = (high - low) / count
+    magnitude = 10 ** math.floor(math.log10(step))
+    step = next(m * magnitude for m in (1, 2, 5, 10) if m * magnitude >= step)
+    return np.arange(math.ceil(low / step) * step, high + step * 1e-6, step)
+
+
+def tick_label(value):
+    return "{:g}".format(round(value, 9))
+
+
+class Canvas:
+    """RGBA pixel buffer with simple drawing of rectangles, masks and text."""
+
+    def __init__(self, width, height, scale=TEXT_SCALE):
+        self.width = width
+        self.height = height
+        self.scale = scale
+        self.pixels = np.full((height, width, 4), 255, dtype=np.uint8)
+
+    def rectangle(self, x0, y0, x1, y1, color):
+        self.pixels[max(y0, 0):max(y1, 0), max(x0, 0):max(x1, 0)] = color
+
+    def frame(self, x0, y0, x1, y1, color=BLACK):
+        self.rectangle(x0 - 1, y0 - 1, x1 + 1, y0, color)
+        self.rectangle(x0 - 1, y1, x1 + 1, y1 + 1, color)
+        self.rectangle(x0 - 1, y0, x0, y1, color)
+        self.rectangle(x1, y0, x1 + 1, y1, color)
+
+    def mask(self, x, y, mask, color):
+        """Paint pixels of boolean mask placed with its top left corner at x, y."""
+        height, width = mask.shape
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + width, self.width), min(y + height, self.height)
+        if x0 >= x1 or y0 >= y1:
+            return
+        self.pixels[y0:y1, x0:x1][mask[y0 - y:y1 - y, x0 - x:x1 - x]] = color
+
+    def text_size(self, text, scale=None):
+        """Return width and height of horizontal text in pixels."""
+        scale = scale or self.scale
+        return (6 * len(text) - 1) * scale, 7 * scale
+
+    def fit_text(self, texts, length):
+        """
+        Return the first of alternative texts and the largest scale, with
+        which it's at most length pixels long. The last text with the
+        smallest scale is returned when none fits.
+        """
+        for scale in range(self.scale, 0, -1):
+            for text in texts:
+                if self.text_size(text, scale)[0] <= length:
+                    return text, scale
+        return texts[-1], 1
+
+    def text(self, x, y, text, halign="left", valign="top", vertical=False, color=BLACK, scale=None):
+        scale = scale or self.scale
+        bitmap = glyphs(text).repeat(scale, axis=0).repeat(scale, axis=1)
+        if vertical:
+            bitmap = np.rot90(bitmap)
+        height, width = bitmap.shape
+        x -= {"left": 0, "center": width // 2, "right": width}[halign]
+        y -= {"top": 0, "center": height // 2, "bottom": height}[valign]
+        self.mask(x, y, bitmap, color)
+
+    def save(self, file_name):
+        write_png(file_name, self.pixels)
+
+
+class Panel:
+    """Rectangle of canvas with linear mapping of time and values to pixels."""
+
+    def __init__(self, canvas, x0, y0, x1, y1, time_range, value_range):
+        self.canvas = canvas
+        self.x0, self.y0, self.x1, self.y1 = x0, y0, x1, y1
+        self.time_range = time_range
+        self.value_range = value_range
+
+    def x(self, time):
+        low, high = self.time_range
+        return np.round(self.x0 + (np.asarray(time) - low) / (high - low) * (self.x1 - self.x0)).astype(int)
+
+    def y(self, value):
+        low, high = self.value_range
+        return np.round(self.y1 - 1 - (np.asarray(value) - low) / (high - low) * (self.y1 - self.y0 - 1)).astype(int)
+
+    def pixel_edges(self):
+        """Return times of borders between pixel columns."""
+        return np.linspace(self.time_range[0], self.time_range[1], self.x1 - self.x0 + 1)
+
+    def time_grid(self, ticks, labels=False):
+        for tick in ticks:
+            x = int(self.x(tick))
+            if labels:
+                self.canvas.rectangle(x, self.y1, x + 1, self.y1 + 5, BLACK)
+                self.canvas.text(x, self.y1 + 8, tick_label(tick), halign="center")
+            if self.value_range[1] > self.value_range[0]:
+                self.canvas.rectangle(x, self.y0, x + 1, self.y1, GRID)
+
+    def value_grid(self, ticks, top, bottom):
+        """
+        Draw grid lines with tick labels, which are left out when they don't
+        fit between pixel rows top and bottom. Return width of the widest
+        label and the row below the lowest one.
+        """
+        widest, lowest = 0, top
+        for tick in ticks:
+            y = int(self.y(tick))
+            self.canvas.rectangle(self.x0, y, self.x1, y + 1, GRID)
+            self.canvas.rectangle(self.x0 - 5, y, self.x0, y + 1, BLACK)
+            width, height = self.canvas.text_size(tick_label(tick))
+            if top <= y - height // 2 and y - height // 2 + height <= bottom:
+                self.canvas.text(self.x0 - 8, y, tick_label(tick), halign="right", valign="center")
+                widest, lowest = max(widest, width), max(lowest, y - height // 2 + height)
+        return widest, lowest
+
+    def axis_label(self, texts, width):
+        """
+        Write vertical label left of tick labels at most width pixels wide,
+        the first of alternative texts fitting the panel height.
+        """
+        text, scale = self.canvas.fit_text(texts, self.y1 - self.y0)
+        height = self.canvas.text_size(text, scale)[1]
+        x = max(self.x0 - 8 - width - LABEL_GAP * self.canvas.scale, height)
+        self.canvas.text(x, (self.y0 + self.y1) // 2, text, halign="right", valign="center", vertical=True,
+                         scale=scale)
+
+    def steps(self, time_axis, values, color=LINE):
+        """Draw step line of values changing at time_axis (where='post')."""
+        values = np.asarray(values, dtype=float)
+        steps = np.concatenate((values[:1], values))
+        edges = self.pixel_edges()
+        high = aggregate_steps(time_axis, steps, edges, "max")
+        low = -aggregate_steps(time_axis, -steps, edges, "max")
+        rows = np.arange(self.y1 - self.y0)[:, np.newaxis] + self.y0
+        self.canvas.mask(self.x0, self.y0, (rows >= self.y(high)) & (rows <= self.y(low) + 1), color)
+
+    def segments(self, segments, color=RED):
+        """Draw horizontal segments [(start, value), (end, value)] with cross at start."""
+        cross = np.eye(7, dtype=bool) | np.eye(7, dtype=bool)[::-1]
+        for (start, value), (end, _) in segments:
+            x0, x1, y = int(self.x(start)), int(self.x(end)), int(self.y(value))
+            self.canvas.rectangle(max(x0, self.x0), y - 1, min(x1 + 1, self.x1), y + 1, color)
+            self.canvas.mask(x0 - 3, y - 3, cross, color)
+
+
+def render_report(image_file, title, time_axis, map_values, differences, imbalances, sums,
+                  numa_cpus={}, size=(2000, 1000), left=0.05, right=0.9, timer=None):
+    """
+    Write report of plot-nr-running.py to PNG image_file. Arguments have the
+    same meaning as for its draw_report function.
+    """
+    timer = timer or PhaseTimer()
+    width, height = size
+    # Text grows with the image, so labels stay readable, but never below the minimal size
+    scale = max(TEXT_SCALE, height // TEXT_HEIGHT)
+    canvas = Canvas(width, height, scale)
+    x0, x1 = int(width * left), int(width * right)
+    y0, y1 = int(height * 0.05), int(height * 0.95)
+    gap = 10
+    unit = (y1 - y0 - 2 * gap) / 7
+    heat_bottom = y0 + int(4 * unit)
+    diff_bottom = heat_bottom + gap + int(unit)
+    time_range = (time_axis[0], time_axis[-1] if time_axis[-1] > time_axis[0] else time_axis[0] + 1)
+
+    # Transpose heat map data to right axes and group CPU lines by NUMA nodes
+    map_values = np.array(map_values)[:-1, :].transpose()
+    if numa_cpus:
+        new_order = []
+        for k, v in numa_cpus.items():
+            new_order += v
+        map_values = map_values[new_order]
+    cpus = map_values.shape[0]
+
+    with timer.phase("heat map"):
+        # Heat map pixels are looked up from cell of each pixel through color table
+        heat = Panel(canvas, x0, y0, x1, heat_bottom, time_range, (0, cpus))
+        time_axis = np.asarray(time_axis, dtype=float)
+        if len(time_axis) > map_values.shape[1]:
+            borders = time_axis[1:-1]  # time bins
+        else:
+            borders = (time_axis[:-1] + time_axis[1:]) / 2  # cells centered at time points
+        edges = heat.pixel_edges()
+        columns = np.searchsorted(borders, (edges[:-1] + edges[1:]) / 2, side='right')
+        rows = cpus - 1 - (np.arange(heat_bottom - y0) * cpus // (heat_bottom - y0))
+        colors = np.clip(np.floor(map_values + 0.5), 0, len(HEATMAP_COLORS) - 1).astype(np.intp)
+        canvas.pixels[y0:heat_bottom, x0:x1] = color_table(HEATMAP_COLORS)[colors[rows][:, columns]]
+
+        # Separate CPUs with lines by NUMA nodes, labels too close to the previous one are left out
+        if numa_cpus:
+            dash = (np.arange(x1 - x0) % 12 < 6)[np.newaxis, :]
+            labeled = None
+            labels = []
+            for node, start in zip(numa_cpus, node_starts(numa_cpus)):
+                y = int(heat.y(start)) + 1
+                if start:
+                    canvas.mask(x0, y, dash, WHITE)
+                if labeled is None or labeled - y >= 8 * scale:
+                    labels.append((y, "Node " + str(node)))
+                    labeled = y
+        else:
+            row_height = (heat_bottom - y0) / max(cpus, 1)
+            step = max(1, math.ceil(8 * scale / row_height))
+            labels = [(int(heat.y(cpu + 0.5)), str(cpu)) for cpu in range(0, cpus, step)]
+        for y, label in labels:
+            canvas.text(x0 - 8, y, label, halign="right", valign="center")
+        canvas.frame(x0, y0, x1, heat_bottom)
+        canvas.text((x0 + x1) // 2, y0 - 8, title, halign="center", valign="bottom")
+        heat.axis_label(["CPUs"], max([canvas.text_size(label)[0] for _, label in labels], default=0))
+        # Tick labels of line graphs start below the lowest label of heat map
+        text_height = canvas.text_size("0")[1]
+        lowest = max([y - text_height // 2 + text_height for y, _ in labels], default=heat_bottom)
+
+    with timer.phase("lines"):
+        # Line graphs with differences and sums
+        ticks = nice_ticks(*time_range)
+        for top, bottom, values, labels, segments in (
+                (heat_bottom + gap, diff_bottom, differences, ["Max difference", "Max diff."], imbalances),
+                (diff_bottom + gap, y1, sums, ["Sum of tasks", "Sum"], [])):
+            high = max([max(values)] + [s[0][1] for s in segments])
+            panel = Panel(canvas, x0, top, x1, bottom, time_range, (0, high * 1.05 if high > 0 else 1))
+            panel.time_grid(ticks, labels=bottom == y1)
+            # Labels may reach into the next gap, the last ones up to the time labels
+            label_width, lowest = panel.value_grid(nice_ticks(*panel.value_range, count=5 if bottom == y1 else 3),
+                                                   lowest, bottom + gap if bottom < y1 else y1 + 8)
+            panel.steps(time_axis, values)
+            panel.segments(segments)
+            canvas.frame(x0, top, x1, bottom)
+            panel.axis_label(labels, label_width)
+        canvas.text((x0 + x1) // 2, y1 + 8 + 11 * scale, "Timestamp (seconds)", halign="center")
+
+    # Color bar
+    bar_x0, bar_x1 = int(width * 0.95), int(width * 0.97)
+    box = (y1 - y0) / len(HEATMAP_COLORS)
+    for i, color in enumerate(color_table(HEATMAP_COLORS)):
+        top = int(y1 - (i + 1) * box)
+        canvas.rectangle(bar_x0, top, bar_x1, int(y1 - i * box), color)
+        canvas.rectangle(bar_x1, int(top + box / 2), bar_x1 + 5, int(top + box / 2) + 1, BLACK)
+        label = str(i) if i < len(HEATMAP_COLORS) - 1 else str(i) + "+"
+        canvas.text(bar_x1 + 8, int(top + box / 2), label, valign="center")
+    canvas.frame(bar_x0, y0, bar_x1, y1)
+    canvas.text(bar_x1 + 8 + 21 * scale, (y0 + y1) // 2, "Number of tasks on CPU core", halign="center", valign="center",
+                vertical=True)
+
+    with timer.phase("save"):
+        canvas.save(image_file)
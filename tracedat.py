@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+
+"""
+Reading of sched_update_nr_running events directly from trace.dat files
+recorded by trace-cmd, without generating text by trace-cmd report.
+Copyright (C) 2020  Jiri Vozar
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Only the version 6 file format is supported. Version 7 files (trace-cmd 3)
+can be recorded in version 6 with 'trace-cmd record --file-version 6'.
+"""
+
+import re
+import struct
+
+import numpy as np
+
+from nr_running import EventLog
+
+MAGIC = b"\x17\x08\x44tracing"
+EVENT_NAME = "sched_update_nr_running"
+
+# Ring buffer event types
+TYPE_PADDING = 29
+TYPE_TIME_EXTEND = 30
+TYPE_TIME_STAMP = 31
+TS_SHIFT = 27
+COMMIT_MASK = (1 << 27) - 1
+
+OPTION_UNAME = 5  # ID of option with uname of the recording machine
+
+FIELD_RE = re.compile(r"field:(.*?);\s*offset:(\d+);\s*size:(\d+);(?:\s*signed:(\d+);)?")
+
+HEADER_PAGE_FORMAT = """\tfield: u64 timestamp;\toffset:0;\tsize:8;\tsigned:0;
+\tfield: local_t commit;\toffset:8;\tsize:8;\tsigned:1;
+\tfield: int overwrite;\toffset:8;\tsize:1;\tsigned:1;
+\tfield: char data;\toffset:16;\tsize:{};\tsigned:1;
+"""
+
+HEADER_EVENT_FORMAT = """# compressed entry header
+\ttype_len    :    5 bits
+\ttime_delta  :   27 bits
+\tarray       :   32 bits
+
+\tpadding     : type == 29
+\ttime_extend : type == 30
+\ttime_stamp : type == 31
+\tdata max type_len  == 28
+"""
+
+EVENT_FORMAT = """name: sched_update_nr_running
+ID: {}
+format:
+\tfield:unsigned short common_type;\toffset:0;\tsize:2;\tsigned:0;
+\tfield:unsigned char common_flags;\toffset:2;\tsize:1;\tsigned:0;
+\tfield:unsigned char common_preempt_count;\toffset:3;\tsize:1;\tsigned:0;
+\tfield:int common_pid;\toffset:4;\tsize:4;\tsigned:1;
+
+\tfield:int cpu;\toffset:8;\tsize:4;\tsigned:1;
+\tfield:int change;\toffset:12;\tsize:4;\tsigned:1;
+\tfield:unsigned int nr_running;\toffset:16;\tsize:4;\tsigned:0;
+
+print fmt: "cpu=%d change=%d nr_running=%u", REC->cpu, REC->change, REC->nr_running
+"""
+
+
+class TraceDatError(Exception):
+    pass
+
+
+def is_trace_dat(file_name):
+    """Check whether file starts with magic bytes of trace.dat file."""
+    with open(file_name, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def parse_format(text):
+    """Return event ID and dictionary of fields (offset, size, signed) from event format."""
+    event_id = int(re.search(r"^ID:\s*(\d+)", text, re.M).group(1))
+    fields = {}
+    for declaration, offset, size, signed in FIELD_RE.findall(text):
+        name = declaration.split()[-1].split('[')[0]
+        fields[name] = (int(offset), int(size), signed == '1')
+    return event_id, fields
+
+
+class Reader:
+    """Sequential reader of the trace.dat headers."""
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+        self.endian = '<'
+
+    def read(self, size):
+        chunk = self.data[self.pos:self.pos + size]
+        if len(chunk) != size:
+            raise TraceDatError("Unexpected end of trace.dat file")
+        self.pos += size
+        return bytes(chunk)
+
+    def number(self, size):
+        return struct.unpack(self.endian + {2: 'H', 4: 'I', 8: 'Q'}[size], self.read(size))[0]
+
+    def string(self):
+        end = self.data.find(b'\0', self.pos)
+        if end < 0:
+            raise TraceDatError("Unexpected end of trace.dat file")
+        text = bytes(self.data[self.pos:end]).decode()
+        self.pos = end + 1
+        return text
+
+
+def read_headers(data):
+    """
+    Read headers of trace.dat file. Return dictionary with file properties,
+    format of sched_update_nr_running event and (offset, size) of data of each CPU.
+    """
+    reader = Reader(data)
+    if reader.read(len(MAGIC)) != MAGIC:
+        raise TraceDatError("Not a trace.dat file")
+    version = reader.string()
+    if version != '6':
+        raise TraceDatError("Unsupported trace.dat version {}. Record the trace with"
+                            " 'trace-cmd record --file-version 6'".format(version))
+    reader.endian = '>' if reader.read(1) == b'\1' else '<'
+    header = {'endian': reader.endian,
+              'long_size': reader.read(1)[0],
+              'page_size': reader.number(4)}
+
+    if reader.string() != "header_page":
+        raise TraceDatError("Missing header_page section")
+    _, fields = parse_format("ID: 0\n" + reader.read(reader.number(8)).decode())
+    header['timestamp'] = fields['timestamp'][:2]
+    header['commit'] = fields['commit'][:2]
+    header['data_offset'] = fields['data'][0]
+
+    if reader.string() != "header_event":
+        raise TraceDatError("Missing header_event section")
+    reader.read(reader.number(8))
+
+    # Formats of ftrace internal events
+    for _ in range(reader.number(4)):
+        reader.read(reader.number(8))
+
+    header['event'] = None
+    for _ in range(reader.number(4)):
+        reader.string()  # system name
+        for _ in range(reader.number(4)):
+            text = reader.read(reader.number(8)).decode(errors='replace')
+            if re.search(r"^name:\s*{}\s*$".format(EVENT_NAME), text, re.M):
+                header['event'] = parse_format(text)
+
+    reader.read(reader.number(4))  # kallsyms
+    reader.read(reader.number(4))  # printk formats
+    reader.read(reader.number(8))  # process names
+
+    header['cpus'] = reader.number(4)
+    section = reader.read(10)
+    if section == b"options  \0":
+        while True:
+            # The list of options ends with a bare zero ID without size
+            option = reader.number(2)
+            if option == 0:
+                break
+            reader.read(reader.number(4))
+        section = reader.read(10)
+    if section != b"flyrecord\0":
+        raise TraceDatError("Only flyrecord trace.dat files are supported")
+    header['buffers'] = [(reader.number(8), reader.number(8)) for _ in range(header['cpus'])]
+    return header
+
+
+def read_uint(pages, rows, positions, size, endian):
+    """Read unsigned integers of size bytes at positions of rows of pages."""
+    flat = pages.reshape(-1)
+    index = rows * pages.shape[1] + positions
+    if size in (2, 4, 8) and not np.any(index % size):
+        return flat.view(endian + 'u' + str(size))[index // size].astype(np.uint64)
+    values = np.zeros(len(rows), dtype=np.uint64)
+    order = range(size) if endian == '<' else reversed(range(size))
+    for shift, byte in enumerate(order):
+        values |= flat[index + byte].astype(np.uint64) << np.uint64(8 * shift)
+    return values
+
+
+def read_field(pages, rows, positions, field, endian):
+    """Read integer field (offset, size, signed) of events starting at positions."""
+    offset, size, signed = field
+    values = read_uint(pages, rows, positions + offset, size, endian).astype(np.int64)
+    if signed:
+        values = np.where(values >= 1 << (8 * size - 1), values - (1 << (8 * size)), values)
+    return values
+
+
+def read_buffer(pages, header):
+    """
+    Walk events of all ring buffer pages at once, one event of every
+    page in each step. Return (timestamp, page, step, cpu, change,
+    nr_running) arrays of sched_update_nr_running events.
+    """
+    endian = header['endian']
+    event_id, fields = header['event']
+    rows = np.arange(len(pages))
+    timestamp = read_uint(pages, rows, np.full(len(pages), header['timestamp'][0]),
+                          header['timestamp'][1], endian).astype(np.int64)
+    end = header['data_offset'] + (read_uint(pages, rows, np.full(len(pages), header['commit'][0]),
+                                             header['commit'][1], endian) & COMMIT_MASK).astype(np.int64)
+    position = np.full(len(pages), header['data_offset'], dtype=np.int64)
+    end = np.minimum(end, pages.shape[1])
+    found = []
+    step = 0
+
+    while True:
+        active = np.flatnonzero(position + 4 <= end)
+        if not len(active):
+            break
+        position_active = position[active]
+        event_header = read_uint(pages, active, position_active, 4, endian).astype(np.int64)
+        type_len = event_header & 31
+        delta = event_header >> 5
+        array = read_uint(pages, active, np.minimum(position_active + 4, pages.shape[1] - 4), 4, endian).astype(np.int64)
+
+        length = np.where(type_len == 0, ((array - 4 + 3) & ~3) + 4, type_len * 4)
+        length = np.where(type_len == TYPE_PADDING, array, length)
+        length = np.where(type_len >= TYPE_TIME_EXTEND, 4, length)
+
+        # Null padding event ends the data of page
+        null = (type_len == TYPE_PADDING) & (delta == 0) & (array == 0)
+        extend = np.where(type_len >= TYPE_TIME_EXTEND, (array << TS_SHIFT) + delta, delta)
+        timestamp[active] = np.where(type_len == TYPE_TIME_STAMP, extend,
+                                     timestamp[active] + np.where(type_len == TYPE_PADDING, delta, extend))
+
+        data = (type_len > 0) & (type_len <= 28) | (type_len == 0)
+        data_position = position_active + 4 + (type_len == 0) * 4
+        if np.any(data):
+            rows_data = active[data]
+            start = data_position[data]
+            common_type = read_uint(pages, rows_data, start, 2, endian).astype(np.int64)
+            match = common_type == event_id
+            rows_data = rows_data[match]
+            start = start[match]
+            found.append((timestamp[rows_data], rows_data, np.full(len(rows_data), step),
+                          read_field(pages, rows_data, start, fields['cpu'], endian),
+                          read_field(pages, rows_data, start, fields['change'], endian),
+                          read_field(pages, rows_data, start, fields['nr_running'], endian)))
+
+        position[active] = np.where(null, end[active], position_active + 4 + length)
+        step += 1
+
+    if not found:
+        return tuple(np.zeros(0, dtype=np.int64) for _ in range(6))
+    return tuple(np.concatenate(column) for column in zip(*found))
+
+
+def read_trace_dat(file_name):
+    """Return EventLog with sched_update_nr_running events of trace.dat file."""
+    with open(file_name, 'rb') as f:
+        data = f.read()
+    header = read_headers(data)
+    if header['event'] is None:
+        raise TraceDatError("Event {} was not recorded in {}".format(EVENT_NAME, file_name))
+
+    page_size = header['page_size']
+    buffers = [np.frombuffer(data, dtype=np.uint8, count=size // page_size * page_size, offset=offset)
+               for offset, size in header['buffers']]
+    pages = np.concatenate(buffers).reshape(-1, page_size)
+    page_buffer = np.repeat(np.arange(len(buffers)), [len(b) // page_size for b in buffers])
+    timestamp, page, step, cpu, change, nr_running = read_buffer(pages, header)
+    buffer = page_buffer[page]
+
+    # Merge events of all CPUs by time, events with equal time of one CPU stay in order
+    order = np.lexsort((step, page, buffer, timestamp))
+    return EventLog(header['cpus'], timestamp[order], cpu[order].astype(np.uint16),
+                    change[order].astype(np.int16), nr_running[order].astype(np.int16))
+
+
+def write_trace_dat(file_name, cpus_count, time, cpu, change, nr_running, record_cpu=None,
+                    page_size=4096, event_id=300):
+    """
+    Write sched_update_nr_running events to a minimal version 6 trace.dat file,
+    e.g. to create synthetic traces without kernel. Events are recorded in ring
+    buffers of record_cpu, which defaults to the cpu field of events.
+    """
+    time = np.asarray(time, dtype=np.int64)
+    record_cpu = np.asarray(cpu if record_cpu is None else record_cpu)
+
+    def section(text, size_format):
+        data = text.encode()
+        return struct.pack(size_format, len(data)) + data
+
+    out = bytearray(MAGIC + b"6\0" + b"\0" + b"\x08" + struct.pack('<I', page_size))
+    out += b"header_page\0" + section(HEADER_PAGE_FORMAT.format(page_size - 16), '<Q')
+    out += b"header_event\0" + section(HEADER_EVENT_FORMAT, '<Q')
+    out += struct.pack('<I', 0)  # ftrace events
+    out += struct.pack('<I', 1) + b"sched\0" + struct.pack('<I', 1)
+    out += section(EVENT_FORMAT.format(event_id), '<Q')
+    out += section("", '<I')  # kallsyms
+    out += section("", '<I')  # printk formats
+    out += section("", '<Q')  # process names
+    out += struct.pack('<I', cpus_count)
+    uname = b"Linux generate-nr-running 6 x86_64\0"
+    out += b"options  \0" + struct.pack('<HI', OPTION_UNAME, len(uname)) + uname + struct.pack('<H', 0)
+    out += b"flyrecord\0"
+
+    buffers = []
+    for buffer in range(cpus_count):
+        pages = []
+        page = bytearray()
+        last = 0
+        for i in np.flatnonzero(record_cpu == buffer):
+            record = struct.pack('<HBBiiiI', event_id, 0, 0, 0, int(cpu[i]), int(change[i]), int(nr_running[i]))
+            if not page or len(page) + 8 + 4 + len(record) > page_size - 16:
+                if page:
+                    pages.append(page)
+                page = bytearray(struct.pack('<QQ', int(time[i]), 0))
+                last = int(time[i])
+            delta = int(time[i]) - last
+            if delta >= 1 << TS_SHIFT:
+                page += struct.pack('<II', TYPE_TIME_EXTEND | (delta & ((1 << TS_SHIFT) - 1)) << 5,
+                                    delta >> TS_SHIFT)
+                delta = 0
+            page += struct.pack('<I', len(record) // 4 | delta << 5) + record
+            last = int(time[i])
+        if page:
+            pages.append(page)
+        for page in pages:
+            page[8:16] = struct.pack('<Q', len(page) - 16)
+            page += bytes(page_size - len(page))
+        buffers.append(b"".join(pages))
+
+    # Data of CPUs start at page boundaries after the table of offsets
+    offset = -(-(len(out) + 16 * cpus_count) // page_size) * page_size
+    for data in buffers:
+        out += struct.pack('<QQ', offset, len(data))
+        offset += len(data)
+    out += bytes(-len(out) % page_size)
+    for data in buffers:
+        out += data
+
+    with open(file_name, 'wb') as f:
+        f.write(out)